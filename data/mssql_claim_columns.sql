@@ -0,0 +1,12 @@
+-- SQL Server migration for the embedder's claim scheduler (embedder-service/claim_scheduler.py).
+-- Run once before setting CLAIM_SCHEDULER = True; running it again changes nothing.
+IF COL_LENGTH('dbo.Tracks', 'claimed_at') IS NULL
+    ALTER TABLE dbo.Tracks ADD claimed_at DATETIME2(3) NULL;
+GO
+
+-- rows already being processed get a full lease from now instead of going back to 'collected' at once
+UPDATE dbo.Tracks SET claimed_at = SYSUTCDATETIME() WHERE status = 'processing' AND claimed_at IS NULL;
+
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_Tracks_ClaimedAt' AND object_id = OBJECT_ID('dbo.Tracks'))
+    CREATE INDEX IX_Tracks_ClaimedAt ON dbo.Tracks(claimed_at);
+GO
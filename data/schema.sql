@@ -0,0 +1,69 @@
+-- SQLite schema shared by embedder-service/db_sqlite.py and yt-collector/dao_sqlite.py; both run it on connect.
+-- Same tables and columns as the SQL Server schema; timestamps are UTC "YYYY-MM-DD HH:MM:SS.fff" text.
+CREATE TABLE IF NOT EXISTS Tracks (
+    id              TEXT PRIMARY KEY,
+    platform        TEXT NOT NULL,
+    source_id       TEXT NOT NULL,
+    source_url      TEXT NOT NULL,
+    status          TEXT NOT NULL DEFAULT 'collected',
+    title           TEXT,
+    channel_id      TEXT,
+    category_id     INTEGER,
+    upload_date     TEXT,
+    duration_sec    INTEGER,
+    view_count      INTEGER,
+    is_live         INTEGER,
+    etag            TEXT,
+    country_bucket  TEXT,
+    scene           TEXT,
+    seed            INTEGER NOT NULL DEFAULT 0,
+    start_s         INTEGER,
+    dur_s           INTEGER,
+    collected_at    TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')),
+    last_checked_at TEXT,
+    claimed_at      TEXT,
+    processed_at    TEXT,
+    error           TEXT,
+    UNIQUE (platform, source_id)
+);
+CREATE INDEX IF NOT EXISTS IX_Tracks_Status ON Tracks(status, platform, collected_at);
+CREATE INDEX IF NOT EXISTS IX_Tracks_ClaimedAt ON Tracks(claimed_at);
+
+CREATE TABLE IF NOT EXISTS Playlists (
+    id                   TEXT PRIMARY KEY,
+    platform             TEXT NOT NULL,
+    source_playlist_id   TEXT NOT NULL,
+    title                TEXT,
+    description          TEXT,
+    country              TEXT,
+    scene                TEXT,
+    etag                 TEXT,
+    created_at           TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')),
+    last_scanned_at      TEXT,
+    cooccurrence_counted INTEGER NOT NULL DEFAULT 0,
+    coherence            REAL,
+    hub_score            REAL,
+    UNIQUE (platform, source_playlist_id)
+);
+
+CREATE TABLE IF NOT EXISTS TrackPlaylists (
+    playlist_id   TEXT NOT NULL,
+    track_id      TEXT NOT NULL,
+    position      INTEGER,
+    first_seen_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')),
+    last_seen_at  TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')),
+    PRIMARY KEY (playlist_id, track_id)
+);
+
+CREATE TABLE IF NOT EXISTS CoOccurrence (
+    track_id_a TEXT NOT NULL,
+    track_id_b TEXT NOT NULL,
+    count      INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (track_id_a, track_id_b)
+);
+
+CREATE TABLE IF NOT EXISTS VectorMap (
+    faiss_id INTEGER PRIMARY KEY,
+    track_id TEXT NOT NULL UNIQUE,
+    added_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now'))
+);
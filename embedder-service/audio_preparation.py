@@ -3,19 +3,18 @@ import torch
 import torchaudio
 import noisereduce as nr
 import numpy as np
-from transformers import AutoProcessor, AutoModel
-from config import TARGET_SAMPLING_RATE
+from config import TARGET_SAMPLING_RATE, EMBED_BATCH_SIZE
 from logger import logger
+from model_registry import ModelRegistry, get_registry
 import time
+from functools import lru_cache
+from typing import List, Optional
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-processor = AutoProcessor.from_pretrained(
-    "m-a-p/MERT-v1-95M", trust_remote_code=True, use_fast=False
-)
-model = AutoModel.from_pretrained(
-    "m-a-p/MERT-v1-95M", trust_remote_code=True
-).to(device)
-model.eval()
+
+@lru_cache(maxsize=None)
+def get_resampler(orig_sr: int, new_sr: int = TARGET_SAMPLING_RATE) -> torchaudio.transforms.Resample:
+    # building Resample computes the sinc kernel; keep one per source rate
+    return torchaudio.transforms.Resample(orig_sr, new_sr)
 
 
 def trim_silence_torch(waveform: torch.Tensor, top_db: float = 60.0) -> torch.Tensor:
@@ -48,13 +47,10 @@ def denoise(waveform: torch.Tensor, sr: int) -> torch.Tensor:
     return torch.from_numpy(reduced).unsqueeze(0).to(waveform.dtype)
 
 
-def load_and_prep(pth: str, do_denoise: bool = False) -> torch.Tensor:
-    start = time.time()
-    waveform, sr = torchaudio.load(pth)
-
+def prep_waveform(waveform: torch.Tensor, sr: int, do_denoise: bool = False) -> torch.Tensor:
     # Resample
     if sr != TARGET_SAMPLING_RATE:
-        waveform = torchaudio.transforms.Resample(sr, TARGET_SAMPLING_RATE)(waveform)
+        waveform = get_resampler(sr)(waveform)
         sr = TARGET_SAMPLING_RATE
 
     # Mono mix
@@ -71,42 +67,104 @@ def load_and_prep(pth: str, do_denoise: bool = False) -> torch.Tensor:
     if do_denoise:
         waveform = denoise(waveform, sr)
 
+    return waveform
+
+
+def load_and_prep(pth: str, do_denoise: bool = False) -> torch.Tensor:
+    start = time.time()
+    waveform, sr = torchaudio.load(pth)
+    waveform = prep_waveform(waveform, sr, do_denoise=do_denoise)
+
     duration = time.time() - start
     logger.info(f"load_and_prep({os.path.basename(pth)}) took {duration:.3f}s")
     return waveform
 
 
-def get_embedding_from_waveform(waveform: torch.Tensor) -> np.ndarray:
-    with torch.no_grad():
-        audio_np = waveform.squeeze(0).cpu().numpy()
+def _frame_mask(model, sample_lengths: torch.Tensor, n_frames: int, max_samples: int) -> torch.Tensor:
+    if hasattr(model, "_get_feat_extract_output_lengths"):
+        frame_lengths = model._get_feat_extract_output_lengths(sample_lengths)
+    else:
+        frame_lengths = torch.ceil(sample_lengths.float() * n_frames / max(1, max_samples))
+    frame_lengths = frame_lengths.long().clamp(min=1, max=n_frames)
+    return torch.arange(n_frames, device=sample_lengths.device)[None, :] < frame_lengths[:, None]
+
+
+def get_embeddings_from_windows(windows: List[torch.Tensor], registry: Optional[ModelRegistry] = None) -> np.ndarray:
+    # one padded forward pass over all windows; rows match get_embedding_from_waveform per window
+    registry = registry or get_registry()
+    processor, model = registry.get()
+    with registry.inference_context():
+        audio_np = [w.squeeze(0).cpu().numpy() for w in windows]
         inputs = processor(raw_speech=audio_np,
                            sampling_rate=TARGET_SAMPLING_RATE,
+                           padding=True,
                            return_tensors="pt")
-        inputs = {k: v.to(device) for k, v in inputs.items()}
-        hidden = model(**inputs).last_hidden_state
-        emb = hidden.mean(dim=1).squeeze()
-    return emb.cpu().numpy().astype("float32")
+        weights = registry.layer_weights
+        out = model(**registry.to_model_inputs(inputs), output_hidden_states=bool(weights))
+        hidden = out.last_hidden_state
+
+        sample_lengths = torch.tensor([a.shape[-1] for a in audio_np], device=registry.device)
+        mask = _frame_mask(model, sample_lengths, hidden.size(1), int(sample_lengths.max()))
+        mask = mask.unsqueeze(-1).to(hidden.dtype)
+        denom = mask.sum(dim=1).clamp(min=1.0)
+        if weights:
+            emb = sum(w * (out.hidden_states[layer] * mask).sum(dim=1) for layer, w in weights.items())
+            emb = emb / (denom * sum(weights.values()))
+        else:
+            emb = (hidden * mask).sum(dim=1) / denom
+    return emb.float().cpu().numpy().astype("float32")
 
 
-def windowed_embedding(
-        waveform: torch.Tensor,
-        sr: int = TARGET_SAMPLING_RATE,
-        window_s: float = 5.0,
-        stride_s: float = 2.5
-) -> np.ndarray:
+def get_embedding_from_waveform(waveform: torch.Tensor) -> np.ndarray:
+    return get_embeddings_from_windows([waveform])[0]
+
+
+def _slice_windows(waveform: torch.Tensor, sr: int, window_s: float, stride_s: float) -> List[torch.Tensor]:
     win_len = int(window_s * sr)
     step = int(stride_s * sr)
-    vecs = []
     total_samples = waveform.size(1)
+    return [
+        waveform[:, start:start + win_len]
+        for start in range(0, max(1, total_samples - win_len + 1), step)
+    ] or [waveform]
 
-    for start in range(0, max(1, total_samples - win_len + 1), step):
-        w = waveform[:, start:start + win_len]
-        vecs.append(get_embedding_from_waveform(w))
 
-    if not vecs:
-        return get_embedding_from_waveform(waveform)
+def embed_waveforms(
+        waveforms: List[torch.Tensor],
+        sr: int = TARGET_SAMPLING_RATE,
+        window_s: float = 5.0,
+        stride_s: float = 2.5,
+        batch_size: int = EMBED_BATCH_SIZE,
+        registry: Optional[ModelRegistry] = None
+) -> np.ndarray:
+    # windows of several tracks share forward passes; returns one window-averaged row per track
+    windows: List[torch.Tensor] = []
+    owners: List[int] = []
+    for i, w in enumerate(waveforms):
+        ws = _slice_windows(w, sr, window_s, stride_s)
+        windows.extend(ws)
+        owners.extend([i] * len(ws))
 
-    return np.mean(vecs, axis=0)
+    batch_size = max(1, int(batch_size))
+    vecs = np.concatenate([
+        get_embeddings_from_windows(windows[i:i + batch_size], registry=registry)
+        for i in range(0, len(windows), batch_size)
+    ], axis=0)
+
+    owners_arr = np.asarray(owners)
+    return np.stack([vecs[owners_arr == i].mean(axis=0) for i in range(len(waveforms))])
+
+
+def windowed_embedding(
+        waveform: torch.Tensor,
+        sr: int = TARGET_SAMPLING_RATE,
+        window_s: float = 5.0,
+        stride_s: float = 2.5,
+        batch_size: int = EMBED_BATCH_SIZE,
+        registry: Optional[ModelRegistry] = None
+) -> np.ndarray:
+    return embed_waveforms([waveform], sr=sr, window_s=window_s, stride_s=stride_s,
+                           batch_size=batch_size, registry=registry)[0]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,127 @@
+﻿import os
+import math
+import time
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import (
+    BATCH_LIMIT, SCENE_CONFIG_PATH, CLAIM_SEED_WEIGHT, CLAIM_VIEWS_WEIGHT, CLAIM_AGE_WEIGHT_PER_DAY,
+    CLAIM_BUCKET_WEIGHTS, CLAIM_CANDIDATE_FACTOR, CLAIM_TARGET_BATCH_SECONDS, CLAIM_MIN_BATCH, CLAIM_MAX_BATCH,
+    CLAIM_LEASE_SECONDS, CLAIM_LEASE_CHECK_SECONDS, CLAIM_RACE_RETRIES
+)
+from db import fetch_claim_candidates, admitted_since, claim_ids, requeue_expired
+from logger import logger
+
+def load_scene_caps(path: str = SCENE_CONFIG_PATH) -> Dict[Tuple[str, str], int]:
+    # {(country_bucket, scene): daily_admit_cap} from the collector's config.yaml
+    if not os.path.exists(path):
+        logger.warning(f"Scene config not found at {path}; daily admit caps are off")
+        return {}
+    try:
+        import yaml
+    except ImportError:
+        logger.warning("pyyaml is not installed; daily admit caps are off")
+        return {}
+    with open(path, encoding="utf-8") as f:
+        data = yaml.safe_load(f) or {}
+    # a scene without its own cap takes global.daily_admit_cap; with neither it is uncapped
+    default = (data.get("global") or {}).get("daily_admit_cap")
+    caps = {}
+    for country, scenes in (data.get("country_scenes") or {}).items():
+        for scene in scenes or []:
+            cap = scene.get("daily_admit_cap", default)
+            if scene.get("name") and cap is not None:
+                caps[(country, scene["name"])] = int(cap)
+    return caps
+
+
+def _utc_midnight() -> datetime:
+    return datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class ClaimScheduler:
+    # picks the next batch by score within each bucket's remaining daily quota, sized from measured latency
+    def __init__(self, caps: Optional[Dict[Tuple[str, str], int]] = None, batch: int = BATCH_LIMIT,
+                 target_seconds: float = CLAIM_TARGET_BATCH_SECONDS, min_batch: int = CLAIM_MIN_BATCH,
+                 max_batch: int = CLAIM_MAX_BATCH, lease_seconds: float = CLAIM_LEASE_SECONDS):
+        self.caps = load_scene_caps() if caps is None else caps
+        self.batch = batch
+        self.target_seconds = target_seconds
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.lease_seconds = lease_seconds
+        self.seconds_per_track: Optional[float] = None  # EWMA over finished batches
+        self._last_lease_check = 0.0
+        self._lock = threading.Lock()
+
+    def batch_size(self) -> int:
+        if not self.seconds_per_track:
+            return max(self.min_batch, min(self.max_batch, self.batch))
+        return max(self.min_batch, min(self.max_batch, int(self.target_seconds / self.seconds_per_track)))
+
+    def record(self, n_tracks: int, seconds: float) -> None:
+        if n_tracks <= 0 or seconds <= 0:
+            return
+        per_track = seconds / n_tracks
+        with self._lock:
+            # the first sample sets the estimate, later ones move it by a third
+            self.seconds_per_track = per_track if self.seconds_per_track is None else \
+                self.seconds_per_track + (per_track - self.seconds_per_track) / 3
+
+    def maybe_requeue_expired(self) -> int:
+        if time.time() - self._last_lease_check < CLAIM_LEASE_CHECK_SECONDS:
+            return 0
+        self._last_lease_check = time.time()
+        n = requeue_expired(self.lease_seconds)
+        if n:
+            logger.warning(f"Requeued {n} rows whose processing lease ({self.lease_seconds:.0f}s) expired")
+        return n
+
+    def remaining(self) -> Dict[Tuple[str, str], int]:
+        used = admitted_since(_utc_midnight()) if self.caps else {}
+        return {bucket: cap - used.get(bucket, 0) for bucket, cap in self.caps.items()}
+
+    def select(self, candidates: List[Dict[str, Any]], limit: int,
+               remaining: Dict[Tuple[str, str], int]) -> List[str]:
+        # greedy by score; a bucket at its cap is skipped, buckets without a cap are not limited
+        left = dict(remaining)
+        chosen = []
+        for c in candidates:
+            if len(chosen) >= limit:
+                break
+            quota = left.get(c["bucket"], math.inf)
+            if quota <= 0:
+                continue
+            if c["bucket"] in left:
+                left[c["bucket"]] = quota - 1
+            chosen.append(c["id"])
+        return chosen
+
+    def next_batch(self) -> List[Dict[str, Any]]:
+        self.maybe_requeue_expired()
+        limit = self.batch_size()
+        remaining = self.remaining()
+        jobs: List[Dict[str, Any]] = []
+        for _ in range(CLAIM_RACE_RETRIES + 1):
+            candidates = fetch_claim_candidates(
+                limit * CLAIM_CANDIDATE_FACTOR, limit, CLAIM_SEED_WEIGHT, CLAIM_VIEWS_WEIGHT,
+                CLAIM_AGE_WEIGHT_PER_DAY, CLAIM_BUCKET_WEIGHTS
+            )
+            chosen = self.select(candidates, limit - len(jobs), remaining)
+            if candidates and not chosen and not jobs:
+                logger.info("Every bucket with pending rows is at its daily admit cap")
+            won = claim_ids(chosen)
+            jobs += won
+            buckets = {c["id"]: c["bucket"] for c in candidates}
+            for job in won:
+                if buckets.get(job["id"]) in remaining:
+                    remaining[buckets[job["id"]]] -= 1
+            # another worker claimed part of the same candidates; fetch again for the rest
+            if len(won) == len(chosen) or len(jobs) >= limit:
+                break
+        if jobs:
+            capped = {f"{b[0]}/{b[1]}": max(0, n) for b, n in remaining.items() if n < limit}
+            logger.info(f"Claimed {len(jobs)}/{limit} rows (s/track={self.seconds_per_track or 0:.2f}"
+                        f"{', near cap: ' + str(capped) if capped else ''})")
+        return jobs
@@ -1,6 +1,9 @@
 ﻿AUDIO_PATH = "audio/processed/"
 FAISS_INDEX_PATH = "faiss/music.index"
+FAISS_JOURNAL_PATH = "faiss/music.journal"
 MAPPING_PATH = "faiss/mapping.csv"
+MAPPING_COMPACT_PATH = "faiss/mapping.npy"  # mmap-able GUID table built from the CSV/SQL mapping by mapping_compact.py
+EMBED_CACHE_DIR = "cache/embeddings/"
 
 EMBEDDING_DIM = 768
 TARGET_SAMPLING_RATE = 24000
@@ -9,8 +12,72 @@ YT_START_SECONDS = 0
 YT_CLIP_SECONDS = 30
 BATCH_LIMIT = 16
 
+# bump whenever load_and_prep / windowing changes so cached embeddings are not reused
+EMBED_PREP_VERSION = 1
+EMBED_CACHE_ENABLED = True
+EMBED_CACHE_SHARD_ROWS = 65536
+
+# read ffmpeg PCM from stdout into memory; False falls back to temp WAV files
+YT_STREAM_PCM = True
+FULL_TRACK_PREALLOC_SECONDS = 600
+
+# max windows per MERT forward pass in windowed_embedding
+EMBED_BATCH_SIZE = 8
+# clips per PreprocessEngine.prep_batch call when loading a folder of local audio
+# (precision_check / depth_benchmark reference sets under AUDIO_PATH, preprocess.py)
+PREP_BATCH_SIZE = 16
+
+# embed_from_db_once pipeline: resolve/ffmpeg threads, load_and_prep threads,
+# bounded queue depth between stages and tracks per inference batch
+PIPELINE_IO_WORKERS = 4
+PIPELINE_PREP_WORKERS = 2
+PIPELINE_QUEUE_SIZE = 8
+PIPELINE_INFER_TRACKS = 4
+
+# flat | ivf_flat | ivf_pq | hnsw | fp16 | sq8 | pq_refine; IVF, sq8 and pq_refine need training data
+# and are built with index_migrate.py
+FAISS_INDEX_TYPE = "flat"
+FAISS_IVF_NLIST = 4096
+FAISS_PQ_M = 64
+FAISS_PQ_BITS = 8
+FAISS_HNSW_M = 32
+FAISS_HNSW_EF_CONSTRUCTION = 200
+# search-time knobs applied whenever an index is loaded
+FAISS_NPROBE = 32
+FAISS_EF_SEARCH = 128
+FAISS_REFINE_K_FACTOR = 8  # pq_refine: PQ candidates re-scored at full precision = k * this
+
+# music.index is rewritten when either limit is reached; in between, adds go to the journal
+INDEX_CHECKPOINT_SECONDS = 300
+INDEX_CHECKPOINT_RECORDS = 5000
+
+# sharded layout: manifest.json + one index/journal per shard; only the newest (open) shard takes writes
+FAISS_SHARDED = False
+FAISS_SHARD_DIR = "faiss/shards"
+FAISS_SHARD_MAX_ROWS = 1_000_000  # the open shard is sealed at the first checkpoint past this size
+
+# knn_graph.py: exact top-K neighbours of every vector, built offline in row x column blocks
+KNN_GRAPH_DIR = "faiss/knn"
+KNN_K = 50
+KNN_BLOCK_ROWS = 1024
+KNN_BLOCK_COLS = 16384
+
 import os
 
+MERT_MODEL_ID = os.getenv("MERT_MODEL_ID", "m-a-p/MERT-v1-95M")
+MODEL_DEVICE = os.getenv("MODEL_DEVICE", "auto")  # auto | cpu | cuda | cuda:N
+MODEL_DTYPE = os.getenv("MODEL_DTYPE", "float32")  # float32 | bfloat16 | float16
+# float32 | bfloat16 (autocast) | int8 (dynamic quantization of nn.Linear, CPU only)
+MODEL_PRECISION = os.getenv("MODEL_PRECISION", "float32")
+# stop the forward pass after this many transformer layers (0 = all)
+MODEL_NUM_LAYERS = int(os.getenv("MODEL_NUM_LAYERS", "0"))
+# layers to mean-pool: "last", "6" or weighted "4:0.5,6:0.5" (0 = feature projection output)
+EMBED_LAYERS = os.getenv("EMBED_LAYERS", "last")
+
+# mssql | sqlite; sqlite (db_sqlite.py) is the local stand-in for load tests and CI, shared with yt-collector
+DB_BACKEND = os.getenv("DB_BACKEND", "mssql").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "../data/ums.sqlite3")
+
 DB_CONN_STR = os.getenv("DB_CONN_STR", "")
 
 MSSQL_DRIVER = os.getenv("MSSQL_DRIVER", "ODBC Driver 17 for SQL Server")
@@ -19,6 +86,32 @@ MSSQL_DATABASE = os.getenv("MSSQL_DATABASE", "UMSDB")
 MSSQL_USERNAME = os.getenv("MSSQL_USERNAME", "sa")
 MSSQL_PASSWORD = os.getenv("MSSQL_PASSWORD", "SQL")
 MSSQL_TRUSTED = os.getenv("MSSQL_TRUSTED", "true").lower() in ("1", "true", "yes")
+# connections kept open per process and connection string; an idle one older than this is reopened
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+DB_POOL_IDLE_SECONDS = 300
+# buffered status rows (failures from the pipeline threads) are written once this many are waiting
+STATUS_FLUSH_ROWS = 64
+
+# claim scheduler (claim_scheduler.py): which 'collected' rows get embedded first
+# False = oldest collected_at first, no caps (fetch_batch_to_process). On SQL Server run
+# data/mssql_claim_columns.sql once before turning it on
+CLAIM_SCHEDULER = False
+# score = seed * SEED_WEIGHT + log10(1 + views) * VIEWS_WEIGHT + days waiting * AGE_WEIGHT + bucket weight
+CLAIM_SEED_WEIGHT = 3.0
+CLAIM_VIEWS_WEIGHT = 1.0
+CLAIM_AGE_WEIGHT_PER_DAY = 0.5  # keeps low-score rows from waiting forever
+CLAIM_BUCKET_WEIGHTS = {}  # e.g. {"RS/trap": 1.0}, keyed "<country_bucket>/<scene>"
+CLAIM_CANDIDATE_FACTOR = 8  # candidates read per claimed row, so capped buckets can be skipped
+# per-scene daily_admit_cap comes from the collector's config.yaml; scenes not listed there are uncapped
+SCENE_CONFIG_PATH = os.getenv("SCENE_CONFIG_PATH", "../yt-collector/config.yaml")
+# adaptive batch size: aim for this much wall time per claimed batch, from the measured seconds per track
+CLAIM_TARGET_BATCH_SECONDS = 60.0
+CLAIM_MIN_BATCH = 4
+CLAIM_MAX_BATCH = 128
+# a 'processing' row whose claim is older than this goes back to 'collected'
+CLAIM_LEASE_SECONDS = 1800
+CLAIM_LEASE_CHECK_SECONDS = 60
+CLAIM_RACE_RETRIES = 2  # refetches when another worker claimed part of the chosen candidates first
 
 
 def build_default_conn_str() -> str:
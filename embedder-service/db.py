@@ -0,0 +1,56 @@
+﻿import threading
+from typing import Dict
+
+from config import DB_BACKEND, STATUS_FLUSH_ROWS
+
+# Tracks status / claim operations from the configured backend; db_mssql and db_sqlite expose the same functions
+if DB_BACKEND == "sqlite":
+    import db_sqlite as backend
+elif DB_BACKEND == "mssql":
+    import db_mssql as backend
+else:
+    raise ValueError(f"Unknown DB_BACKEND '{DB_BACKEND}', expected 'mssql' or 'sqlite'")
+
+get_conn = backend.get_conn
+fetch_batch_to_process = backend.fetch_batch_to_process
+fetch_claim_candidates = backend.fetch_claim_candidates
+admitted_since = backend.admitted_since
+claim_ids = backend.claim_ids
+requeue_expired = backend.requeue_expired
+mark_processed_many = backend.mark_processed_many
+mark_failed_many = backend.mark_failed_many
+requeue_many = backend.requeue_many
+mark_processed = backend.mark_processed
+mark_failed = backend.mark_failed
+requeue = backend.requeue
+
+
+class StatusBuffer:
+    # failures reported by the fetch/prep threads, written as one statement per flush instead of one each
+    def __init__(self, flush_rows: int = STATUS_FLUSH_ROWS):
+        self.flush_rows = flush_rows
+        self.failed: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def fail(self, id_: str, msg: str) -> None:
+        with self._lock:
+            self.failed[str(id_)] = msg
+            full = len(self.failed) >= self.flush_rows
+        if full:
+            self.flush()
+
+    def flush(self) -> int:
+        with self._lock:
+            pending, self.failed = self.failed, {}
+        if not pending:
+            return 0
+        try:
+            return mark_failed_many(pending.items())
+        except Exception:
+            with self._lock:
+                # put them back under anything newer that arrived meanwhile
+                self.failed = {**pending, **self.failed}
+            raise
+
+
+status_buffer = StatusBuffer()
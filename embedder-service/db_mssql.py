@@ -1,18 +1,141 @@
-﻿import pyodbc
-from typing import List, Dict, Any
+﻿import time
+import queue
+import threading
+import pyodbc
+from contextlib import contextmanager
+from typing import List, Dict, Any, Iterable, Optional, Tuple
 from datetime import datetime, timezone
-from config import build_default_conn_str
+from config import build_default_conn_str, DB_POOL_SIZE, DB_POOL_IDLE_SECONDS
 
 CONN_STR = build_default_conn_str()
+SQL_PARAMS_PER_STATEMENT = 2000  # SQL Server caps a statement at 2100
 
 
-def get_conn():
-    return pyodbc.connect(CONN_STR, autocommit=False)
+class ConnectionPool:
+    # a few long-lived connections shared by the threads of one process instead of a handshake per statement
+    def __init__(self, conn_str: str, size: int = DB_POOL_SIZE, idle_seconds: float = DB_POOL_IDLE_SECONDS):
+        self.conn_str = conn_str
+        self.idle_seconds = idle_seconds
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max(1, size))
+        self.opened = 0
+
+    def _take(self):
+        while True:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                self.opened += 1
+                return pyodbc.connect(self.conn_str, autocommit=False)
+            if time.monotonic() - last_used < self.idle_seconds:
+                return conn
+            # the server or a firewall may have dropped it by now
+            _close_quietly(conn)
+
+    @contextmanager
+    def connection(self):
+        # commit on success, rollback on error; a connection that cannot even roll back is dropped
+        with self._slots:
+            conn = self._take()
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                try:
+                    conn.rollback()
+                except pyodbc.Error:
+                    _close_quietly(conn)
+                    raise
+                self._idle.put((conn, time.monotonic()))
+                raise
+            self._idle.put((conn, time.monotonic()))
+
+    def close(self) -> None:
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            _close_quietly(conn)
+
+
+def _close_quietly(conn) -> None:
+    try:
+        conn.close()
+    except pyodbc.Error:
+        pass
+
+
+_pools: Dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(conn_str: Optional[str] = None) -> ConnectionPool:
+    conn_str = conn_str or CONN_STR
+    with _pools_lock:
+        if conn_str not in _pools:
+            _pools[conn_str] = ConnectionPool(conn_str)
+        return _pools[conn_str]
+
+
+def get_conn(conn_str: Optional[str] = None):
+    # `with get_conn() as conn:` borrows a pooled connection for the block
+    return get_pool(conn_str).connection()
+
+
+def _values_chunks(rows: List[tuple]):
+    # (chunk, "(?, ?), (?, ?) ...") pairs that stay under the parameter cap
+    width = len(rows[0])
+    step = max(1, SQL_PARAMS_PER_STATEMENT // width)
+    row_sql = "(" + ", ".join(["?"] * width) + ")"
+    for i in range(0, len(rows), step):
+        chunk = rows[i:i + step]
+        yield chunk, ", ".join([row_sql] * len(chunk))
+
+
+_claim_columns_ready = False
+
+
+def ensure_claim_columns() -> None:
+    # claimed_at stamps each claim: leases expire from it and daily admits are counted by it. The column is
+    # added by data/mssql_claim_columns.sql; workers only check for it, once
+    global _claim_columns_ready
+    if _claim_columns_ready:
+        return
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT COL_LENGTH('dbo.Tracks', 'claimed_at')")
+        if cur.fetchone()[0] is None:
+            raise RuntimeError("dbo.Tracks has no claimed_at column; run data/mssql_claim_columns.sql "
+                               "before turning on CLAIM_SCHEDULER")
+    _claim_columns_ready = True
+
+
+JOB_OUTPUT = """
+    OUTPUT
+       INSERTED.id,
+       INSERTED.platform,
+       INSERTED.source_url,
+       COALESCE(INSERTED.start_s, 0) AS start_s,
+       COALESCE(INSERTED.dur_s,   0) AS dur_s,
+       INSERTED.duration_sec
+"""
+
+
+def _job_row(r) -> Dict[str, Any]:
+    return {
+        "id": str(r[0]),
+        "platform": r[1],
+        "source_url": r[2],
+        "start_s": int(r[3]),
+        "dur_s": int(r[4]),
+        "duration_sec": (int(r[5]) if r[5] is not None else None),  # <-- NEW
+    }
 
 
 def fetch_batch_to_process(limit: int = 16) -> List[Dict[str, Any]]:
-    rows: List[Dict[str, Any]] = []
-    sql = """
+    # CLAIM_SCHEDULER off: works without claimed_at; requeue_expired starts the lease of these claims
+    sql = f"""
     ;WITH cte AS (
         SELECT TOP (?) id, platform, source_url, start_s, dur_s, duration_sec, status
         FROM dbo.Tracks WITH (UPDLOCK, READPAST, ROWLOCK)
@@ -21,45 +144,168 @@ def fetch_batch_to_process(limit: int = 16) -> List[Dict[str, Any]]:
     )
     UPDATE cte
        SET status = 'processing'
-    OUTPUT
-       INSERTED.id,
-       INSERTED.platform,
-       INSERTED.source_url,
-       COALESCE(INSERTED.start_s, 0) AS start_s,
-       COALESCE(INSERTED.dur_s,   0) AS dur_s,
-       INSERTED.duration_sec;
+    {JOB_OUTPUT};
     """
     with get_conn() as conn:
         cur = conn.cursor()
         cur.execute(sql, (limit,))
-        for r in cur.fetchall():
-            rows.append({
-                "id": str(r[0]),
-                "platform": r[1],
-                "source_url": r[2],
-                "start_s": int(r[3]),
-                "dur_s": int(r[4]),
-                "duration_sec": (int(r[5]) if r[5] is not None else None),  # <-- NEW
-            })
+        rows = [_job_row(r) for r in cur.fetchall()]
         conn.commit()
     return rows
 
 
-def mark_processed(id_: str):
+def fetch_claim_candidates(limit: int, per_bucket: int, seed_weight: float, views_weight: float,
+                           age_weight_per_day: float, bucket_weights: Dict[str, float]) -> List[Dict[str, Any]]:
+    # read-only: the best `per_bucket` rows of every country/scene bucket, best `limit` overall, highest score first
+    weights = [tuple(k.split("/", 1)) + (float(w),) for k, w in bucket_weights.items() if "/" in k]
+    bucket_cte = (f"bw AS (SELECT * FROM (VALUES {', '.join(['(?, ?, ?)'] * len(weights))}) AS v(country_bucket, scene, w)),"
+                  if weights else "bw AS (SELECT CAST(NULL AS nvarchar(64)) AS country_bucket, "
+                                  "CAST(NULL AS nvarchar(64)) AS scene, CAST(0 AS float) AS w WHERE 1 = 0),")
+    sql = f"""
+    ;WITH {bucket_cte}
+    scored AS (
+        SELECT t.id, t.country_bucket, t.scene,
+               ? * CAST(COALESCE(t.seed, 0) AS float)
+             + ? * LOG10(1.0 + CAST(COALESCE(t.view_count, 0) AS float))
+             + ? * DATEDIFF(minute, t.collected_at, SYSUTCDATETIME()) / 1440.0
+             + COALESCE(bw.w, 0) AS score
+        FROM dbo.Tracks AS t
+        LEFT JOIN bw ON bw.country_bucket = t.country_bucket AND bw.scene = t.scene
+        WHERE t.status='collected' AND t.platform='youtube'
+    ),
+    ranked AS (
+        SELECT *, ROW_NUMBER() OVER (PARTITION BY country_bucket, scene ORDER BY score DESC) AS rn FROM scored
+    )
+    SELECT TOP (?) id, country_bucket, scene, score FROM ranked WHERE rn <= ? ORDER BY score DESC;
+    """
+    params = [p for row in weights for p in row] + [seed_weight, views_weight, age_weight_per_day, limit, per_bucket]
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(sql, *params)
+        return [{"id": str(r[0]), "bucket": (r[1], r[2]), "score": float(r[3])} for r in cur.fetchall()]
+
+
+def admitted_since(since: datetime) -> Dict[Tuple[str, str], int]:
+    # rows claimed per country/scene bucket since `since`; a re-claimed row counts once (latest claim)
+    ensure_claim_columns()
     with get_conn() as conn:
         cur = conn.cursor()
         cur.execute(
-            "UPDATE dbo.Tracks SET status='processed', processed_at=? WHERE id=?",
-            datetime.now(timezone.utc), id_
+            "SELECT country_bucket, scene, COUNT(*) FROM dbo.Tracks WHERE claimed_at >= ? GROUP BY country_bucket, scene",
+            since
         )
+        return {(r[0], r[1]): int(r[2]) for r in cur.fetchall()}
+
+
+def claim_ids(ids: Iterable[str]) -> List[Dict[str, Any]]:
+    # claims the chosen rows that are still 'collected'; rows another worker took meanwhile are skipped
+    ensure_claim_columns()
+    rows = [(i,) for i in dict.fromkeys(str(i) for i in ids)]
+    jobs: List[Dict[str, Any]] = []
+    if not rows:
+        return jobs
+    with get_conn() as conn:
+        cur = conn.cursor()
+        for chunk, values in _values_chunks(rows):
+            cur.execute(
+                f"""
+                UPDATE t SET status = 'processing', claimed_at = SYSUTCDATETIME()
+                {JOB_OUTPUT}
+                FROM dbo.Tracks AS t WITH (UPDLOCK, READPAST, ROWLOCK)
+                JOIN (VALUES {values}) AS s(id) ON t.id = s.id
+                WHERE t.status = 'collected';
+                """,
+                *[p for row in chunk for p in row]
+            )
+            jobs += [_job_row(r) for r in cur.fetchall()]
         conn.commit()
+    return jobs
 
 
-def mark_failed(id_: str, msg: str):
+def requeue_expired(lease_seconds: float) -> int:
+    # claims whose worker died or hung. A claim without claimed_at (fetch_batch_to_process, or a worker from
+    # before the column during a rolling deploy) has its lease start now instead of being taken back at once
+    ensure_claim_columns()
     with get_conn() as conn:
         cur = conn.cursor()
+        cur.execute("UPDATE dbo.Tracks SET claimed_at = SYSUTCDATETIME() WHERE status = 'processing' AND claimed_at IS NULL")
         cur.execute(
-            "UPDATE dbo.Tracks SET status='failed', error=? WHERE id=?",
-            msg[:4000], id_
+            """
+            UPDATE dbo.Tracks SET status = 'collected', claimed_at = NULL
+            WHERE status = 'processing' AND claimed_at < DATEADD(second, -?, SYSUTCDATETIME())
+            """,
+            int(lease_seconds)
         )
+        n = cur.rowcount
         conn.commit()
+    return max(0, n)
+
+
+def mark_processed_many(ids: Iterable[str]) -> int:
+    # one set-based UPDATE ... FROM per chunk of ids, one transaction for the batch
+    rows = [(i,) for i in dict.fromkeys(str(i) for i in ids)]
+    if not rows:
+        return 0
+    now = datetime.now(timezone.utc)
+    with get_conn() as conn:
+        cur = conn.cursor()
+        for chunk, values in _values_chunks(rows):
+            cur.execute(
+                f"""
+                UPDATE t SET status='processed', processed_at=?
+                FROM dbo.Tracks AS t JOIN (VALUES {values}) AS s(id) ON t.id = s.id
+                """,
+                now, *[p for row in chunk for p in row]
+            )
+        conn.commit()
+    return len(rows)
+
+
+def mark_failed_many(failures: Iterable[Tuple[str, str]]) -> int:
+    # last message wins for a track that failed twice
+    rows = list({str(i): (str(i), (msg or "")[:4000]) for i, msg in failures}.values())
+    if not rows:
+        return 0
+    with get_conn() as conn:
+        cur = conn.cursor()
+        for chunk, values in _values_chunks(rows):
+            cur.execute(
+                f"""
+                UPDATE t SET status='failed', error=s.error
+                FROM dbo.Tracks AS t JOIN (VALUES {values}) AS s(id, error) ON t.id = s.id
+                """,
+                *[p for row in chunk for p in row]
+            )
+        conn.commit()
+    return len(rows)
+
+
+def requeue_many(ids: Iterable[str]) -> int:
+    # back to 'collected' so the embedder picks them up again and upserts their vectors
+    rows = [(i,) for i in dict.fromkeys(str(i) for i in ids)]
+    if not rows:
+        return 0
+    with get_conn() as conn:
+        cur = conn.cursor()
+        for chunk, values in _values_chunks(rows):
+            cur.execute(
+                f"""
+                UPDATE t SET status='collected', error=NULL, processed_at=NULL
+                FROM dbo.Tracks AS t JOIN (VALUES {values}) AS s(id) ON t.id = s.id
+                """,
+                *[p for row in chunk for p in row]
+            )
+        conn.commit()
+    return len(rows)
+
+
+def mark_processed(id_: str):
+    mark_processed_many([id_])
+
+
+def mark_failed(id_: str, msg: str):
+    mark_failed_many([(id_, msg)])
+
+
+def requeue(id_: str):
+    requeue_many([id_])
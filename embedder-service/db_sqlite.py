@@ -0,0 +1,348 @@
+﻿import os
+import math
+import uuid
+import sqlite3
+import argparse
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, Any, Iterable, Optional, Tuple
+
+from config import SQLITE_PATH
+
+SQL_VARS_PER_STATEMENT = 900  # below SQLITE_MAX_VARIABLE_NUMBER on every build
+
+# the DDL lives in data/schema.sql, which yt-collector/dao_sqlite.py runs too
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "data", "schema.sql")
+
+JOB_COLUMNS = "id, platform, source_url, COALESCE(start_s, 0), COALESCE(dur_s, 0), duration_sec"
+
+_local = threading.local()
+_schema_ready: set = set()
+_schema_lock = threading.Lock()
+
+
+def _ts(dt: datetime) -> str:
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+
+def _now() -> str:
+    return _ts(datetime.now(timezone.utc))
+
+
+def _log10(x):
+    return math.log10(x) if x is not None and x > 0 else None
+
+
+def connect(path: str = SQLITE_PATH) -> sqlite3.Connection:
+    folder = os.path.dirname(os.path.abspath(path))
+    os.makedirs(folder, exist_ok=True)
+    # autocommit mode: transactions are opened explicitly, BEGIN IMMEDIATE for anything that writes
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")  # readers never block the writer and vice versa
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    conn.create_function("log10", 1, _log10, deterministic=True)  # math functions are optional in SQLite builds
+    with _schema_lock:
+        if path not in _schema_ready:
+            with open(SCHEMA_PATH, encoding="utf-8") as f:
+                conn.executescript(f.read())
+            _schema_ready.add(path)
+    return conn
+
+
+def _thread_conn(path: str) -> sqlite3.Connection:
+    # one connection per thread and database file; sqlite3 connections must not cross threads
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+    if path not in conns:
+        conns[path] = connect(path)
+    return conns[path]
+
+
+@contextmanager
+def get_conn(path: Optional[str] = None, write: bool = True):
+    # commit on success, rollback on error; BEGIN IMMEDIATE takes the write lock up front so claims are atomic
+    conn = _thread_conn(path or SQLITE_PATH)
+    conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+    try:
+        yield conn
+    except BaseException:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    if conn.in_transaction:
+        conn.commit()
+
+
+def _chunks(rows: List[tuple]):
+    step = max(1, SQL_VARS_PER_STATEMENT // len(rows[0]))
+    for i in range(0, len(rows), step):
+        yield rows[i:i + step]
+
+
+def _job_row(r) -> Dict[str, Any]:
+    return {
+        "id": str(r[0]),
+        "platform": r[1],
+        "source_url": r[2],
+        "start_s": int(r[3]),
+        "dur_s": int(r[4]),
+        "duration_sec": (int(r[5]) if r[5] is not None else None),
+    }
+
+
+def ensure_claim_columns() -> None:
+    pass  # claimed_at is part of data/schema.sql
+
+
+def fetch_batch_to_process(limit: int = 16) -> List[Dict[str, Any]]:
+    with get_conn() as conn:
+        rows = conn.execute(
+            f"""
+            UPDATE Tracks SET status = 'processing', claimed_at = ?
+            WHERE id IN (
+                SELECT id FROM Tracks WHERE status='collected' AND platform='youtube' ORDER BY collected_at LIMIT ?
+            )
+            RETURNING {JOB_COLUMNS}
+            """,
+            (_now(), int(limit))
+        ).fetchall()
+    return [_job_row(r) for r in rows]
+
+
+def fetch_claim_candidates(limit: int, per_bucket: int, seed_weight: float, views_weight: float,
+                           age_weight_per_day: float, bucket_weights: Dict[str, float]) -> List[Dict[str, Any]]:
+    weights = [tuple(k.split("/", 1)) + (float(w),) for k, w in bucket_weights.items() if "/" in k]
+    bucket_cte = (f"bw(country_bucket, scene, w) AS (VALUES {', '.join(['(?, ?, ?)'] * len(weights))}),"
+                  if weights else "bw(country_bucket, scene, w) AS (SELECT NULL, NULL, 0.0 WHERE 0),")
+    sql = f"""
+    WITH {bucket_cte}
+    scored AS (
+        SELECT t.id, t.country_bucket, t.scene,
+               ? * COALESCE(t.seed, 0)
+             + ? * COALESCE(log10(1.0 + COALESCE(t.view_count, 0)), 0)
+             + ? * (julianday('now') - julianday(t.collected_at))
+             + COALESCE(bw.w, 0) AS score
+        FROM Tracks AS t
+        LEFT JOIN bw ON bw.country_bucket = t.country_bucket AND bw.scene = t.scene
+        WHERE t.status='collected' AND t.platform='youtube'
+    ),
+    ranked AS (
+        SELECT *, ROW_NUMBER() OVER (PARTITION BY country_bucket, scene ORDER BY score DESC) AS rn FROM scored
+    )
+    SELECT id, country_bucket, scene, score FROM ranked WHERE rn <= ? ORDER BY score DESC LIMIT ?
+    """
+    params = [p for row in weights for p in row] + [seed_weight, views_weight, age_weight_per_day, per_bucket, limit]
+    with get_conn(write=False) as conn:
+        rows = conn.execute(sql, params).fetchall()
+    return [{"id": str(r[0]), "bucket": (r[1], r[2]), "score": float(r[3])} for r in rows]
+
+
+def admitted_since(since: datetime) -> Dict[Tuple[str, str], int]:
+    with get_conn(write=False) as conn:
+        rows = conn.execute(
+            "SELECT country_bucket, scene, COUNT(*) FROM Tracks WHERE claimed_at >= ? GROUP BY country_bucket, scene",
+            (_ts(since),)
+        ).fetchall()
+    return {(r[0], r[1]): int(r[2]) for r in rows}
+
+
+def claim_ids(ids: Iterable[str]) -> List[Dict[str, Any]]:
+    rows = [(i,) for i in dict.fromkeys(str(i) for i in ids)]
+    jobs: List[Dict[str, Any]] = []
+    if not rows:
+        return jobs
+    now = _now()
+    with get_conn() as conn:
+        for chunk in _chunks(rows):
+            jobs += [_job_row(r) for r in conn.execute(
+                f"""
+                UPDATE Tracks SET status = 'processing', claimed_at = ?
+                WHERE status = 'collected' AND id IN ({', '.join(['?'] * len(chunk))})
+                RETURNING {JOB_COLUMNS}
+                """,
+                [now, *[row[0] for row in chunk]]
+            ).fetchall()]
+    return jobs
+
+
+def requeue_expired(lease_seconds: float) -> int:
+    # as in db_mssql: a claim without claimed_at has its lease start now
+    cutoff = _ts(datetime.now(timezone.utc) - timedelta(seconds=lease_seconds))
+    with get_conn() as conn:
+        conn.execute("UPDATE Tracks SET claimed_at = ? WHERE status = 'processing' AND claimed_at IS NULL", (_now(),))
+        cur = conn.execute(
+            """
+            UPDATE Tracks SET status = 'collected', claimed_at = NULL
+            WHERE status = 'processing' AND claimed_at < ?
+            """,
+            (cutoff,)
+        )
+        return max(0, cur.rowcount)
+
+
+def mark_processed_many(ids: Iterable[str]) -> int:
+    rows = [(i,) for i in dict.fromkeys(str(i) for i in ids)]
+    if not rows:
+        return 0
+    now = _now()
+    with get_conn() as conn:
+        conn.executemany("UPDATE Tracks SET status='processed', processed_at=? WHERE id=?", [(now, i) for i, in rows])
+    return len(rows)
+
+
+def mark_failed_many(failures: Iterable[Tuple[str, str]]) -> int:
+    rows = list({str(i): ((msg or "")[:4000], str(i)) for i, msg in failures}.values())
+    if not rows:
+        return 0
+    with get_conn() as conn:
+        conn.executemany("UPDATE Tracks SET status='failed', error=? WHERE id=?", rows)
+    return len(rows)
+
+
+def requeue_many(ids: Iterable[str]) -> int:
+    rows = [(i,) for i in dict.fromkeys(str(i) for i in ids)]
+    if not rows:
+        return 0
+    with get_conn() as conn:
+        conn.executemany("UPDATE Tracks SET status='collected', error=NULL, processed_at=NULL WHERE id=?", rows)
+    return len(rows)
+
+
+def mark_processed(id_: str):
+    mark_processed_many([id_])
+
+
+def mark_failed(id_: str, msg: str):
+    mark_failed_many([(id_, msg)])
+
+
+def requeue(id_: str):
+    requeue_many([id_])
+
+
+# ---------- fake catalog ----------
+
+FAKE_SCENES = ("RS/trap", "RS/drill", "HR/rap", "DE/rap", "FR/drill")
+_WORDS = ("noc", "grad", "beton", "ljubav", "novac", "kraj", "blok", "zlato", "sat", "leto", "kiša", "put",
+          "dim", "ulica", "san", "vatra", "plavo", "brzo", "tiho", "sever")
+_SUFFIXES = ("(Official Video)", "(Official Audio)", "(prod. by Coby)", "ft. Devito", "(Visualizer)", "")
+_B64 = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
+
+
+def seed_fake_data(n_tracks: int = 10000, scenes: Iterable[str] = FAKE_SCENES, playlists_per_scene: int = 20,
+                   processed_fraction: float = 0.0, failed_fraction: float = 0.0, url_template: Optional[str] = None,
+                   days: int = 30, rng_seed: int = 0, path: str = SQLITE_PATH) -> Dict[str, int]:
+    # skewed like a real crawl: a few big scenes, log-normal view counts, ~5% seeds, tracks shared across playlists
+    import numpy as np
+
+    rng = np.random.default_rng(rng_seed)
+    buckets = [tuple(s.split("/", 1)) for s in scenes]
+    share = 1.0 / np.arange(1, len(buckets) + 1)
+    bucket_of = rng.choice(len(buckets), size=n_tracks, p=share / share.sum())
+    now = datetime.now(timezone.utc)
+
+    tracks, by_bucket = [], {b: [] for b in range(len(buckets))}
+    statuses = rng.random(n_tracks)
+    for n in range(n_tracks):
+        track_id = str(uuid.UUID(bytes=rng.bytes(16), version=4)).upper()
+        source_id = "".join(_B64[c] for c in rng.integers(0, 64, 11))
+        country, scene = buckets[bucket_of[n]]
+        collected = now - timedelta(seconds=float(rng.uniform(0, days * 86400)))
+        words = rng.choice(len(_WORDS), 3, replace=False)
+        title = f"{_WORDS[words[0]].upper()} - {_WORDS[words[1]]} {_WORDS[words[2]]} " \
+                f"{_SUFFIXES[rng.integers(len(_SUFFIXES))]}".strip()
+        if statuses[n] < processed_fraction:
+            status, processed_at, error = "processed", _ts(collected + timedelta(hours=1)), None
+        elif statuses[n] < processed_fraction + failed_fraction:
+            status, processed_at, error = "failed", None, "RuntimeError: fake failure"
+        else:
+            status, processed_at, error = "collected", None, None
+        tracks.append((
+            track_id, "youtube", source_id,
+            (url_template or "https://www.youtube.com/watch?v={source_id}").format(source_id=source_id, id=track_id),
+            status, title, "UC" + "".join(_B64[c] for c in rng.integers(0, 64, 22)),
+            10 if rng.random() < 0.9 else 24, _ts(collected - timedelta(days=float(rng.uniform(0, 1800)))),
+            int(np.clip(rng.normal(200, 60), 90, 600)), int(rng.lognormal(9.0, 2.2)), 0, None, country, scene,
+            int(rng.random() < 0.05), _ts(collected), _ts(collected) if processed_at else None, processed_at, error,
+        ))
+        by_bucket[bucket_of[n]].append(track_id)
+
+    playlists, links, pairs = [], [], {}
+    for b, (country, scene) in enumerate(buckets):
+        members = by_bucket[b]
+        for _ in range(playlists_per_scene if members else 0):
+            pid = str(uuid.UUID(bytes=rng.bytes(16), version=4)).upper()
+            playlists.append((pid, "youtube", "PL" + "".join(_B64[c] for c in rng.integers(0, 64, 32)),
+                              f"{scene} {country} {rng.integers(2019, 2026)}", "", country, scene, None))
+            size = int(min(len(members), rng.integers(20, 150)))
+            picked = [members[i] for i in rng.choice(len(members), size, replace=False)]
+            links += [(pid, t, pos) for pos, t in enumerate(picked)]
+            for a, c in zip(picked, picked[1:]):
+                key = (a, c) if a < c else (c, a)
+                pairs[key] = pairs.get(key, 0) + 1
+
+    vector_rows = []
+    if processed_fraction > 0:
+        from faiss_index import track_faiss_id
+
+        vector_rows = [(track_faiss_id(t[0]), t[0]) for t in tracks if t[4] == "processed"]
+
+    with get_conn(path) as conn:
+        conn.executemany(
+            """
+            INSERT OR IGNORE INTO Tracks
+              (id, platform, source_id, source_url, status, title, channel_id, category_id, upload_date,
+               duration_sec, view_count, is_live, etag, country_bucket, scene, seed, collected_at, claimed_at,
+               processed_at, error)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, tracks)
+        conn.executemany(
+            """
+            INSERT OR IGNORE INTO Playlists (id, platform, source_playlist_id, title, description, country, scene, etag)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, playlists)
+        conn.executemany("INSERT OR IGNORE INTO TrackPlaylists (playlist_id, track_id, position) VALUES (?, ?, ?)",
+                         links)
+        conn.executemany(
+            """
+            INSERT INTO CoOccurrence (track_id_a, track_id_b, count) VALUES (?, ?, ?)
+            ON CONFLICT (track_id_a, track_id_b) DO UPDATE SET count = count + excluded.count
+            """, [(a, c, n) for (a, c), n in pairs.items()])
+        conn.executemany("INSERT OR REPLACE INTO VectorMap (faiss_id, track_id) VALUES (?, ?)", vector_rows)
+    return {"tracks": len(tracks), "playlists": len(playlists), "track_playlists": len(links),
+            "cooccurrence": len(pairs), "vector_map": len(vector_rows)}
+
+
+def table_counts(path: str = SQLITE_PATH) -> Dict[str, Any]:
+    with get_conn(path, write=False) as conn:
+        out = {t: conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0]
+               for t in ("Tracks", "Playlists", "TrackPlaylists", "CoOccurrence", "VectorMap")}
+        out["status"] = dict(conn.execute("SELECT status, COUNT(*) FROM Tracks GROUP BY status").fetchall())
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("action", choices=("init", "seed", "status"))
+    parser.add_argument("--db", default=SQLITE_PATH)
+    parser.add_argument("--tracks", type=int, default=10000)
+    parser.add_argument("--scenes", default=",".join(FAKE_SCENES), help="comma-separated country/scene buckets")
+    parser.add_argument("--playlists-per-scene", type=int, default=20)
+    parser.add_argument("--processed", type=float, default=0.0, help="fraction seeded as already processed")
+    parser.add_argument("--failed", type=float, default=0.0, help="fraction seeded as failed")
+    parser.add_argument("--url-template", default=None,
+                        help='source_url format, e.g. "http://127.0.0.1:8000/{source_id}.wav"')
+    parser.add_argument("--days", type=int, default=30, help="collected_at spread")
+    parser.add_argument("--rng-seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.action == "seed":
+        print(seed_fake_data(args.tracks, [s.strip() for s in args.scenes.split(",") if s.strip()],
+                             args.playlists_per_scene, args.processed, args.failed, args.url_template, args.days,
+                             args.rng_seed, args.db))
+    else:
+        connect(args.db).close()
+    print(table_counts(args.db))
@@ -0,0 +1,67 @@
+﻿import json
+import time
+import argparse
+
+import numpy as np
+
+from config import AUDIO_PATH, TARGET_SAMPLING_RATE
+from audio_preparation import embed_waveforms
+from model_registry import ModelRegistry
+from precision_check import _reference_files, _normalize
+from preprocess import load_and_prep_files
+
+
+def _neighbours(vecs: np.ndarray, k: int) -> np.ndarray:
+    sims = vecs @ vecs.T
+    np.fill_diagonal(sims, -np.inf)
+    return np.argsort(-sims, axis=1)[:, :k]
+
+
+def run_benchmark(folder: str, depths, limit: int = 50, k: int = 10, layers: str = None) -> list:
+    files = _reference_files(folder, limit)
+    if len(files) < 2:
+        raise SystemExit(f"Need at least 2 reference tracks in {folder}")
+    waveforms = load_and_prep_files(files)
+    audio_s = sum(w.size(1) for w in waveforms) / TARGET_SAMPLING_RATE
+    k = min(k, len(files) - 1)
+
+    results = []
+    reference_nn = None
+    # full depth first: it is the baseline the truncated variants are compared against
+    for depth in [0] + [d for d in depths if d]:
+        registry = ModelRegistry(num_layers=depth or None, layers=layers if depth else None)
+        if depth and not layers:
+            registry.layer_weights = {depth: 1.0}
+        registry.get()
+
+        start = time.time()
+        vecs = _normalize(embed_waveforms(waveforms, registry=registry))
+        seconds = time.time() - start
+
+        nn = _neighbours(vecs, k)
+        if reference_nn is None:
+            reference_nn = nn
+        overlap = [len(set(a) & set(b)) / k for a, b in zip(nn.tolist(), reference_nn.tolist())]
+        results.append({
+            "depth": depth or "full",
+            "embedding_id": registry.embedding_id,
+            "seconds": round(seconds, 3),
+            "tracks_per_s": round(len(files) / seconds, 3),
+            "audio_x_realtime": round(audio_s / seconds, 2),
+            "topk": k,
+            "topk_overlap_vs_full": float(np.mean(overlap)),
+        })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--depths", default="4,6,8,10", help="comma-separated layer counts to compare with full depth")
+    parser.add_argument("--layers", default=None, help='pooled layers for the truncated runs (default: the last kept layer)')
+    parser.add_argument("--reference", default=AUDIO_PATH, help="folder with reference audio files")
+    parser.add_argument("--limit", type=int, default=50, help="max reference tracks (0 = all)")
+    parser.add_argument("--k", type=int, default=10, help="neighbours compared within the reference set")
+    args = parser.parse_args()
+
+    depths = [int(d) for d in args.depths.split(",") if d.strip()]
+    print(json.dumps(run_benchmark(args.reference, depths, limit=args.limit, k=args.k, layers=args.layers), indent=2))
@@ -0,0 +1,121 @@
+﻿import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+import torch
+import torchaudio
+
+from audio_preparation import prep_waveform, windowed_embedding
+from config import TARGET_SAMPLING_RATE
+from logger import logger
+from model_registry import get_registry
+
+# line-delimited JSON headers on stdin/stdout, raw little-endian payloads after them:
+#   -> {"op": "file", "path": ..., "denoise": false}
+#   -> {"op": "pcm", "sr": 24000, "format": "f32le" | "s16le", "channels": 1, "nbytes": N} + N bytes
+#   <- {"ok": true, "dim": D, "timings": {...}} + D float32, or {"ok": false, "error": ...}
+PCM_FORMATS = {"f32le": ("<f4", 1.0), "s16le": ("<i2", 32768.0)}
+
+
+def _read_exact(stream, n: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = stream.read(n - len(buf))
+        if not chunk:
+            raise EOFError("stdin closed mid-payload")
+        buf += chunk
+    return bytes(buf)
+
+
+def _pcm_to_tensor(payload: bytes, fmt: str, channels: int) -> torch.Tensor:
+    if fmt not in PCM_FORMATS:
+        raise ValueError(f"Unknown PCM format '{fmt}', expected one of {tuple(PCM_FORMATS)}")
+    dtype, scale = PCM_FORMATS[fmt]
+    samples = np.frombuffer(payload, dtype=dtype).astype("float32") / scale
+    channels = max(1, int(channels))
+    samples = samples[: len(samples) - len(samples) % channels].reshape(-1, channels).T
+    return torch.from_numpy(np.ascontiguousarray(samples))
+
+
+def embed_request(req: dict, payload: bytes, registry) -> tuple:
+    # same steps as load_and_prep + windowed_embedding, timed per stage
+    timings = {}
+    t = time.perf_counter()
+    if req.get("op") == "file":
+        waveform, sr = torchaudio.load(req["path"])
+    elif req.get("op") == "pcm":
+        waveform, sr = _pcm_to_tensor(payload, req.get("format", "f32le"), req.get("channels", 1)), int(req["sr"])
+    else:
+        raise ValueError(f"Unknown op {req.get('op')!r}")
+    timings["decode_s"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    waveform = prep_waveform(waveform, sr, do_denoise=bool(req.get("denoise", False)))
+    timings["prep_s"] = time.perf_counter() - t
+    if waveform.numel() == 0:
+        raise ValueError("No audio left after silence trimming")
+
+    t = time.perf_counter()
+    vec = windowed_embedding(waveform, registry=registry)
+    timings["embed_s"] = time.perf_counter() - t
+    timings["audio_s"] = waveform.shape[-1] / TARGET_SAMPLING_RATE
+    return np.asarray(vec, dtype="<f4").reshape(-1), timings
+
+
+def claim_stdout():
+    # the protocol owns the real stdout; anything printed later (model load warnings etc.) goes to stderr
+    out = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    return out
+
+
+def serve_stdio(registry, out=None) -> None:
+    out = out or claim_stdout()
+    inp = sys.stdin.buffer
+
+    out.write((json.dumps({"ready": True, "embedding_id": registry.embedding_id,
+                           "load_s": registry.load_seconds}) + "\n").encode("utf-8"))
+    out.flush()
+    while True:
+        line = inp.readline()
+        if not line:
+            return
+        try:
+            req = json.loads(line)
+            payload = _read_exact(inp, int(req.get("nbytes", 0))) if req.get("nbytes") else b""
+            t = time.perf_counter()
+            vec, timings = embed_request(req, payload, registry)
+            timings["worker_s"] = time.perf_counter() - t
+            out.write((json.dumps({"ok": True, "dim": int(vec.shape[0]), "timings": timings}) + "\n").encode("utf-8"))
+            out.write(vec.tobytes())
+        except EOFError:
+            return
+        except Exception as e:
+            logger.exception(f"Audio query failed: {e}")
+            out.write((json.dumps({"ok": False, "error": f"{type(e).__name__}: {e}"}) + "\n").encode("utf-8"))
+        out.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default=None)
+    parser.add_argument("--dtype", default=None)
+    parser.add_argument("--precision", default=None)
+    parser.add_argument("--num-layers", type=int, default=None)
+    parser.add_argument("--layers", default=None)
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    args = parser.parse_args()
+
+    out = claim_stdout()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    registry = get_registry()
+    registry.configure(device=args.device, dtype=args.dtype, precision=args.precision,
+                       num_layers=args.num_layers, layers=args.layers)
+    registry.warm_up()
+    logger.info(f"Embed worker ready ({registry.embedding_id}, load {registry.load_seconds:.3f}s)")
+    serve_stdio(registry, out)
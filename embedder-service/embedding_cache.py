@@ -0,0 +1,218 @@
+﻿import os
+import hashlib
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from config import EMBED_CACHE_DIR, EMBED_CACHE_SHARD_ROWS, EMBEDDING_DIM, MERT_MODEL_ID, EMBED_PREP_VERSION
+from logger import logger
+
+# one fixed-size record per cached vector in keys.bin
+_KEY_DTYPE = np.dtype([
+    ("key", "V16"),
+    ("ns", "<u8"),
+    ("track", "S36"),
+    ("start_s", "<i4"),
+    ("dur_s", "<i4"),
+    ("shard", "<u4"),
+    ("row", "<u4"),
+])
+
+CacheKey = Tuple[str, int, int]
+
+
+def _digest(data: str, size: int) -> bytes:
+    return hashlib.blake2b(data.encode("utf-8"), digest_size=size).digest()
+
+
+def _write_at(path: str, offset: int, data: bytes) -> None:
+    # append at a record boundary: a partial record left by a crash is overwritten instead of shifting what follows
+    with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+        f.seek(offset)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class EmbeddingCache:
+    # append-only float32 shards (shard_NNNNN.f32) plus keys.bin; a vector is written before its key,
+    # so a crash between the two only leaves an unreferenced row behind
+    def __init__(self, root: str = EMBED_CACHE_DIR, dim: int = EMBEDDING_DIM,
+                 model_id: str = MERT_MODEL_ID, prep_version: int = EMBED_PREP_VERSION,
+                 shard_rows: int = EMBED_CACHE_SHARD_ROWS):
+        self.root = root
+        self.dim = int(dim)
+        self.model_id = model_id
+        self.prep_version = int(prep_version)
+        self.shard_rows = int(shard_rows)
+        self.ns = int.from_bytes(_digest(f"{model_id}|{self.prep_version}", 8), "little")
+        self._row_bytes = self.dim * 4
+        self._keys_path = os.path.join(root, "keys.bin")
+        self._index: Dict[bytes, Tuple[int, int]] = {}
+        self._maps: Dict[int, np.memmap] = {}
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._load_keys()
+
+    def _shard_path(self, shard: int) -> str:
+        return os.path.join(self.root, f"shard_{shard:05d}.f32")
+
+    def _shard_len(self, shard: int) -> int:
+        path = self._shard_path(shard)
+        return os.path.getsize(path) // self._row_bytes if os.path.exists(path) else 0
+
+    def _read_keys(self) -> np.ndarray:
+        if not os.path.exists(self._keys_path):
+            return np.zeros(0, dtype=_KEY_DTYPE)
+        n = os.path.getsize(self._keys_path) // _KEY_DTYPE.itemsize
+        recs = np.fromfile(self._keys_path, dtype=_KEY_DTYPE, count=n)
+        if not len(recs):
+            return recs
+        # drop keys whose vector row never reached disk
+        shard_ids = np.unique(recs["shard"])
+        shard_lens = np.array([self._shard_len(int(sh)) for sh in shard_ids])
+        limit = shard_lens[np.searchsorted(shard_ids, recs["shard"])]
+        return recs[recs["row"] < limit]
+
+    def _load_keys(self) -> None:
+        recs = self._read_keys()
+        self._index = dict(zip(recs["key"].tolist(), zip(recs["shard"].tolist(), recs["row"].tolist())))
+        self._tail_shard = int(recs["shard"].max()) if len(recs) else 0
+        while self._shard_len(self._tail_shard + 1) > 0:
+            self._tail_shard += 1
+        logger.info(f"Embedding cache: {len(self._index)} entries in {self.root}")
+
+    def key_digest(self, track_id: str, start_s: int, dur_s: int) -> bytes:
+        return _digest(f"{track_id}|{int(start_s)}|{int(dur_s)}|{self.model_id}|{self.prep_version}", 16)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, key: CacheKey) -> bool:
+        return self.key_digest(*key) in self._index
+
+    def _mapped(self, shard: int, row: int) -> np.memmap:
+        mm = self._maps.get(shard)
+        if mm is None or row >= mm.shape[0]:
+            rows = self._shard_len(shard)
+            mm = np.memmap(self._shard_path(shard), dtype="float32", mode="r", shape=(rows, self.dim))
+            self._maps[shard] = mm
+        return mm
+
+    def get(self, track_id: str, start_s: int, dur_s: int) -> Optional[np.ndarray]:
+        loc = self._index.get(self.key_digest(track_id, start_s, dur_s))
+        if loc is None:
+            return None
+        shard, row = loc
+        with self._lock:
+            return np.array(self._mapped(shard, row)[row])
+
+    def lookup_many(self, keys: Iterable[CacheKey]) -> Tuple[np.ndarray, np.ndarray]:
+        keys = list(keys)
+        found = np.zeros(len(keys), dtype=bool)
+        out = np.zeros((len(keys), self.dim), dtype="float32")
+        by_shard: Dict[int, List[Tuple[int, int]]] = {}
+        for i, key in enumerate(keys):
+            loc = self._index.get(self.key_digest(*key))
+            if loc is not None:
+                by_shard.setdefault(loc[0], []).append((i, loc[1]))
+        with self._lock:
+            for shard, hits in by_shard.items():
+                pos = np.array([h[0] for h in hits])
+                rows = np.array([h[1] for h in hits])
+                mm = self._mapped(shard, int(rows.max()))
+                out[pos] = mm[rows]
+                found[pos] = True
+        return found, out
+
+    def put(self, track_id: str, start_s: int, dur_s: int, vec: np.ndarray) -> None:
+        self.put_many([(track_id, start_s, dur_s)], np.asarray(vec, dtype="float32")[None, :])
+
+    def put_many(self, keys: List[CacheKey], vecs: np.ndarray) -> None:
+        vecs = np.ascontiguousarray(vecs, dtype="float32").reshape(-1, self.dim)
+        with self._lock:
+            pending, seen = [], set()
+            for k, v in zip(keys, vecs):
+                digest = self.key_digest(*k)
+                if digest not in self._index and digest not in seen:
+                    seen.add(digest)
+                    pending.append((k, v))
+            if not pending:
+                return
+            recs = np.zeros(len(pending), dtype=_KEY_DTYPE)
+            i = 0
+            while i < len(pending):
+                shard = self._tail_shard
+                row0 = self._shard_len(shard)
+                if row0 >= self.shard_rows:
+                    self._tail_shard += 1
+                    continue
+                take = pending[i:i + (self.shard_rows - row0)]
+                _write_at(self._shard_path(shard), row0 * self._row_bytes, np.stack([v for _, v in take]).tobytes())
+                for j, ((track_id, start_s, dur_s), _) in enumerate(take):
+                    r = recs[i + j]
+                    r["key"] = self.key_digest(track_id, start_s, dur_s)
+                    r["ns"] = self.ns
+                    r["track"] = str(track_id).encode("ascii")
+                    r["start_s"] = int(start_s)
+                    r["dur_s"] = int(dur_s)
+                    r["shard"] = shard
+                    r["row"] = row0 + j
+                i += len(take)
+
+            n_keys = os.path.getsize(self._keys_path) // _KEY_DTYPE.itemsize if os.path.exists(self._keys_path) else 0
+            _write_at(self._keys_path, n_keys * _KEY_DTYPE.itemsize, recs.tobytes())
+            for r in recs:
+                self._index[bytes(r["key"])] = (int(r["shard"]), int(r["row"]))
+
+    def export(self) -> Tuple[List[str], np.ndarray, np.ndarray, np.ndarray]:
+        # (track_ids, start_s, dur_s, vectors) for this model/prep version, read shard by shard
+        recs = self._read_keys()
+        recs = recs[recs["ns"] == self.ns]
+        # a key written twice (e.g. after a crash) only counts at the row the index points to
+        live = [self._index.get(k) == loc
+                for k, loc in zip(recs["key"].tolist(), zip(recs["shard"].tolist(), recs["row"].tolist()))]
+        recs = recs[np.asarray(live, dtype=bool)]
+        order = np.lexsort((recs["row"], recs["shard"]))
+        recs = recs[order]
+
+        vecs = np.zeros((len(recs), self.dim), dtype="float32")
+        with self._lock:
+            for shard in np.unique(recs["shard"]):
+                sel = np.nonzero(recs["shard"] == shard)[0]
+                rows = recs["row"][sel].astype(np.int64)
+                vecs[sel] = self._mapped(int(shard), int(rows.max()))[rows]
+        track_ids = [t.decode("ascii") for t in recs["track"]]
+        return track_ids, recs["start_s"].copy(), recs["dur_s"].copy(), vecs
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("action", nargs="?", choices=("status", "export"), default="status")
+    parser.add_argument("out", nargs="?", help="export: /path/to/out.npz")
+    # the cache is keyed by the registry's embedding_id: pass the same model options main.py ran with
+    parser.add_argument("--precision", default=None, help="float32, bfloat16 or int8 (default: MODEL_PRECISION)")
+    parser.add_argument("--num-layers", type=int, default=None, help="(default: MODEL_NUM_LAYERS)")
+    parser.add_argument("--layers", default=None, help='e.g. "last", "6" or "4:0.5,6:0.5" (default: EMBED_LAYERS)')
+    parser.add_argument("--model-id", default=None, help="raw embedding_id, overrides the options above")
+    args = parser.parse_args()
+
+    model_id = args.model_id
+    if model_id is None:
+        from model_registry import get_registry
+
+        registry = get_registry()
+        registry.configure(precision=args.precision, num_layers=args.num_layers, layers=args.layers)
+        model_id = registry.embedding_id
+    cache = EmbeddingCache(model_id=model_id)
+    if args.action == "export":
+        if not args.out:
+            parser.error("export needs an output path")
+        ids, starts, durs, vectors = cache.export()
+        np.savez(args.out, track_id=np.array(ids), start_s=starts, dur_s=durs, vectors=vectors)
+        print(f"Exported {len(ids)} vectors -> {args.out}")
+    else:
+        print(f"Embedding cache {cache.root}: {len(cache)} entries (model={cache.model_id}, prep=v{cache.prep_version})")
@@ -1,37 +1,300 @@
 ﻿import os
+import json
+import uuid
+import hashlib
+from datetime import datetime, timezone
 from pathlib import Path
+from typing import Any, Dict, Iterable, Optional, Tuple
 import faiss
 import numpy as np
-from config import FAISS_INDEX_PATH, EMBEDDING_DIM
+from config import (
+    FAISS_INDEX_PATH, EMBEDDING_DIM, FAISS_INDEX_TYPE,
+    FAISS_IVF_NLIST, FAISS_PQ_M, FAISS_PQ_BITS, FAISS_HNSW_M, FAISS_HNSW_EF_CONSTRUCTION,
+    FAISS_NPROBE, FAISS_EF_SEARCH, FAISS_REFINE_K_FACTOR
+)
 from logger import logger
 
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw", "fp16", "sq8", "pq_refine")
+# types whose reconstructed vectors are noticeably off the originals (pq_refine reconstructs from its flat copy)
+LOSSY_INDEX_TYPES = ("ivf_pq", "sq8")
 
-def _resolved_index_path() -> str:
-    p = Path(FAISS_INDEX_PATH).resolve()
+
+def _resolved_index_path(path: Optional[str] = None) -> str:
+    p = Path(path or FAISS_INDEX_PATH).resolve()
     p.parent.mkdir(parents=True, exist_ok=True)
     return str(p)
 
 
-def load_index():
-    path = _resolved_index_path()
+def _meta_path(path: str) -> str:
+    return path + ".meta.json"
+
+
+def needs_training(kind: str) -> bool:
+    return kind in ("ivf_flat", "ivf_pq", "sq8", "pq_refine")
+
+
+def index_factory_string(kind: str, nlist: int = FAISS_IVF_NLIST, pq_m: int = FAISS_PQ_M,
+                         pq_bits: int = FAISS_PQ_BITS, hnsw_m: int = FAISS_HNSW_M) -> str:
+    if kind == "flat":
+        return "Flat"
+    if kind == "ivf_flat":
+        return f"IVF{nlist},Flat"
+    if kind == "ivf_pq":
+        return f"IVF{nlist},PQ{pq_m}x{pq_bits}"
+    if kind == "hnsw":
+        return f"HNSW{hnsw_m}"
+    if kind == "fp16":
+        return "SQfp16"
+    if kind == "sq8":
+        return "SQ8"
+    if kind == "pq_refine":
+        # PQ codes are scanned, the top k * k_factor are re-scored against the float32 copy
+        return f"PQ{pq_m}x{pq_bits},RFlat"
+    raise ValueError(f"Unknown index type '{kind}', expected one of {INDEX_TYPES}")
+
+
+def create_index(kind: str = FAISS_INDEX_TYPE, dim: int = EMBEDDING_DIM,
+                 ef_construction: int = FAISS_HNSW_EF_CONSTRUCTION, **params):
+    idx = faiss.index_factory(dim, index_factory_string(kind, **params), faiss.METRIC_INNER_PRODUCT)
+    if kind == "hnsw":
+        faiss.downcast_index(idx).hnsw.efConstruction = ef_construction
+    return idx
+
+
+def track_faiss_id(track_id: str) -> int:
+    # stable positive int64 for a track; hashed because sequential GUIDs share most of their bytes
+    try:
+        key = str(uuid.UUID(str(track_id)))
+    except ValueError:
+        key = str(track_id)
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big") & 0x7FFFFFFFFFFFFFFF
+
+
+def _base_index(index):
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.downcast_index(index.index)
+    return faiss.downcast_index(index)
+
+
+def has_stable_ids(index) -> bool:
+    if isinstance(index, faiss.IndexIDMap):
+        return True
+    base = faiss.downcast_index(index)
+    return isinstance(base, faiss.IndexIVF) and base.direct_map.type == faiss.DirectMap.Hashtable
+
+
+def with_stable_ids(index):
+    # IVF keeps arbitrary ids natively (hashtable direct map for reconstruct); everything else gets an IDMap2
+    base = faiss.downcast_index(index)
+    if isinstance(base, faiss.IndexIVF):
+        base.set_direct_map_type(faiss.DirectMap.Hashtable)
+        return index  # not base: the downcast proxy does not own the index
+    return faiss.IndexIDMap2(index)
+
+
+def supports_remove(index) -> bool:
+    # an HNSW graph cannot drop nodes; every other layout removes by id
+    return not isinstance(faiss.downcast_index(_base_index(index)), faiss.IndexHNSW)
+
+
+def contains_id(index, faiss_id: int) -> bool:
+    try:
+        index.reconstruct(int(faiss_id))
+        return True
+    except RuntimeError:
+        return False
+
+
+def index_ids(index) -> np.ndarray:
+    # every id stored in the index, without reconstructing vectors
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.vector_to_array(index.id_map).astype("int64")
+    base = faiss.downcast_index(index)
+    if isinstance(base, faiss.IndexIVF) and has_stable_ids(base):
+        invlists = base.invlists
+        ids = [
+            faiss.rev_swig_ptr(invlists.get_ids(lst), invlists.list_size(lst)).copy()
+            for lst in range(base.nlist) if invlists.list_size(lst)
+        ]
+        return np.sort(np.concatenate(ids)).astype("int64") if ids else np.zeros(0, "int64")
+    return np.arange(index.ntotal, dtype="int64")
+
+
+def export_vectors(index) -> Tuple[np.ndarray, np.ndarray]:
+    # (ids, vectors) for every entry, whatever the index layout
+    if isinstance(index, faiss.IndexIDMap):
+        return index_ids(index), _base_index(index).reconstruct_n(0, index.ntotal)
+    base = faiss.downcast_index(index)
+    if isinstance(base, faiss.IndexIVF) and has_stable_ids(base):
+        ids = index_ids(base)
+        if not len(ids):
+            return ids, np.zeros((0, base.d), "float32")
+        return ids, base.reconstruct_batch(ids)
+    if isinstance(base, faiss.IndexIVF):
+        base.make_direct_map()
+    return np.arange(index.ntotal, dtype="int64"), index.reconstruct_n(0, index.ntotal)
+
+
+def describe_index(index) -> str:
+    base = _base_index(index)
+    if isinstance(base, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(base, faiss.IndexIVF):
+        return "ivf_flat"
+    if isinstance(base, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(base, faiss.IndexRefine):
+        return "pq_refine"
+    if isinstance(base, faiss.IndexScalarQuantizer):
+        return "fp16" if base.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "sq8"
+    return "flat"
+
+
+def apply_search_params(index, nprobe: Optional[int] = FAISS_NPROBE, ef_search: Optional[int] = FAISS_EF_SEARCH,
+                        k_factor: Optional[int] = FAISS_REFINE_K_FACTOR):
+    ps = faiss.ParameterSpace()
+    kind = describe_index(index)
+    if kind in ("ivf_flat", "ivf_pq") and nprobe:
+        ps.set_index_parameter(index, "nprobe", int(nprobe))
+        # reconstruct() on IVF needs the id -> list map
+        ivf = faiss.extract_index_ivf(index)
+        if ivf.direct_map.type == faiss.DirectMap.NoMap:
+            ivf.make_direct_map()
+    elif kind == "hnsw" and ef_search:
+        ps.set_index_parameter(index, "efSearch", int(ef_search))
+    elif kind == "pq_refine" and k_factor:
+        _base_index(index).k_factor = float(k_factor)  # not exposed through ParameterSpace
+
+
+def read_index_meta(path: Optional[str] = None) -> Dict[str, Any]:
+    meta_path = _meta_path(path or _resolved_index_path())
+    if not os.path.exists(meta_path):
+        return {}
+    with open(meta_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_index_meta(index, path: Optional[str] = None, **extra) -> Dict[str, Any]:
+    path = path or _resolved_index_path()
+    meta = read_index_meta(path)
+    meta.update(extra)
+    meta.update({
+        "type": describe_index(index),
+        "dim": index.d,
+        "ntotal": index.ntotal,
+        "saved_at": datetime.now(timezone.utc).isoformat(),
+    })
+    tmp_path = _meta_path(path) + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_path, _meta_path(path))
+    return meta
+
+
+def load_index(path: Optional[str] = None):
+    path = _resolved_index_path(path)
     if os.path.exists(path):
         idx = faiss.read_index(path)
-        logger.info(f"Loaded FAISS index: {path} (ntotal={idx.ntotal})")
+        apply_search_params(idx)
+        logger.info(f"Loaded FAISS index: {path} (type={describe_index(idx)}, ntotal={idx.ntotal})")
         return idx
-    idx = faiss.IndexFlatIP(EMBEDDING_DIM)
-    logger.info(f"Created new FAISS index in memory (dim={EMBEDDING_DIM}); will save to {path}")
+    kind = FAISS_INDEX_TYPE
+    if needs_training(kind):
+        logger.warning(f"FAISS_INDEX_TYPE={kind} needs training; starting flat, migrate with index_migrate.py")
+        kind = "flat"
+    idx = with_stable_ids(create_index(kind))
+    apply_search_params(idx)
+    logger.info(f"Created new FAISS index in memory (type={kind}, dim={EMBEDDING_DIM}); will save to {path}")
     return idx
 
 
+def normalize_rows(vecs: np.ndarray) -> np.ndarray:
+    vecs = np.asarray(vecs, dtype="float32")
+    norms = np.linalg.norm(vecs, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vecs / norms).astype("float32")
+
+
+def _remove_refine_ids(index, ids: np.ndarray) -> int:
+    # IndexRefine has no remove_ids; drop the same positions from both halves and compact the id map
+    id_map = faiss.vector_to_array(index.id_map)
+    drop = np.isin(id_map, ids)
+    if not drop.any():
+        return 0
+    refine = _base_index(index)
+    positions = faiss.IDSelectorBatch(np.flatnonzero(drop).astype("int64"))
+    refine.base_index.remove_ids(positions)
+    refine.refine_index.remove_ids(positions)
+    refine.ntotal = refine.base_index.ntotal
+    faiss.copy_array_to_vector(id_map[~drop], index.id_map)
+    index.ntotal = refine.ntotal
+    index.construct_rev_map()
+    return int(drop.sum())
+
+
+def remove_ids(index, ids: np.ndarray) -> int:
+    ids = np.ascontiguousarray(ids, dtype="int64")
+    if isinstance(index, faiss.IndexIDMap2) and isinstance(_base_index(index), faiss.IndexRefine):
+        return _remove_refine_ids(index, ids)
+    return int(index.remove_ids(ids))
+
+
+def upsert_to_index(index, faiss_id: int, embedding: np.ndarray):
+    vec = normalize_rows(embedding)[None, :]
+    ids = np.array([faiss_id], dtype="int64")
+    if contains_id(index, faiss_id):
+        # replace in place: re-embedding a track keeps its id
+        remove_ids(index, ids)
+    index.add_with_ids(vec, ids)
+    logger.info(f"Index upsert OK (id={faiss_id}, ntotal={index.ntotal})")
+    return vec[0]
+
+
+def upsert_batch_to_index(index, faiss_ids: np.ndarray, embeddings: np.ndarray) -> np.ndarray:
+    # one remove_ids + one add_with_ids for the whole batch; ids must be unique within it
+    vecs = normalize_rows(np.atleast_2d(embeddings))
+    ids = np.ascontiguousarray(faiss_ids, dtype="int64")
+    if not len(ids):
+        return vecs
+    if supports_remove(index):
+        remove_ids(index, ids)  # no-op for ids that are not present yet
+    elif any(contains_id(index, int(i)) for i in ids):
+        raise RuntimeError("HNSW index cannot replace existing ids; rebuild with index_migrate")
+    index.add_with_ids(vecs, ids)
+    logger.info(f"Index upsert OK (n={len(ids)}, ntotal={index.ntotal})")
+    return vecs
+
+
+def add_batch_to_index(index, embeddings: np.ndarray) -> np.ndarray:
+    # positional ids: the batch gets ntotal .. ntotal + n - 1
+    vecs = normalize_rows(np.atleast_2d(embeddings))
+    if len(vecs):
+        index.add(vecs)
+        logger.info(f"Index add OK (n={len(vecs)}, ntotal={index.ntotal})")
+    return vecs
+
+
+def remove_from_index(index, faiss_ids: Iterable[int]) -> int:
+    ids = np.asarray(list(faiss_ids), dtype="int64")
+    n = remove_ids(index, ids) if len(ids) else 0
+    logger.info(f"Index remove OK (removed={n}, ntotal={index.ntotal})")
+    return n
+
+
 def add_to_index(index, embedding: np.ndarray):
     # normalize
     norm = float(np.linalg.norm(embedding)) or 1.0
     vec = (embedding / norm).astype("float32")[None, :]
     index.add(vec)
     logger.info(f"Index add OK (ntotal={index.ntotal})")
+    return vec[0]
 
 
-def save_index(index):
-    path = _resolved_index_path()
-    faiss.write_index(index, path)
+def save_index(index, path: Optional[str] = None):
+    path = _resolved_index_path(path)
+    # write-then-rename so a crash never leaves a half-written music.index
+    tmp_path = path + ".tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, path)
+    write_index_meta(index, path)
     logger.info(f"Saved FAISS index -> {path} (ntotal={index.ntotal})")
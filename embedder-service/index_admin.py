@@ -0,0 +1,56 @@
+﻿import argparse
+
+from config import MAPPING_PATH, FAISS_SHARDED
+from mapping_store import CSVMappingStore, CompositeMappingStore, sql_mapping_store
+from faiss_index import has_stable_ids, track_faiss_id
+from logger import logger
+from vector_journal import JournaledIndex
+
+# run while the embedder is stopped: the index has a single owner
+
+
+def _stable_store():
+    if FAISS_SHARDED:
+        from index_shards import ShardedIndexStore
+
+        store = ShardedIndexStore()
+    else:
+        store = JournaledIndex()
+    if not has_stable_ids(store.index):
+        raise SystemExit("Index uses positional ids; migrate with index_migrate.py --stable-ids first")
+    return store
+
+
+def remove_tracks(track_ids) -> int:
+    store = _stable_store()
+    ids = [track_faiss_id(t) for t in track_ids]
+    n = store.remove(ids)
+    mapper = CompositeMappingStore([CSVMappingStore(MAPPING_PATH), sql_mapping_store()])
+    mapper.initialize()
+    for fid in ids:
+        mapper.remove(fid)
+    store.maybe_checkpoint(force=True)
+    return n
+
+
+def requeue_tracks(track_ids) -> None:
+    from db import requeue_many
+
+    # on a positional index a re-embed appends a second vector and its mapping row hits UNIQUE(track_id)
+    _stable_store()
+    requeue_many(track_ids)
+    for t in track_ids:
+        logger.info(f"[{t}] Requeued for embedding")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("action", choices=("remove", "requeue"),
+                        help="remove: drop vectors and mappings; requeue: re-embed and replace in place")
+    parser.add_argument("track_ids", nargs="+", help="dbo.Tracks ids")
+    args = parser.parse_args()
+
+    if args.action == "remove":
+        print(f"Removed {remove_tracks(args.track_ids)} vectors")
+    else:
+        requeue_tracks(args.track_ids)
@@ -0,0 +1,139 @@
+﻿import time
+import argparse
+from typing import Dict, Tuple
+
+import faiss
+import numpy as np
+
+from config import (
+    MAPPING_PATH, FAISS_INDEX_TYPE, FAISS_IVF_NLIST, FAISS_PQ_M, FAISS_PQ_BITS,
+    FAISS_HNSW_M, FAISS_HNSW_EF_CONSTRUCTION
+)
+from logger import logger
+from faiss_index import (
+    INDEX_TYPES, LOSSY_INDEX_TYPES, create_index, needs_training, apply_search_params, describe_index, write_index_meta,
+    export_vectors, normalize_rows, has_stable_ids, with_stable_ids, track_faiss_id, _resolved_index_path
+)
+from mapping_store import CSVMappingStore, CompositeMappingStore, sql_mapping_store
+from vector_journal import JournaledIndex
+
+ADD_CHUNK = 65536
+
+
+def vectors_from_index(index) -> Tuple[np.ndarray, np.ndarray]:
+    if describe_index(index) in LOSSY_INDEX_TYPES:
+        logger.warning(f"Source index is {describe_index(index)}: reconstructed vectors are lossy, prefer --source cache")
+    return export_vectors(index)
+
+
+def vectors_from_cache(index, id2track: Dict[int, str]) -> Tuple[np.ndarray, np.ndarray]:
+    # stored full-precision vectors where available, the current index for any id the cache misses
+    from embedding_cache import EmbeddingCache
+    from model_registry import get_registry
+
+    track_ids, _, _, cached = EmbeddingCache(model_id=get_registry().embedding_id).export()
+    latest = {tid: i for i, tid in enumerate(track_ids)}
+
+    ids, vecs = export_vectors(index)
+    hits = 0
+    for pos, fid in enumerate(ids.tolist()):
+        row = latest.get(id2track.get(fid))
+        if row is not None:
+            vecs[pos] = cached[row]
+            hits += 1
+    logger.info(f"Cache supplied {hits}/{len(ids)} vectors")
+    return ids, normalize_rows(vecs)
+
+
+def _to_stable_ids(ids: np.ndarray, vecs: np.ndarray, id2track: Dict[int, str]) -> Tuple[np.ndarray, np.ndarray]:
+    keep, new_ids = [], []
+    for pos, fid in enumerate(ids.tolist()):
+        tid = id2track.get(fid)
+        if tid is None:
+            continue
+        keep.append(pos)
+        new_ids.append(track_faiss_id(tid))
+    if len(keep) < len(ids):
+        logger.warning(f"Dropping {len(ids) - len(keep)} vectors with no mapping row")
+    return np.asarray(new_ids, dtype="int64"), vecs[keep]
+
+
+def _rekey_mapping(mapper, id2track: Dict[int, str]) -> int:
+    # mapping rows move from positional ids to stable ids in one rewrite; the new keys only depend on the
+    # mapping itself, so a run stopped before this point is finished by running --stable-ids again
+    rows = {track_faiss_id(tid): tid for tid in id2track.values()}
+    mapper.initialize()
+    mapper.replace_all(list(rows.items()))
+    logger.info(f"Re-keyed {len(rows)} mapping rows to stable ids")
+    return len(rows)
+
+
+def migrate(kind: str, source: str = "index", train_size: int = 200000, stable_ids: bool = False, **params) -> dict:
+    store = JournaledIndex()
+    old = store.index
+    if old.ntotal == 0:
+        raise SystemExit("Index is empty; nothing to migrate")
+    stable = stable_ids or has_stable_ids(old)
+
+    start = time.time()
+    mapper = CompositeMappingStore([CSVMappingStore(MAPPING_PATH), sql_mapping_store()])
+    id2track = CSVMappingStore(MAPPING_PATH).load() if (source == "cache" or stable_ids or not has_stable_ids(old)) else {}
+    ids, vecs = vectors_from_cache(old, id2track) if source == "cache" else vectors_from_index(old)
+    if stable and not has_stable_ids(old):
+        ids, vecs = _to_stable_ids(ids, vecs, id2track)
+    n = len(ids)
+
+    new = create_index(kind, dim=old.d, **params)
+    if needs_training(kind):
+        # IVF needs a vector per list, PQ one per centroid of each sub-quantizer
+        need = faiss.extract_index_ivf(new).nlist if kind.startswith("ivf") else 0
+        if kind == "pq_refine":
+            need = 1 << params.get("pq_bits", FAISS_PQ_BITS)
+        if n < need:
+            raise SystemExit(f"{n} vectors are not enough to train {kind} (need at least {need})")
+        rng = np.random.default_rng(0)
+        sample = vecs if n <= train_size else vecs[np.sort(rng.choice(n, train_size, replace=False))]
+        logger.info(f"Training {kind} on {len(sample)} vectors")
+        new.train(np.ascontiguousarray(sample))
+    if stable:
+        new = with_stable_ids(new)
+
+    # ids are carried over explicitly (stable) or by adding in id order (positional)
+    for i in range(0, n, ADD_CHUNK):
+        chunk = np.ascontiguousarray(vecs[i:i + ADD_CHUNK])
+        if stable:
+            new.add_with_ids(chunk, np.ascontiguousarray(ids[i:i + ADD_CHUNK]))
+        else:
+            new.add(chunk)
+    apply_search_params(new)
+
+    store.index = new
+    store.checkpoint()
+    # only once the re-keyed index is on disk
+    if stable_ids and any(fid != track_faiss_id(tid) for fid, tid in id2track.items()):
+        _rekey_mapping(mapper, id2track)
+    meta = write_index_meta(new, _resolved_index_path(), params=params, migrated_from=describe_index(old),
+                            source=source, stable_ids=stable,
+                            train_size=min(n, train_size) if needs_training(kind) else 0)
+    logger.info(f"Migrated {n} vectors to {kind} in {time.time() - start:.1f}s")
+    return meta
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--type", default=FAISS_INDEX_TYPE, choices=INDEX_TYPES)
+    parser.add_argument("--source", default="index", choices=("index", "cache"),
+                        help="vectors from the current index or from the embedding cache")
+    parser.add_argument("--stable-ids", action="store_true",
+                        help="re-key a positional index by stable per-track ids (rewrites the mapping)")
+    parser.add_argument("--train-size", type=int, default=200000)
+    parser.add_argument("--nlist", type=int, default=FAISS_IVF_NLIST)
+    parser.add_argument("--pq-m", type=int, default=FAISS_PQ_M)
+    parser.add_argument("--pq-bits", type=int, default=FAISS_PQ_BITS)
+    parser.add_argument("--hnsw-m", type=int, default=FAISS_HNSW_M)
+    parser.add_argument("--ef-construction", type=int, default=FAISS_HNSW_EF_CONSTRUCTION)
+    args = parser.parse_args()
+
+    print(migrate(args.type, source=args.source, train_size=args.train_size, stable_ids=args.stable_ids,
+                  nlist=args.nlist, pq_m=args.pq_m, pq_bits=args.pq_bits,
+                  hnsw_m=args.hnsw_m, ef_construction=args.ef_construction))
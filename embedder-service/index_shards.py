@@ -0,0 +1,215 @@
+﻿import os
+import json
+import argparse
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import faiss
+import numpy as np
+
+from config import FAISS_SHARD_DIR, FAISS_SHARD_MAX_ROWS, EMBEDDING_DIM
+from faiss_index import has_stable_ids, index_ids, export_vectors, save_index, describe_index, remove_from_index
+from logger import logger
+from vector_journal import JournaledIndex, VectorJournal
+
+MANIFEST_NAME = "manifest.json"
+
+
+def _save_ids(path: str, ids: np.ndarray) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, np.asarray(ids, dtype="int64"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _load_ids(path: str) -> np.ndarray:
+    return np.load(path) if os.path.exists(path) else np.zeros(0, dtype="int64")
+
+
+class ShardManifest:
+    # shards are only ever appended; a sealed shard's .index file is never rewritten,
+    # ids replaced or removed later are listed in its small .deleted.npy instead
+    def __init__(self, root: str = FAISS_SHARD_DIR):
+        p = Path(root).resolve()
+        p.mkdir(parents=True, exist_ok=True)
+        self.root = str(p)
+        self.path = os.path.join(self.root, MANIFEST_NAME)
+        self.data = self._load()
+
+    def _load(self) -> Dict[str, Any]:
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        return {"version": 1, "dim": EMBEDDING_DIM, "metric": "inner_product", "shards": []}
+
+    def save(self) -> None:
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    @property
+    def shards(self) -> List[Dict[str, Any]]:
+        return self.data["shards"]
+
+    def file(self, shard: Dict[str, Any], key: str) -> str:
+        return os.path.join(self.root, shard[key])
+
+    def add_shard(self) -> Dict[str, Any]:
+        name = f"shard_{len(self.shards):05d}"
+        shard = {
+            "name": name,
+            "index": f"{name}.index",
+            "journal": f"{name}.journal",
+            "ids": f"{name}.ids.npy",
+            "deleted": f"{name}.deleted.npy",
+            "sealed": False,
+            "ntotal": 0,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        }
+        self.shards.append(shard)
+        self.save()
+        logger.info(f"Added shard {name} to {self.path}")
+        return shard
+
+    def open_shard(self) -> Dict[str, Any]:
+        for shard in self.shards:
+            if not shard["sealed"]:
+                return shard
+        return self.add_shard()
+
+
+class ShardedIndexStore:
+    # same surface as JournaledIndex; only the open shard is loaded, sealed shards contribute their id lists
+    def __init__(self, manifest: Optional[ShardManifest] = None, max_rows: int = FAISS_SHARD_MAX_ROWS):
+        self.manifest = manifest or ShardManifest()
+        self.max_rows = max_rows
+        self.sealed = [
+            {"shard": s, "ids": _load_ids(self.manifest.file(s, "ids")),
+             "deleted": _load_ids(self.manifest.file(s, "deleted"))}
+            for s in self.manifest.shards if s["sealed"]
+        ]
+        self._open(self.manifest.open_shard())
+        # a crash between a journal record and the older shard's tombstone is repaired here
+        recs = self.current.journal.read()
+        if len(recs):
+            self._shadow(np.unique(recs["id"]))
+
+    def _open(self, shard: Dict[str, Any]) -> None:
+        self.shard = shard
+        self.current = JournaledIndex(journal=VectorJournal(self.manifest.file(shard, "journal")),
+                                      index_path=self.manifest.file(shard, "index"))
+        if not has_stable_ids(self.current.index):
+            raise RuntimeError(f"Shard {shard['name']} uses positional ids; shards need stable ids")
+        logger.info(f"Open shard {shard['name']} (ntotal={self.current.index.ntotal}, sealed shards={len(self.sealed)})")
+
+    @property
+    def index(self):
+        return self.current.index
+
+    @property
+    def pending(self) -> int:
+        return self.current.pending
+
+    def _shadow(self, ids: np.ndarray) -> int:
+        # the open shard now owns these ids; hide any copy in a sealed shard
+        ids = np.unique(np.asarray(ids, dtype="int64"))
+        n = 0
+        for entry in self.sealed:
+            hit = ids[np.isin(ids, entry["ids"]) & ~np.isin(ids, entry["deleted"])]
+            if len(hit):
+                entry["deleted"] = np.union1d(entry["deleted"], hit)
+                _save_ids(self.manifest.file(entry["shard"], "deleted"), entry["deleted"])
+                n += len(hit)
+        return n
+
+    def log_added(self, ids: np.ndarray, vecs: np.ndarray) -> None:
+        self.current.log_added(ids, vecs)
+        self._shadow(ids)
+
+    def log_removed(self, ids: np.ndarray) -> None:
+        self.current.log_removed(ids)
+        self._shadow(ids)
+
+    def remove(self, ids: np.ndarray) -> int:
+        n = remove_from_index(self.current.index, ids)
+        self.current.log_removed(ids)
+        return n + self._shadow(ids)
+
+    def _checkpointed(self) -> None:
+        self.shard["ntotal"] = int(self.current.index.ntotal)
+        self.manifest.save()
+        if self.current.index.ntotal >= self.max_rows:
+            self._roll()
+
+    def checkpoint(self) -> None:
+        self.current.checkpoint()
+        self._checkpointed()
+
+    def maybe_checkpoint(self, force: bool = False) -> bool:
+        if not self.current.maybe_checkpoint(force):
+            return False
+        self._checkpointed()
+        return True
+
+    def _roll(self) -> None:
+        ids = index_ids(self.current.index)
+        _save_ids(self.manifest.file(self.shard, "ids"), ids)
+        self.shard["sealed"] = True
+        self.sealed.append({"shard": self.shard, "ids": ids, "deleted": np.zeros(0, dtype="int64")})
+        template = self.current.index
+        shard = self.manifest.add_shard()  # also persists the seal
+
+        # same type and training as the shard it follows
+        empty = faiss.clone_index(template)
+        empty.reset()
+        save_index(empty, self.manifest.file(shard, "index"))
+        logger.info(f"Sealed shard {self.shard['name']} at ntotal={len(ids)}")
+        self._open(shard)
+
+
+def split_index(rows: int = FAISS_SHARD_MAX_ROWS, root: str = FAISS_SHARD_DIR) -> ShardManifest:
+    # one-off conversion of music.index (+ journal) into id-range shards of `rows` vectors
+    manifest = ShardManifest(root)
+    if manifest.shards:
+        raise SystemExit(f"{manifest.path} already lists shards")
+    src = JournaledIndex()
+    if not has_stable_ids(src.index):
+        raise SystemExit("Index uses positional ids; migrate with index_migrate.py --stable-ids first")
+    ids, vecs = export_vectors(src.index)
+    order = np.argsort(ids)
+    ids, vecs = ids[order], vecs[order]
+
+    for start in range(0, len(ids), rows):
+        shard = manifest.add_shard()
+        part = slice(start, start + rows)
+        idx = faiss.clone_index(src.index)
+        idx.reset()
+        idx.add_with_ids(np.ascontiguousarray(vecs[part]), ids[part])
+        save_index(idx, manifest.file(shard, "index"))
+        _save_ids(manifest.file(shard, "ids"), ids[part])
+        shard["ntotal"] = int(idx.ntotal)
+        shard["sealed"] = idx.ntotal >= rows  # a short last shard stays open for new writes
+        logger.info(f"Wrote {shard['name']} ({describe_index(idx)}, ntotal={idx.ntotal})")
+    manifest.save()
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("action", choices=("split", "status"))
+    parser.add_argument("--rows", type=int, default=FAISS_SHARD_MAX_ROWS, help="vectors per shard for split")
+    parser.add_argument("--dir", default=FAISS_SHARD_DIR)
+    args = parser.parse_args()
+
+    if args.action == "split":
+        m = split_index(args.rows, args.dir)
+        print(f"Wrote {len(m.shards)} shards -> {m.path}")
+    else:
+        m = ShardManifest(args.dir)
+        for s in m.shards:
+            deleted = len(_load_ids(m.file(s, "deleted")))
+            print(f"{s['name']}  {'sealed' if s['sealed'] else 'open  '}  ntotal={s['ntotal']}  deleted={deleted}")
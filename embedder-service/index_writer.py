@@ -0,0 +1,172 @@
+﻿import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from db import mark_processed_many
+from faiss_index import (
+    add_to_index, add_batch_to_index, upsert_to_index, upsert_batch_to_index, has_stable_ids, supports_remove,
+    remove_ids, track_faiss_id
+)
+from logger import logger
+
+# (job, window-averaged vector, cache key or None when the vector came from the cache)
+Result = Tuple[Dict[str, Any], np.ndarray, Optional[Tuple[str, int, int]]]
+# (job, faiss id, normalised vector) once the vector is in the index
+Added = Tuple[Dict[str, Any], int, np.ndarray]
+
+
+class IndexWriter:
+    # sole owner of the FAISS index in a process: ids are assigned and mappings written under one lock
+    def __init__(self, index, mapper, on_error: Callable[[Dict[str, Any], Exception], None], cache=None,
+                 journal=None):
+        self._index = index
+        self.mapper = mapper
+        self.on_error = on_error
+        self.cache = cache
+        self.journal = journal
+        self.dirty = False
+        self._lock = threading.Lock()
+
+    @property
+    def index(self):
+        # a sharded store swaps in a fresh open shard once the current one is sealed
+        return self.journal.index if self.journal is not None else self._index
+
+    def commit_batch(self, results: List[Result]) -> int:
+        fresh = [(key, vec) for _, vec, key in results if key is not None]
+        if self.cache is not None and fresh:
+            try:
+                self.cache.put_many([k for k, _ in fresh], np.stack([v for _, v in fresh]))
+            except Exception as e:
+                logger.exception(f"Embedding cache write failed: {e}")
+
+        done = 0
+        with self._lock:
+            previous = self._previous(results)
+            added = self._add_vectors(results)
+
+            # vectors are durable in the journal before their mapping / status rows are written
+            if self.journal is not None and added:
+                self.journal.log_added(np.array([i for _, i, _ in added]), np.stack([v for _, _, v in added]))
+
+            mapped = self._add_mappings(added, previous)
+
+            # one set-based status update for the batch
+            try:
+                mark_processed_many([job["id"] for job, _, _ in mapped])
+            except Exception as e:
+                for job, _, _ in mapped:
+                    self.on_error(job, e)
+                self._rollback(mapped, previous)
+                return 0
+            for job, new_id, _ in mapped:
+                done += 1
+                logger.info(f"[{job['id']}] Completed. FAISS id={new_id}")
+        return done
+
+    def _previous(self, results: List[Result]) -> Dict[int, np.ndarray]:
+        # vectors an upsert is about to replace, so a rolled-back batch can put them back
+        if not has_stable_ids(self.index) or not supports_remove(self.index):
+            return {}
+        previous = {}
+        for job, _, _ in results:
+            fid = track_faiss_id(job["id"])
+            try:
+                previous[fid] = self.index.reconstruct(fid)
+            except RuntimeError:
+                pass
+        return previous
+
+    def _add_mappings(self, added: List[Added], previous: Dict[int, np.ndarray]) -> List[Added]:
+        # whole batch in one write; per row if it fails, so one UNIQUE(track_id) conflict only fails its own job
+        try:
+            self.mapper.add_many([(new_id, f"{job['id']}") for job, new_id, _ in added])
+            return added
+        except Exception as e:
+            logger.exception(f"Batch mapping write failed, retrying per row: {e}")
+
+        mapped, failed = [], []
+        for job, new_id, vec in added:
+            try:
+                self.mapper.add_many([(new_id, f"{job['id']}")])
+                mapped.append((job, new_id, vec))
+            except Exception as e:
+                self.on_error(job, e)
+                failed.append((job, new_id, vec))
+        self._rollback(failed, previous)
+        return mapped
+
+    def _rollback(self, failed: List[Added], previous: Dict[int, np.ndarray]) -> None:
+        # take the vectors of failed jobs back out (restoring what they replaced) so a retry starts clean
+        if not failed:
+            return
+        index = self.index
+        ids = np.array([i for _, i, _ in failed], dtype="int64")
+        stable = has_stable_ids(index)
+        # positional ids can only be dropped from the end; anything else would renumber later vectors
+        tail = np.arange(index.ntotal - len(ids), index.ntotal)
+        if not supports_remove(index) or (not stable and not np.array_equal(np.sort(ids), tail)):
+            logger.warning(f"Vectors {ids.tolist()} of failed jobs stay in the index without a mapping")
+            return
+        back = np.array([i for i in ids.tolist() if i in previous], dtype="int64")
+        try:
+            remove_ids(index, ids)
+            if len(back):
+                index.add_with_ids(np.stack([previous[i] for i in back.tolist()]), back)
+        except Exception as e:
+            logger.exception(f"Rolling back vectors {ids.tolist()} failed: {e}")
+            return
+
+        if self.journal is not None and stable:
+            self.journal.log_removed(ids)
+            if len(back):
+                self.journal.log_added(back, np.stack([previous[i] for i in back.tolist()]))
+        elif self.journal is not None:
+            self.journal.unlog_added(len(ids))
+        for fid in ids.tolist():
+            if fid in previous:
+                continue  # a stable id maps to the same track before and after
+            try:
+                self.mapper.remove(fid)
+            except Exception as e:
+                logger.exception(f"Removing mapping row {fid} of a rolled-back vector failed: {e}")
+        logger.warning(f"Rolled back {len(ids)} vectors of failed jobs ({len(back)} restored)")
+
+    def _add_vectors(self, results: List[Result]) -> List[Added]:
+        # whole batch in one normalize + one add; per-item only if the batch add fails
+        if not results:
+            return []
+        stable = has_stable_ids(self.index)
+        try:
+            vecs = np.stack([vec for _, vec, _ in results])
+            if stable:
+                # a track seen twice in one batch keeps its last vector
+                last = {track_faiss_id(job["id"]): n for n, (job, _, _) in enumerate(results)}
+                rows = list(last.values())
+                ids = np.fromiter(last.keys(), dtype="int64", count=len(last))
+                normed = upsert_batch_to_index(self.index, ids, vecs[rows])
+            else:
+                rows = range(len(results))
+                first_id = self.index.ntotal
+                normed = add_batch_to_index(self.index, vecs)
+                ids = np.arange(first_id, first_id + len(normed), dtype="int64")
+            self.dirty = True
+            return [(results[n][0], int(i), v) for n, i, v in zip(rows, ids, normed)]
+        except Exception as e:
+            logger.exception(f"Batch index add failed, retrying per item: {e}")
+
+        added = []
+        for job, vec, _ in results:
+            try:
+                if stable:
+                    new_id = track_faiss_id(job["id"])
+                    normed = upsert_to_index(self.index, new_id, vec)
+                else:
+                    normed = add_to_index(self.index, vec)
+                    new_id = self.index.ntotal - 1
+                self.dirty = True
+                added.append((job, new_id, normed))
+            except Exception as e:
+                self.on_error(job, e)
+        return added
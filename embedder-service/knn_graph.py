@@ -0,0 +1,187 @@
+﻿import os
+import json
+import time
+import argparse
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional, Tuple
+
+import faiss
+import numpy as np
+
+from config import KNN_GRAPH_DIR, KNN_K, KNN_BLOCK_ROWS, KNN_BLOCK_COLS, FAISS_SHARD_DIR
+from faiss_index import LOSSY_INDEX_TYPES, export_vectors, describe_index
+from logger import logger
+
+# files inside KNN_GRAPH_DIR; row r of neighbors/scores belongs to ids[r] (ids sorted ascending)
+VECTORS_FILE = "vectors.f32"
+IDS_FILE = "ids.npy"
+NEIGHBORS_FILE = "neighbors.npy"
+SCORES_FILE = "scores.npy"
+META_FILE = "meta.json"
+
+
+def _export_index() -> Tuple[np.ndarray, np.ndarray]:
+    from vector_journal import JournaledIndex
+
+    index = JournaledIndex().index
+    if describe_index(index) in LOSSY_INDEX_TYPES:
+        logger.warning(f"Index is {describe_index(index)}: the graph is exact over the reconstructed (lossy) vectors")
+    return export_vectors(index)
+
+
+def _export_shards(root: str) -> Tuple[np.ndarray, np.ndarray]:
+    from index_shards import ShardManifest, _load_ids
+
+    manifest = ShardManifest(root)
+    all_ids, all_vecs = [], []
+    for s in manifest.shards:
+        path = manifest.file(s, "index")
+        if not os.path.exists(path):
+            continue
+        ids, vecs = export_vectors(faiss.read_index(path))
+        live = ~np.isin(ids, _load_ids(manifest.file(s, "deleted")))
+        all_ids.append(ids[live])
+        all_vecs.append(vecs[live])
+    if not all_ids:
+        return np.zeros(0, "int64"), np.zeros((0, 0), "float32")
+    return np.concatenate(all_ids), np.concatenate(all_vecs)
+
+
+def dump_vectors(out_dir: str, source: str = "index", shard_dir: str = FAISS_SHARD_DIR) -> Tuple[int, int]:
+    # the catalog as an id-sorted float32 memmap: workers read it without holding a copy each
+    ids, vecs = _export_shards(shard_dir) if source == "shards" else _export_index()
+    order = np.argsort(ids)
+    ids = np.ascontiguousarray(ids[order], dtype="int64")
+    n, d = (int(vecs.shape[0]), int(vecs.shape[1])) if len(ids) else (0, 0)
+    mm = np.memmap(os.path.join(out_dir, VECTORS_FILE), dtype="float32", mode="w+", shape=(max(n, 1), max(d, 1)))
+    for start in range(0, n, 65536):
+        mm[start:start + 65536] = vecs[order[start:start + 65536]]
+    mm.flush()
+    del mm
+    np.save(os.path.join(out_dir, IDS_FILE + ".tmp.npy"), ids)
+    return n, d
+
+
+def _block_topk(X: np.ndarray, r0: int, r1: int, k: int, block_cols: int) -> Tuple[np.ndarray, np.ndarray]:
+    # exact top-k of rows [r0, r1) against every row of X, merging one column block at a time
+    Q = np.asarray(X[r0:r1])
+    n = X.shape[0]
+    best_s = np.full((r1 - r0, k), -np.inf, dtype="float32")
+    best_i = np.full((r1 - r0, k), -1, dtype="int64")
+    rows = np.arange(r1 - r0)
+    for c0 in range(0, n, block_cols):
+        c1 = min(n, c0 + block_cols)
+        S = Q @ np.asarray(X[c0:c1]).T
+        # a track is not its own neighbour
+        self_hit = (rows + r0 >= c0) & (rows + r0 < c1)
+        S[rows[self_hit], rows[self_hit] + r0 - c0] = -np.inf
+
+        cand_s = np.hstack([best_s, S])
+        cand_i = np.hstack([best_i, np.broadcast_to(np.arange(c0, c1, dtype="int64"), S.shape)])
+        top = np.argpartition(-cand_s, k - 1, axis=1)[:, :k]
+        best_s = np.take_along_axis(cand_s, top, axis=1)
+        best_i = np.take_along_axis(cand_i, top, axis=1)
+
+    order = np.argsort(-best_s, axis=1, kind="stable")
+    return np.take_along_axis(best_s, order, axis=1), np.take_along_axis(best_i, order, axis=1)
+
+
+def _worker(out_dir: str, n: int, d: int, k: int, r0: int, r1: int, block_cols: int, suffix: str) -> int:
+    X = np.memmap(os.path.join(out_dir, VECTORS_FILE), dtype="float32", mode="r", shape=(n, d))
+    ids = np.load(os.path.join(out_dir, IDS_FILE + suffix), mmap_mode="r")
+    neighbors = np.load(os.path.join(out_dir, NEIGHBORS_FILE + suffix), mmap_mode="r+")
+    scores = np.load(os.path.join(out_dir, SCORES_FILE + suffix), mmap_mode="r+")
+
+    s, i = _block_topk(X, r0, r1, k, block_cols)
+    missing = (i < 0) | ~np.isfinite(s)  # catalogs smaller than k + 1
+    neighbors[r0:r1] = np.where(missing, -1, np.asarray(ids)[np.where(missing, 0, i)])
+    scores[r0:r1] = np.where(missing, 0.0, s).astype("float16")
+    neighbors.flush()
+    scores.flush()
+    return r1 - r0
+
+
+def build_graph(out_dir: str = KNN_GRAPH_DIR, k: int = KNN_K, source: str = "index", workers: Optional[int] = None,
+                block_rows: int = KNN_BLOCK_ROWS, block_cols: int = KNN_BLOCK_COLS) -> dict:
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    t0 = time.time()
+    n, d = dump_vectors(out_dir, source)
+    if n < 2:
+        raise SystemExit(f"Need at least 2 vectors for a k-NN graph, found {n}")
+    logger.info(f"Dumped {n} x {d} vectors in {time.time() - t0:.1f}s")
+
+    # new files are written beside the live ones and swapped in at the end; open mmaps keep the old inodes
+    suffix = ".tmp.npy"
+    np.lib.format.open_memmap(os.path.join(out_dir, NEIGHBORS_FILE + suffix), mode="w+", dtype="int64", shape=(n, k))
+    np.lib.format.open_memmap(os.path.join(out_dir, SCORES_FILE + suffix), mode="w+", dtype="float16", shape=(n, k))
+
+    workers = workers or os.cpu_count() or 1
+    ctx = mp.get_context("spawn")
+    # each process does its own blocks; one BLAS thread apiece avoids oversubscribing the cores
+    saved = {v: os.environ.get(v) for v in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")}
+    os.environ.update({v: "1" for v in saved})
+    t1 = time.time()
+    done = 0
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+            futures = [pool.submit(_worker, out_dir, n, d, k, r0, min(n, r0 + block_rows), block_cols, suffix)
+                       for r0 in range(0, n, block_rows)]
+            for fut in as_completed(futures):
+                done += fut.result()
+                logger.info(f"k-NN rows {done}/{n} ({done / max(time.time() - t1, 1e-9):.0f} rows/s)")
+    finally:
+        for v, old in saved.items():
+            if old is None:
+                os.environ.pop(v, None)
+            else:
+                os.environ[v] = old
+
+    for name in (IDS_FILE, NEIGHBORS_FILE, SCORES_FILE):
+        os.replace(os.path.join(out_dir, name + suffix), os.path.join(out_dir, name))
+    os.remove(os.path.join(out_dir, VECTORS_FILE))
+    meta = {"n": n, "dim": d, "k": k, "source": source, "score": "inner_product", "score_dtype": "float16",
+            "build_seconds": round(time.time() - t0, 1), "built_at": datetime.now(timezone.utc).isoformat()}
+    tmp_path = os.path.join(out_dir, META_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_path, os.path.join(out_dir, META_FILE))
+    logger.info(f"k-NN graph written -> {out_dir} ({meta})")
+    return meta
+
+
+class KnnGraph:
+    # mmap'd lookup: the row is found by binary search over the sorted ids, the neighbours are one row read
+    def __init__(self, root: str = KNN_GRAPH_DIR):
+        with open(os.path.join(root, META_FILE), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.ids = np.load(os.path.join(root, IDS_FILE), mmap_mode="r")
+        self.neighbors = np.load(os.path.join(root, NEIGHBORS_FILE), mmap_mode="r")
+        self.scores = np.load(os.path.join(root, SCORES_FILE), mmap_mode="r")
+
+    def row(self, faiss_id: int) -> Optional[int]:
+        r = int(np.searchsorted(self.ids, faiss_id))
+        return r if r < len(self.ids) and int(self.ids[r]) == faiss_id else None
+
+    def lookup(self, faiss_id: int, k: Optional[int] = None) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        r = self.row(faiss_id)
+        if r is None:
+            return None
+        nb, sc = self.neighbors[r, :k], self.scores[r, :k]
+        keep = nb >= 0
+        return np.asarray(sc[keep], dtype="float32"), np.asarray(nb[keep])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", default=KNN_GRAPH_DIR)
+    parser.add_argument("--k", type=int, default=KNN_K)
+    parser.add_argument("--source", default="index", choices=("index", "shards"))
+    parser.add_argument("--workers", type=int, default=None, help="processes (default: all cores)")
+    parser.add_argument("--block-rows", type=int, default=KNN_BLOCK_ROWS)
+    parser.add_argument("--block-cols", type=int, default=KNN_BLOCK_COLS)
+    args = parser.parse_args()
+
+    print(build_graph(args.out, args.k, args.source, args.workers, args.block_rows, args.block_cols))
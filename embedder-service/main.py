@@ -1,88 +1,228 @@
 ﻿import os, time
+import argparse
+from typing import Any, Callable, List, Optional, Tuple
+import numpy as np
+import torch
 from logger import logger
 from config import (
-    MAPPING_PATH,
-    YT_START_SECONDS, YT_CLIP_SECONDS, BATCH_LIMIT
+    MAPPING_PATH, TARGET_SAMPLING_RATE,
+    YT_START_SECONDS, YT_CLIP_SECONDS, BATCH_LIMIT, YT_STREAM_PCM, EMBED_CACHE_ENABLED,
+    PIPELINE_IO_WORKERS, PIPELINE_PREP_WORKERS, PIPELINE_QUEUE_SIZE, PIPELINE_INFER_TRACKS, FAISS_SHARDED,
+    CLAIM_SCHEDULER
 )
-from mapping_store import CSVMappingStore, SQLMappingStore, CompositeMappingStore
-from faiss_index import load_index, add_to_index, save_index
-from audio_preparation import load_and_prep, windowed_embedding
-from stream_media import resolve_youtube_media, stream_clip_to_temp_wav
-from db_mssql import fetch_batch_to_process, mark_processed, mark_failed
+from mapping_store import CSVMappingStore, CompositeMappingStore, sql_mapping_store
+from vector_journal import JournaledIndex
+from audio_preparation import load_and_prep, prep_waveform, embed_waveforms
+from stream_media import resolve_youtube_media, stream_clip_to_temp_wav, stream_clip_to_tensor
+from db import fetch_batch_to_process, status_buffer
+from model_registry import get_registry
+from pipeline import run_pipeline
+from embedding_cache import EmbeddingCache
+from index_writer import IndexWriter, Result
 
 csv_map = CSVMappingStore(MAPPING_PATH)
-sql_map = SQLMappingStore()
+sql_map = sql_mapping_store()
 mapper = CompositeMappingStore([csv_map, sql_map])
-mapper.initialize()
+_mapper_ready = False
+_embed_cache: Optional[EmbeddingCache] = None
+_index_store = None  # JournaledIndex, or ShardedIndexStore when FAISS_SHARDED
+_scheduler = None  # ClaimScheduler when CLAIM_SCHEDULER
+
+
+def ensure_mapper() -> CompositeMappingStore:
+    # only the index-owning process touches the mapping stores
+    global _mapper_ready
+    if not _mapper_ready:
+        mapper.initialize()
+        _mapper_ready = True
+    return mapper
+
+
+def get_embed_cache() -> Optional[EmbeddingCache]:
+    # keyed by the registry's embedding_id, so open it only after the model has been configured
+    global _embed_cache
+    if EMBED_CACHE_ENABLED and _embed_cache is None:
+        _embed_cache = EmbeddingCache(model_id=get_registry().embedding_id)
+    return _embed_cache
+
+
+def get_index_store():
+    # loaded (checkpoint + journal replay) once per process, not once per cycle
+    global _index_store
+    if _index_store is None:
+        if FAISS_SHARDED:
+            from index_shards import ShardedIndexStore
+
+            _index_store = ShardedIndexStore()
+        else:
+            _index_store = JournaledIndex()
+    return _index_store
+
+
+def fetch_jobs() -> List[dict]:
+    global _scheduler
+    if not CLAIM_SCHEDULER:
+        return fetch_batch_to_process(limit=BATCH_LIMIT)
+    if _scheduler is None:
+        from claim_scheduler import ClaimScheduler
+
+        _scheduler = ClaimScheduler()
+    return _scheduler.next_batch()
+
+
+def run_jobs(jobs: List[dict], sink: Callable[[List[Result]], int]) -> int:
+    # embed_jobs timed, so the scheduler can size the next claim from seconds per track
+    t = time.time()
+    n = embed_jobs(jobs, sink)
+    if _scheduler is not None:
+        _scheduler.record(len(jobs), time.time() - t)
+    return n
+
+
+def compute_segment(job: dict) -> Tuple[int, int]:
+    db_start = int(job.get("start_s", 0) or 0)
+    db_dur = int(job.get("dur_s", 0) or 0)
+    total = int(job.get("duration_sec") or 0)
+
+    if db_dur > 0:
+        return db_start, db_dur
+    if YT_CLIP_SECONDS > 0:
+        dur_s = YT_CLIP_SECONDS
+        if total and total > dur_s:
+            return max(0, (total - dur_s) // 2), dur_s
+        return YT_START_SECONDS, dur_s
+    return 0, 0
+
+
+def _fetch_job(job: dict, _):
+    jid = job["id"]
+    url = job["source_url"]
+    start_s, dur_s = compute_segment(job)
+    embed_cache = get_embed_cache()
+    if embed_cache is not None:
+        cached = embed_cache.get(jid, start_s, dur_s)
+        if cached is not None:
+            logger.info(f"[{jid}] Embedding cache hit (ss={start_s}, dur={dur_s})")
+            return cached
+    logger.info(f"[{jid}] Resolving YouTube: {url} (ss={start_s}, dur={'FULL' if dur_s == 0 else dur_s})")
+    media_url, headers = resolve_youtube_media(url)
+    if YT_STREAM_PCM:
+        return stream_clip_to_tensor(media_url, headers, start_s=start_s, dur_s=dur_s)
+    return stream_clip_to_temp_wav(media_url, headers, start_s=start_s, dur_s=dur_s)
+
+
+def _prep_job(job: dict, fetched):
+    if isinstance(fetched, np.ndarray):
+        return fetched
+    if isinstance(fetched, torch.Tensor):
+        # ffmpeg already produced mono PCM at TARGET_SAMPLING_RATE
+        return prep_waveform(fetched, TARGET_SAMPLING_RATE, do_denoise=False)
+
+    tmp_wav = fetched
+    try:
+        return load_and_prep(tmp_wav, do_denoise=False)
+    finally:
+        if tmp_wav and os.path.exists(tmp_wav):
+            try:
+                os.remove(tmp_wav)
+            except:
+                pass
+
+
+def _fail_job(job: dict, e: Exception) -> None:
+    jid = job["id"]
+    logger.exception(f"[{jid}] Failed: {e}")
+    try:
+        status_buffer.fail(jid, str(e))
+    except Exception as e2:
+        logger.exception(f"[{jid}] Mark-failed error: {e2}")
+
+
+def flush_failures() -> None:
+    try:
+        status_buffer.flush()
+    except Exception as e:
+        logger.exception(f"Mark-failed flush error (kept for the next cycle): {e}")
+
+
+def embed_jobs(jobs: List[dict], sink: Callable[[List[Result]], int]) -> int:
+    get_embed_cache()  # open before the fetch threads start
+
+    def consume(batch: List[Tuple[dict, Any]]) -> int:
+        vecs = [payload for _, payload in batch]
+        keys = [None] * len(batch)
+        todo = [i for i, payload in enumerate(vecs) if isinstance(payload, torch.Tensor)]
+        if todo:
+            fresh = embed_waveforms([vecs[i] for i in todo])
+            for i, vec in zip(todo, fresh):
+                vecs[i] = vec
+                if get_embed_cache() is not None:
+                    keys[i] = (batch[i][0]["id"], *compute_segment(batch[i][0]))
+        return sink([(job, vec, key) for (job, _), vec, key in zip(batch, vecs, keys)])
+
+    return run_pipeline(
+        jobs,
+        fetch=_fetch_job,
+        prep=_prep_job,
+        consume=consume,
+        on_error=_fail_job,
+        io_workers=PIPELINE_IO_WORKERS,
+        prep_workers=PIPELINE_PREP_WORKERS,
+        queue_size=PIPELINE_QUEUE_SIZE,
+        batch_size=PIPELINE_INFER_TRACKS,
+    )
 
 
 def embed_from_db_once() -> int:
     start_wall = time.time()
-    index = load_index()
-    logger.info(f"Starting embed pass; current index size = {index.ntotal}")
+    store = get_index_store()
+    logger.info(f"Starting embed pass; current index size = {store.index.ntotal}")
     processed = 0
+    writer = IndexWriter(store.index, ensure_mapper(), on_error=_fail_job, cache=get_embed_cache(), journal=store)
 
-    jobs = fetch_batch_to_process(limit=BATCH_LIMIT)
+    jobs = fetch_jobs()
     if not jobs:
         logger.info("No pending YouTube rows.")
     else:
-        for job in jobs:
-            jid = job["id"]
-            url = job["source_url"]
-
-            # compute effective segment
-            db_start = int(job.get("start_s", 0) or 0)
-            db_dur = int(job.get("dur_s", 0) or 0)
-            total = int(job.get("duration_sec") or 0)
-
-            if db_dur > 0:
-                start_s, dur_s = db_start, db_dur
-            elif YT_CLIP_SECONDS > 0:
-                dur_s = YT_CLIP_SECONDS
-                if total and total > dur_s:
-                    start_s = max(0, (total - dur_s) // 2)
-                else:
-                    start_s = YT_START_SECONDS
-            else:
-                start_s, dur_s = 0, 0
-
-            tmp_wav = None
-            logger.info(f"[{jid}] Resolving YouTube: {url} (ss={start_s}, dur={'FULL' if dur_s == 0 else dur_s})")
-            try:
-                media_url, headers = resolve_youtube_media(url)
-                tmp_wav = stream_clip_to_temp_wav(media_url, headers, start_s=start_s, dur_s=dur_s)
-
-                waveform = load_and_prep(tmp_wav, do_denoise=False)
-                vec = windowed_embedding(waveform)
-                add_to_index(index, vec)
-
-                new_id = index.ntotal - 1
-                mapper.add(new_id, f"{jid}")
-                mark_processed(jid)
-                processed += 1
-                logger.info(f"[{jid}] Completed. FAISS id={new_id}")
-
-            except Exception as e:
-                logger.exception(f"[{jid}] Failed: {e}")
-                try:
-                    mark_failed(jid, str(e))
-                except Exception as e2:
-                    logger.exception(f"[{jid}] Mark-failed error: {e2}")
-            finally:
-                if tmp_wav and os.path.exists(tmp_wav):
-                    try:
-                        os.remove(tmp_wav)
-                    except:
-                        pass
-
-    save_index(index)
+        processed = run_jobs(jobs, writer.commit_batch)
+    flush_failures()
+
+    store.maybe_checkpoint()
     logger.info(f"Cycle complete: processed={processed} in {time.time() - start_wall:.3f}s")
     return processed
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default=None, help="e.g., cpu, cuda, cuda:1 (default: MODEL_DEVICE)")
+    parser.add_argument("--dtype", default=None, help="float32, bfloat16 or float16 (default: MODEL_DTYPE)")
+    parser.add_argument("--precision", default=None, help="float32, bfloat16 or int8 (default: MODEL_PRECISION)")
+    parser.add_argument("--num-layers", type=int, default=None, help="stop after N transformer layers (default: MODEL_NUM_LAYERS)")
+    parser.add_argument("--layers", default=None, help='pooled layers, e.g. "last", "6" or "4:0.5,6:0.5" (default: EMBED_LAYERS)')
+    parser.add_argument("--workers", type=int, default=1, help="embedding worker processes (>1 starts the supervisor)")
+    parser.add_argument("--threads-per-worker", type=int, default=None, help="torch threads per worker process")
+    args = parser.parse_args()
+
+    model_opts = dict(device=args.device, dtype=args.dtype, precision=args.precision,
+                      num_layers=args.num_layers, layers=args.layers)
+    if args.workers > 1:
+        from supervisor import run_supervisor
+
+        run_supervisor(args.workers, threads_per_worker=args.threads_per_worker, model_opts=model_opts)
+        raise SystemExit(0)
+
+    registry = get_registry()
+    registry.configure(**model_opts)
+    registry.warm_up()
+    logger.info(f"Model ready={registry.is_ready()} (load {registry.load_seconds:.3f}s)")
+
     POLL_SECONDS = 3
-    while True:
-        n = embed_from_db_once()
-        if n == 0:
-            time.sleep(POLL_SECONDS)
+    try:
+        while True:
+            n = embed_from_db_once()
+            if n == 0:
+                time.sleep(POLL_SECONDS)
+    finally:
+        flush_failures()
+        if _index_store is not None:
+            _index_store.maybe_checkpoint(force=True)
@@ -0,0 +1,185 @@
+﻿import os
+import re
+import csv
+import json
+import time
+import uuid
+import argparse
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from config import MAPPING_PATH, MAPPING_COMPACT_PATH
+from logger import logger
+
+# one .npy of fixed-size rows sorted by faiss_id, opened with mmap_mode="r" by search-engine/id_map.py.
+# Each conversion writes a new mapping.<version>.npy and then points mapping.npy.meta.json at it, so the
+# file a searcher has mapped is never replaced (Windows refuses to replace a mapped file). Rows:
+#   fid      faiss id
+#   uuid     track GUID as 16 raw bytes (uuid.UUID.bytes)
+#   by_uuid  row numbers ordered by uuid, the reverse (track -> faiss id) index
+ENTRY_DTYPE = np.dtype([("fid", "<i8"), ("uuid", "S16"), ("by_uuid", "<i8")])
+
+
+def _meta_path(path: str) -> str:
+    return path + ".meta.json"
+
+
+def _version_path(path: str, version: int) -> str:
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.{version}{ext}"
+
+
+def _table_path(path: str, meta: dict) -> str:
+    # the versioned file the meta points at; tables from before versioning were written to `path` itself
+    return os.path.join(os.path.dirname(path), meta["file"]) if meta.get("file") else path
+
+
+def _read_meta(path: str) -> dict:
+    try:
+        with open(_meta_path(path), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _prune(path: str, keep: set) -> None:
+    # older versions; one a slow reader still has mapped on Windows is left for the next conversion
+    folder = os.path.dirname(path) or "."
+    stem, ext = os.path.splitext(os.path.basename(path))
+    pattern = re.compile(rf"{re.escape(stem)}\.\d+{re.escape(ext)}")
+    old = [os.path.join(folder, n) for n in os.listdir(folder) if pattern.fullmatch(n)]
+    for p in old + ([path] if os.path.exists(path) else []):
+        if os.path.abspath(p) in keep:
+            continue
+        try:
+            os.remove(p)
+        except OSError as e:
+            logger.warning(f"Could not remove old compact mapping {p} (retried next time): {e}")
+
+
+def _read_csv_tail(csv_path: str, offset: int = 0) -> Tuple[Dict[int, str], int]:
+    # rows appended after `offset`; an empty db_id is a tombstone and stays in the result as ""
+    changes: Dict[int, str] = {}
+    if not os.path.exists(csv_path):
+        return changes, 0
+    with open(csv_path, "rb") as f:
+        header = next(csv.reader([f.readline().decode("utf-8-sig")]), [])
+        if "faiss_id" not in header:
+            return changes, 0
+        fid_col = header.index("faiss_id")
+        key_col = header.index("db_id") if "db_id" in header else header.index("filename")
+        start = max(offset, f.tell())
+        f.seek(start)
+        data = f.read()
+    end = data.rfind(b"\n") + 1  # a half-written last row is picked up next time
+    for row in csv.reader(data[:end].decode("utf-8").splitlines()):
+        try:
+            changes[int(row[fid_col])] = row[key_col] if len(row) > key_col else ""
+        except (ValueError, IndexError):
+            continue
+    return changes, start + end
+
+
+def _open(path: str) -> Tuple[Optional[np.ndarray], dict]:
+    meta = _read_meta(path)
+    table = _table_path(path, meta)
+    if not meta or not os.path.exists(table):
+        return None, {}
+    return np.load(table, mmap_mode="r"), meta
+
+
+def _split(id2track: Dict[int, str]) -> Tuple[np.ndarray, np.ndarray, Dict[str, str], int]:
+    # GUID keys go into the array; anything else (legacy filename keys) is kept verbatim in the meta file
+    fids, raws, extras, upper = [], [], {}, 0
+    for fid, key in id2track.items():
+        try:
+            u = uuid.UUID(key)
+        except (ValueError, AttributeError, TypeError):
+            extras[str(fid)] = key
+            continue
+        fids.append(fid)
+        raws.append(u.bytes)
+        upper += key != key.lower()
+    return np.asarray(fids, dtype="int64"), np.asarray(raws, dtype="S16"), extras, upper
+
+
+def write_compact(path: str, fids: np.ndarray, uuids: np.ndarray, extras: Dict[str, str], uppercase: bool,
+                  **extra) -> dict:
+    rows = np.zeros(len(fids), dtype=ENTRY_DTYPE)
+    rows["fid"] = fids
+    rows["uuid"] = uuids
+    rows.sort(order="fid")
+    rows["by_uuid"] = np.argsort(rows["uuid"], kind="stable")
+
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    # array first, under a name no reader knows yet; the meta replace then publishes it
+    prev = _read_meta(path)
+    version = int(prev.get("version", 0)) + 1
+    table = _version_path(path, version)
+    np.save(table, rows)
+    meta = {"n": int(len(rows)), "uppercase": bool(uppercase), "extras": extras, "version": version,
+            "file": os.path.basename(table), "bytes_per_entry": ENTRY_DTYPE.itemsize,
+            "built_at": datetime.now(timezone.utc).isoformat(), **extra}
+    with open(_meta_path(path) + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(_meta_path(path) + ".tmp", _meta_path(path))
+    # the previous table stays: searchers move to the new one at their next reload poll
+    keep = {os.path.abspath(table)}
+    if prev:
+        keep.add(os.path.abspath(_table_path(path, prev)))
+    _prune(path, keep)
+    return meta
+
+
+def convert(source: str = "csv", csv_path: str = MAPPING_PATH, path: str = MAPPING_COMPACT_PATH,
+            full: bool = False) -> dict:
+    start = time.time()
+    rows, meta = (None, {}) if full or source == "sql" else _open(path)
+    incremental = (rows is not None and len(rows) == meta.get("n") and meta.get("csv_offset") is not None
+                   and os.path.exists(csv_path) and meta["csv_offset"] <= os.path.getsize(csv_path))
+
+    if incremental:
+        # the existing table minus every faiss id touched since csv_offset, plus the touched ids still mapped
+        changes, csv_offset = _read_csv_tail(csv_path, meta["csv_offset"])
+        rows = np.asarray(rows)
+        keep = ~np.isin(rows["fid"], np.fromiter(changes, dtype="int64", count=len(changes)))
+        fids, uuids, extras, _ = _split({fid: key for fid, key in changes.items() if key})
+        extras.update({k: v for k, v in meta.get("extras", {}).items() if int(k) not in changes})
+        fids = np.concatenate([rows["fid"][keep], fids])
+        uuids = np.concatenate([rows["uuid"][keep], uuids])
+        uppercase, mode = meta.get("uppercase", False), "incremental"
+    else:
+        if source == "sql":
+            from mapping_store import sql_mapping_store
+
+            # search-engine overlays mapping.csv from csv_offset on, so the offset is taken before the read:
+            # rows landing during the conversion are then applied twice, which is harmless
+            csv_offset = os.path.getsize(csv_path) if os.path.exists(csv_path) else 0
+            id2track = sql_mapping_store().load()
+        else:
+            changes, csv_offset = _read_csv_tail(csv_path)
+            id2track = {fid: key for fid, key in changes.items() if key}
+        fids, uuids, extras, upper = _split(id2track)
+        uppercase, mode = upper > len(fids) // 2, "full"
+
+    meta = write_compact(path, fids, uuids, extras, uppercase, source=source, mode=mode,
+                         csv_path=os.path.basename(csv_path), csv_offset=csv_offset)
+    logger.info(f"Compact mapping ({mode} from {source}): {meta['n']} GUIDs + {len(extras)} other keys "
+                f"-> {path} in {time.time() - start:.1f}s")
+    return meta
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", default="csv", choices=("csv", "sql"))
+    parser.add_argument("--csv", default=MAPPING_PATH)
+    parser.add_argument("--out", default=MAPPING_COMPACT_PATH)
+    parser.add_argument("--full", action="store_true", help="re-read the whole CSV instead of only the new rows")
+    args = parser.parse_args()
+
+    meta = convert(args.source, args.csv, args.out, args.full)
+    print({k: v for k, v in meta.items() if k != "extras"})
@@ -1,10 +1,11 @@
 ﻿import os
 import csv
-import pyodbc
 from abc import ABC, abstractmethod
 from datetime import datetime, timezone
-from typing import Dict, List, Iterable, Optional
-from config import build_default_conn_str
+from typing import Dict, List, Iterable, Optional, Sequence, Tuple
+from config import build_default_conn_str, DB_BACKEND, SQLITE_PATH
+
+SQL_ROWS_PER_STATEMENT = 1000  # 2 params per row, SQL Server caps a statement at 2100
 
 
 class MappingStore(ABC):
@@ -16,6 +17,19 @@ class MappingStore(ABC):
     def add(self, vector_id: int, filename: str, timestamp: str = None) -> None:
         pass
 
+    @abstractmethod
+    def remove(self, vector_id: int) -> None:
+        pass
+
+    def add_many(self, rows: Sequence[Tuple[int, str]], timestamp: str = None) -> None:
+        for vector_id, db_id in rows:
+            self.add(vector_id, db_id, timestamp)
+
+    @abstractmethod
+    def replace_all(self, rows: Sequence[Tuple[int, str]]) -> None:
+        # the whole mapping at once, all or nothing
+        pass
+
     @abstractmethod
     def load(self) -> Dict[int, str]:
         pass
@@ -41,6 +55,27 @@ class CSVMappingStore(MappingStore):
             writer = csv.writer(f)
             writer.writerow([vector_id, filename, timestamp])
 
+    def add_many(self, rows: Sequence[Tuple[int, str]], timestamp: str = None) -> None:
+        if not rows:
+            return
+        if timestamp is None:
+            timestamp = datetime.now(timezone.utc).isoformat()
+        with open(self.csv_path, "a", newline="") as f:
+            csv.writer(f).writerows([vector_id, db_id, timestamp] for vector_id, db_id in rows)
+
+    def remove(self, vector_id: int) -> None:
+        # append-only: an empty db_id row is a tombstone that load() applies
+        self.add(vector_id, "")
+
+    def replace_all(self, rows: Sequence[Tuple[int, str]]) -> None:
+        timestamp = datetime.now(timezone.utc).isoformat()
+        tmp_path = self.csv_path + ".tmp"
+        with open(tmp_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["faiss_id", "db_id", "timestamp"])
+            writer.writerows([vector_id, db_id, timestamp] for vector_id, db_id in rows)
+        os.replace(tmp_path, self.csv_path)
+
     def load(self) -> Dict[int, str]:
         mapping = {}
         if not os.path.exists(self.csv_path):
@@ -51,7 +86,10 @@ class CSVMappingStore(MappingStore):
             if not key_name:
                 return mapping
             for row in reader:
-                mapping[int(row["faiss_id"])] = row[key_name]
+                if row[key_name]:
+                    mapping[int(row["faiss_id"])] = row[key_name]
+                else:
+                    mapping.pop(int(row["faiss_id"]), None)
         return mapping
 
 
@@ -61,7 +99,10 @@ class SQLMappingStore(MappingStore):
         self.table = table
 
     def _get_conn(self):
-        return pyodbc.connect(self.conn_str, autocommit=False)
+        # pooled: shares the status updates' connections when the connection string is the same
+        from db_mssql import get_conn
+
+        return get_conn(self.conn_str)
 
     def initialize(self) -> None:
         create_sql = f"""
@@ -81,6 +122,8 @@ class SQLMappingStore(MappingStore):
             conn.commit()
 
     def add(self, vector_id: int, db_id: str, timestamp: str = None) -> None:
+        import pyodbc
+
         with self._get_conn() as conn:
             cur = conn.cursor()
             try:
@@ -95,6 +138,49 @@ class SQLMappingStore(MappingStore):
                 )
             conn.commit()
 
+    def add_many(self, rows: Sequence[Tuple[int, str]], timestamp: str = None) -> None:
+        # one transaction, MERGE over multi-row VALUES; last row wins for a repeated faiss_id
+        merged = {int(vector_id): db_id for vector_id, db_id in rows}
+        if not merged:
+            return
+        items = list(merged.items())
+        with self._get_conn() as conn:
+            cur = conn.cursor()
+            for i in range(0, len(items), SQL_ROWS_PER_STATEMENT):
+                chunk = items[i:i + SQL_ROWS_PER_STATEMENT]
+                values = ", ".join(["(?, ?)"] * len(chunk))
+                cur.execute(
+                    f"""
+                    MERGE {self.table} AS t
+                    USING (VALUES {values}) AS s(faiss_id, track_id)
+                    ON t.faiss_id = s.faiss_id
+                    WHEN MATCHED THEN UPDATE SET track_id = s.track_id
+                    WHEN NOT MATCHED THEN INSERT (faiss_id, track_id) VALUES (s.faiss_id, s.track_id);
+                    """,
+                    *[p for row in chunk for p in row]
+                )
+            conn.commit()
+
+    def remove(self, vector_id: int) -> None:
+        with self._get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute(f"DELETE FROM {self.table} WHERE faiss_id = ?", int(vector_id))
+            conn.commit()
+
+    def replace_all(self, rows: Sequence[Tuple[int, str]]) -> None:
+        # one transaction: readers see the old mapping or the new one
+        items = list({int(vector_id): db_id for vector_id, db_id in rows}.items())
+        with self._get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute(f"DELETE FROM {self.table}")
+            for i in range(0, len(items), SQL_ROWS_PER_STATEMENT):
+                chunk = items[i:i + SQL_ROWS_PER_STATEMENT]
+                cur.execute(
+                    f"INSERT INTO {self.table}(faiss_id, track_id) VALUES {', '.join(['(?, ?)'] * len(chunk))}",
+                    *[p for row in chunk for p in row]
+                )
+            conn.commit()
+
     def load(self) -> Dict[int, str]:
         mapping: Dict[int, str] = {}
         with self._get_conn() as conn:
@@ -105,6 +191,59 @@ class SQLMappingStore(MappingStore):
         return mapping
 
 
+class SQLiteMappingStore(MappingStore):
+    # VectorMap in the local SQLite database (db_sqlite.py), same rows as the SQL Server table
+    def __init__(self, path: str = SQLITE_PATH):
+        self.path = path
+
+    def _get_conn(self):
+        from db_sqlite import get_conn
+
+        return get_conn(self.path)
+
+    def initialize(self) -> None:
+        with self._get_conn():
+            pass  # the schema is created when the connection opens
+
+    def add(self, vector_id: int, db_id: str, timestamp: str = None) -> None:
+        self.add_many([(vector_id, db_id)], timestamp)
+
+    def add_many(self, rows: Sequence[Tuple[int, str]], timestamp: str = None) -> None:
+        # last row wins for a repeated faiss_id, as with the SQL Server MERGE
+        merged = {int(vector_id): db_id for vector_id, db_id in rows}
+        if not merged:
+            return
+        with self._get_conn() as conn:
+            conn.executemany(
+                """
+                INSERT INTO VectorMap (faiss_id, track_id) VALUES (?, ?)
+                ON CONFLICT (faiss_id) DO UPDATE SET track_id = excluded.track_id
+                """,
+                list(merged.items())
+            )
+
+    def remove(self, vector_id: int) -> None:
+        with self._get_conn() as conn:
+            conn.execute("DELETE FROM VectorMap WHERE faiss_id = ?", (int(vector_id),))
+
+    def replace_all(self, rows: Sequence[Tuple[int, str]]) -> None:
+        items = list({int(vector_id): db_id for vector_id, db_id in rows}.items())
+        with self._get_conn() as conn:
+            conn.execute("DELETE FROM VectorMap")
+            conn.executemany("INSERT INTO VectorMap (faiss_id, track_id) VALUES (?, ?)", items)
+
+    def load(self) -> Dict[int, str]:
+        with self._get_conn() as conn:
+            return {int(fid): str(tid) for fid, tid in conn.execute("SELECT faiss_id, track_id FROM VectorMap")}
+
+
+def sql_mapping_store() -> MappingStore:
+    # the database half of the mapping, on whichever backend DB_BACKEND selects
+    if DB_BACKEND == "sqlite":
+        return SQLiteMappingStore()
+    return SQLMappingStore()
+
+
 class CompositeMappingStore(MappingStore):
     def __init__(self, stores: Iterable[MappingStore]):
         self.stores: List[MappingStore] = list(stores)
@@ -117,6 +256,18 @@ class CompositeMappingStore(MappingStore):
         for s in self.stores:
             s.add(vector_id, db_id, timestamp)
 
+    def add_many(self, rows: Sequence[Tuple[int, str]], timestamp: str = None) -> None:
+        for s in self.stores:
+            s.add_many(rows, timestamp)
+
+    def remove(self, vector_id: int) -> None:
+        for s in self.stores:
+            s.remove(vector_id)
+
+    def replace_all(self, rows: Sequence[Tuple[int, str]]) -> None:
+        for s in self.stores:
+            s.replace_all(rows)
+
     def load(self) -> Dict[int, str]:
         merged: Dict[int, str] = {}
         for s in self.stores:
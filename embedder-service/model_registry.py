@@ -0,0 +1,200 @@
+﻿import contextlib
+import threading
+import time
+from typing import Dict, Optional, Tuple, Any
+
+import torch
+
+from config import (
+    MERT_MODEL_ID, MODEL_DEVICE, MODEL_DTYPE, MODEL_PRECISION, MODEL_NUM_LAYERS, EMBED_LAYERS,
+    TARGET_SAMPLING_RATE
+)
+from logger import logger
+
+_DTYPES = {
+    "float32": torch.float32,
+    "fp32": torch.float32,
+    "bfloat16": torch.bfloat16,
+    "bf16": torch.bfloat16,
+    "float16": torch.float16,
+    "fp16": torch.float16,
+}
+
+PRECISIONS = ("float32", "bfloat16", "int8")
+
+
+def _resolve_device(device) -> torch.device:
+    if isinstance(device, torch.device):
+        return device
+    if not device or str(device).lower() == "auto":
+        return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    return torch.device(device)
+
+
+def _resolve_precision(precision) -> str:
+    key = str(precision or "float32").lower()
+    key = {"fp32": "float32", "bf16": "bfloat16", "qint8": "int8"}.get(key, key)
+    if key not in PRECISIONS:
+        raise ValueError(f"Unsupported inference precision: {precision}")
+    return key
+
+
+def parse_layer_weights(spec) -> Optional[Dict[int, float]]:
+    # "" / "last" -> last_hidden_state, "6" -> layer 6, "4:0.5,6:0.5" -> weighted mean of layers 4 and 6
+    if spec is None or isinstance(spec, dict):
+        return spec or None
+    spec = str(spec).strip().lower()
+    if not spec or spec == "last":
+        return None
+    weights: Dict[int, float] = {}
+    for part in spec.split(","):
+        layer, _, weight = part.strip().partition(":")
+        weights[int(layer)] = float(weight) if weight else 1.0
+    if sum(weights.values()) <= 0:
+        raise ValueError(f"Layer weights must sum to a positive value: {spec}")
+    return weights
+
+
+def _resolve_dtype(dtype) -> torch.dtype:
+    if isinstance(dtype, torch.dtype):
+        return dtype
+    key = str(dtype or "float32").lower()
+    if key not in _DTYPES:
+        raise ValueError(f"Unsupported model dtype: {dtype}")
+    return _DTYPES[key]
+
+
+class ModelRegistry:
+    def __init__(self, model_id: str = MERT_MODEL_ID, device=MODEL_DEVICE, dtype=MODEL_DTYPE,
+                 precision: str = MODEL_PRECISION, num_layers: Optional[int] = MODEL_NUM_LAYERS,
+                 layers=EMBED_LAYERS):
+        self.model_id = model_id
+        self.device = _resolve_device(device)
+        self.dtype = _resolve_dtype(dtype)
+        self.precision = _resolve_precision(precision)
+        self.num_layers = int(num_layers) if num_layers else None
+        self.layer_weights = parse_layer_weights(layers)
+        self.load_seconds: Optional[float] = None
+        self._processor = None
+        self._model = None
+        self._lock = threading.Lock()
+
+    def configure(self, device=None, dtype=None, model_id: Optional[str] = None, precision: Optional[str] = None,
+                  num_layers: Optional[int] = None, layers=None) -> None:
+        with self._lock:
+            if self._model is not None:
+                raise RuntimeError("Model already loaded; configure() must be called before first use")
+            if model_id:
+                self.model_id = model_id
+            if device is not None:
+                self.device = _resolve_device(device)
+            if dtype is not None:
+                self.dtype = _resolve_dtype(dtype)
+            if precision is not None:
+                self.precision = _resolve_precision(precision)
+            if num_layers is not None:
+                self.num_layers = int(num_layers) or None
+            if layers is not None:
+                self.layer_weights = parse_layer_weights(layers)
+
+    @property
+    def embedding_id(self) -> str:
+        # identifies the vector space produced; equals model_id for the default full-depth float32 setup
+        parts = [self.model_id]
+        if self.num_layers:
+            parts.append(f"depth={self.num_layers}")
+        if self.layer_weights:
+            parts.append("layers=" + ",".join(f"{k}:{v:g}" for k, v in sorted(self.layer_weights.items())))
+        if self.precision != "float32":
+            parts.append(self.precision)
+        return "|".join(parts)
+
+    def is_ready(self) -> bool:
+        return self._model is not None
+
+    def get(self) -> Tuple[Any, Any]:
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._load()
+        return self._processor, self._model
+
+    @property
+    def processor(self):
+        return self.get()[0]
+
+    @property
+    def model(self):
+        return self.get()[1]
+
+    def _load(self) -> None:
+        from transformers import AutoProcessor, AutoModel
+
+        start = time.time()
+        processor = AutoProcessor.from_pretrained(self.model_id, trust_remote_code=True, use_fast=False)
+        model = AutoModel.from_pretrained(self.model_id, trust_remote_code=True)
+        if self.num_layers:
+            self._truncate(model, self.num_layers)
+        if self.layer_weights:
+            top = self.num_layers or model.config.num_hidden_layers
+            bad = [k for k in self.layer_weights if k < 0 or k > top]
+            if bad:
+                raise ValueError(f"Embedding layers {bad} outside 0..{top}")
+        if self.precision == "int8":
+            # dynamic quantization only exists for float32 linear layers on CPU
+            if self.device.type != "cpu":
+                raise RuntimeError("int8 precision is only supported on CPU")
+            self.dtype = torch.float32
+            model.eval()
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        else:
+            model = model.to(device=self.device, dtype=self.dtype)
+        model.eval()
+        self._processor = processor
+        self._model = model
+        self.load_seconds = time.time() - start
+        logger.info(f"Loaded {self.model_id} on {self.device} ({self.dtype}, precision={self.precision}) "
+                    f"in {self.load_seconds:.3f}s")
+
+    @staticmethod
+    def _truncate(model, n: int) -> None:
+        # drop the transformer layers above n so the forward pass stops there
+        layers = model.encoder.layers
+        if n > len(layers):
+            raise ValueError(f"Model has {len(layers)} layers; cannot keep {n}")
+        model.encoder.layers = torch.nn.ModuleList(list(layers)[:n])
+        model.config.num_hidden_layers = n
+
+    def inference_context(self):
+        stack = contextlib.ExitStack()
+        stack.enter_context(torch.no_grad())
+        if self.precision == "bfloat16":
+            stack.enter_context(torch.autocast(device_type=self.device.type, dtype=torch.bfloat16))
+        return stack
+
+    def warm_up(self, seconds: float = 1.0) -> float:
+        processor, model = self.get()
+        start = time.time()
+        audio = torch.zeros(int(seconds * TARGET_SAMPLING_RATE)).numpy()
+        with self.inference_context():
+            inputs = processor(raw_speech=audio, sampling_rate=TARGET_SAMPLING_RATE, return_tensors="pt")
+            model(**self.to_model_inputs(inputs))
+        duration = time.time() - start
+        logger.info(f"Model warm-up took {duration:.3f}s")
+        return duration
+
+    def to_model_inputs(self, inputs) -> dict:
+        out = {}
+        for k, v in inputs.items():
+            if torch.is_floating_point(v):
+                out[k] = v.to(device=self.device, dtype=self.dtype)
+            else:
+                out[k] = v.to(self.device)
+        return out
+
+
+_registry = ModelRegistry()
+
+
+def get_registry() -> ModelRegistry:
+    return _registry
@@ -0,0 +1,109 @@
+﻿import queue
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+from logger import logger
+
+_DONE = object()
+
+Job = Dict[str, Any]
+StageFn = Callable[[Job, Any], Any]
+ErrorFn = Callable[[Job, Exception], None]
+
+
+class _Stage:
+    def __init__(self, name: str, fn: StageFn, workers: int, in_q: queue.Queue, out_q: queue.Queue, on_error: ErrorFn):
+        self.name = name
+        self.fn = fn
+        self.in_q = in_q
+        self.out_q = out_q
+        self.on_error = on_error
+        self.threads = [
+            threading.Thread(target=self._work, name=f"{name}-{i}", daemon=True)
+            for i in range(max(1, int(workers)))
+        ]
+        self._closer = threading.Thread(target=self._close, name=f"{name}-closer", daemon=True)
+
+    def start(self) -> None:
+        for t in self.threads:
+            t.start()
+        self._closer.start()
+
+    def _work(self) -> None:
+        while True:
+            item = self.in_q.get()
+            if item is _DONE:
+                # hand the sentinel on to sibling workers
+                self.in_q.put(_DONE)
+                return
+            job, payload = item
+            try:
+                result = self.fn(job, payload)
+            except Exception as e:
+                self.on_error(job, e)
+                continue
+            # blocks while the downstream queue is full (backpressure)
+            self.out_q.put((job, result))
+
+    def _close(self) -> None:
+        for t in self.threads:
+            t.join()
+        self.out_q.put(_DONE)
+
+
+def _next_batch(q: queue.Queue, max_items: int) -> Tuple[List[Tuple[Job, Any]], bool]:
+    item = q.get()
+    if item is _DONE:
+        return [], True
+    batch = [item]
+    while len(batch) < max_items:
+        try:
+            item = q.get_nowait()
+        except queue.Empty:
+            break
+        if item is _DONE:
+            return batch, True
+        batch.append(item)
+    return batch, False
+
+
+def run_pipeline(
+        jobs: Iterable[Job],
+        fetch: StageFn,
+        prep: StageFn,
+        consume: Callable[[List[Tuple[Job, Any]]], int],
+        on_error: ErrorFn,
+        io_workers: int = 4,
+        prep_workers: int = 2,
+        queue_size: int = 8,
+        batch_size: int = 4,
+) -> int:
+    jobs_q: queue.Queue = queue.Queue()
+    fetched_q: queue.Queue = queue.Queue(maxsize=max(1, queue_size))
+    prepped_q: queue.Queue = queue.Queue(maxsize=max(1, queue_size))
+
+    for job in jobs:
+        jobs_q.put((job, None))
+    jobs_q.put(_DONE)
+
+    stages = [
+        _Stage("fetch", fetch, io_workers, jobs_q, fetched_q, on_error),
+        _Stage("prep", prep, prep_workers, fetched_q, prepped_q, on_error),
+    ]
+    for s in stages:
+        s.start()
+
+    # inference runs on the calling thread so the model is only ever used from one place
+    processed = 0
+    done = False
+    while not done:
+        batch, done = _next_batch(prepped_q, max(1, batch_size))
+        if not batch:
+            continue
+        try:
+            processed += consume(batch)
+        except Exception as e:
+            logger.error(f"Inference batch of {len(batch)} failed: {e}")
+            for job, _ in batch:
+                on_error(job, e)
+    return processed
@@ -0,0 +1,376 @@
+﻿import io
+import os
+import sys
+import json
+import time
+import wave
+import zlib
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import urllib.request
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows: peak RSS comes from psutil when it is installed
+    resource = None
+
+# config, db and main are imported inside run_benchmark: DB_BACKEND / SQLITE_PATH must point at the
+# benchmark's own SQLite file before config.py reads them, so a run never touches the real database
+
+STAGES = ("claim", "fetch", "prep", "embed", "index")
+
+
+def synth_clip(seconds: float, sample_rate: int, channels: int, rng) -> np.ndarray:
+    # a few detuned harmonic voices with a beat envelope plus noise; int16 frames x channels
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    audio = np.zeros_like(t)
+    for _ in range(4):
+        f0 = rng.uniform(55, 880)
+        for h in range(1, 4):
+            audio += np.sin(2 * np.pi * f0 * h * t + rng.uniform(0, 2 * np.pi)) / h
+    bpm = rng.uniform(70, 160)
+    audio *= 0.6 + 0.4 * np.abs(np.sin(np.pi * bpm / 60 * t))
+    audio += rng.normal(0, 0.05, len(t))
+    audio /= np.abs(audio).max() + 1e-9
+    frames = np.repeat(audio[:, None], channels, axis=1) * rng.uniform(0.9, 1.0, channels)
+    return (frames * 0.8 * 32767).astype("<i2")
+
+
+def write_wav(path: str, frames: np.ndarray, sample_rate: int) -> None:
+    with wave.open(path, "wb") as w:
+        w.setnchannels(frames.shape[1])
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        w.writeframes(frames.tobytes())
+
+
+def make_clips(folder: str, n: int, seconds: float, sample_rate: int, channels: int, seed: int = 0) -> List[str]:
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(n):
+        path = os.path.join(folder, f"clip_{i:03d}.wav")
+        write_wav(path, synth_clip(seconds, sample_rate, channels, rng), sample_rate)
+        paths.append(path)
+    return paths
+
+
+class ClipServer:
+    # serves /<anything>.wav from a small set of synthetic clips, picked by a hash of the name
+    def __init__(self, clips: List[str], host: str = "127.0.0.1", port: int = 0):
+        blobs = []
+        for p in clips:
+            with open(p, "rb") as f:
+                blobs.append(f.read())
+
+        class Handler(SimpleHTTPRequestHandler):
+            def do_GET(self):
+                name = self.path.rsplit("/", 1)[-1].split("?", 1)[0]
+                body = blobs[zlib.crc32(name.encode()) % len(blobs)]
+                self.send_response(200)
+                self.send_header("Content-Type", "audio/wav")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_address[1]}"
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="clip-server", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class StageTimer:
+    # wall seconds per call for each wrapped stage; fetch/prep are per track, claim/embed/index per batch
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {s: [] for s in STAGES}
+        self.items: Dict[str, int] = {s: 0 for s in STAGES}
+        self.last_claimed = None
+        self._lock = threading.Lock()
+
+    def wrap(self, stage: str, fn: Callable, count: Callable[[tuple, Any], int] = None) -> Callable:
+        def timed(*args, **kwargs):
+            t = time.perf_counter()
+            out = fn(*args, **kwargs)
+            seconds = time.perf_counter() - t
+            n = count(args, out) if count else 1
+            with self._lock:
+                self.samples[stage].append(seconds)
+                self.items[stage] += n
+                if stage == "claim":
+                    self.last_claimed = n
+            return out
+
+        return timed
+
+    def reset(self) -> None:
+        with self._lock:
+            for s in STAGES:
+                self.samples[s] = []
+                self.items[s] = 0
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        out = {}
+        for s in STAGES:
+            xs = np.asarray(self.samples[s])
+            if not len(xs):
+                continue
+            out[s] = {
+                "calls": int(len(xs)),
+                "items": int(self.items[s]),
+                "total_s": round(float(xs.sum()), 3),
+                "mean_ms": round(float(xs.mean()) * 1000, 2),
+                "p50_ms": round(float(np.percentile(xs, 50)) * 1000, 2),
+                "p95_ms": round(float(np.percentile(xs, 95)) * 1000, 2),
+            }
+        return out
+
+
+def _http_wav(url: str, start_s: int, dur_s: int):
+    # int16 frames x channels of the requested segment, and the clip's sample rate
+    with urllib.request.urlopen(url, timeout=60) as r, wave.open(io.BytesIO(r.read())) as w:
+        sr, channels = w.getframerate(), w.getnchannels()
+        w.setpos(min(w.getnframes(), int(start_s * sr)))
+        frames = w.readframes(int(dur_s * sr) if dur_s and dur_s > 0 else w.getnframes())
+    return np.frombuffer(frames, dtype="<i2").reshape(-1, channels), sr
+
+
+def _http_clip_to_tensor(media_url: str, headers: Dict[str, str], start_s: int, dur_s: int):
+    # stand-in for stream_clip_to_tensor without ffmpeg: mono float32 at TARGET_SAMPLING_RATE
+    import torch
+    from config import TARGET_SAMPLING_RATE
+    from audio_preparation import get_resampler
+
+    frames, sr = _http_wav(media_url, start_s, dur_s)
+    waveform = torch.from_numpy(frames.mean(axis=1, dtype="float32") / 32768.0).unsqueeze(0)
+    if sr != TARGET_SAMPLING_RATE:
+        waveform = get_resampler(sr)(waveform)
+    return waveform.contiguous()
+
+
+def _http_clip_to_temp_wav(media_url: str, headers: Dict[str, str], start_s: int, dur_s: int) -> str:
+    frames, sr = _http_wav(media_url, start_s, dur_s)
+    fd, tmp_path = tempfile.mkstemp(suffix=".wav")
+    os.close(fd)
+    write_wav(tmp_path, frames, sr)
+    return tmp_path
+
+
+def _usage() -> Dict[str, float]:
+    t = os.times()
+    return {"wall": time.perf_counter(), "cpu": t.user + t.system, "children_cpu": t.children_user + t.children_system}
+
+
+def _peak_rss_mb() -> Optional[float]:
+    # ru_maxrss is KiB on Linux, bytes on macOS; not reported for ffmpeg, a forked child inherits the parent's peak
+    if resource is not None:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+    try:
+        import psutil
+    except ImportError:
+        return None
+    mem = psutil.Process().memory_info()
+    return round(getattr(mem, "peak_wset", mem.rss) / (1024 * 1024), 1)  # peak working set on Windows
+
+
+def _git_commit(repo_dir: str) -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "-C", repo_dir, "rev-parse", "--short", "HEAD"], capture_output=True, text=True)
+        dirty = subprocess.run(["git", "-C", repo_dir, "status", "--porcelain", "--untracked-files=no"],
+                               capture_output=True, text=True).stdout.strip()
+        return out.stdout.strip() + ("-dirty" if dirty else "") if out.returncode == 0 else None
+    except OSError:
+        return None
+
+
+def run_benchmark(workdir: str, tracks: int = 64, clip_seconds: float = 30.0, sample_rate: int = 44100,
+                  channels: int = 2, distinct_clips: int = 8, use_ffmpeg: Optional[bool] = None,
+                  warmup_batches: int = 1, model_opts: Optional[dict] = None) -> Dict[str, Any]:
+    commit = _git_commit(os.path.dirname(os.path.abspath(__file__)))
+    os.makedirs(workdir, exist_ok=True)
+    workdir = os.path.abspath(workdir)
+    os.environ["DB_BACKEND"] = "sqlite"
+    os.environ["SQLITE_PATH"] = os.path.join(workdir, "ums.sqlite3")
+    if "config" in sys.modules and sys.modules["config"].SQLITE_PATH != os.environ["SQLITE_PATH"]:
+        raise RuntimeError("config was imported before run_benchmark; run pipeline_benchmark.py as a script")
+    # index, mapping, embedding cache and logs are relative paths: keep them all inside the workdir
+    os.chdir(workdir)
+
+    import config
+    import db_sqlite
+    import main
+    from model_registry import get_registry
+    from index_writer import IndexWriter
+
+    if use_ffmpeg is None:
+        use_ffmpeg = shutil.which("ffmpeg") is not None
+    clips = make_clips(os.path.join(workdir, "clips"), distinct_clips, clip_seconds, sample_rate, channels)
+
+    with ClipServer(clips) as server:
+        # the first claims (warm-up) use BATCH_LIMIT rows each; seed those on top of the timed tracks
+        seeded = db_sqlite.seed_fake_data(tracks + warmup_batches * config.BATCH_LIMIT,
+                                          url_template=server.url + "/{source_id}.wav")
+        with db_sqlite.get_conn() as conn:
+            # the whole synthetic clip is the track, so compute_segment starts at 0 instead of seeking past the end
+            conn.execute("UPDATE Tracks SET duration_sec = ?, start_s = NULL, dur_s = NULL", (int(clip_seconds),))
+
+        registry = get_registry()
+        registry.configure(**(model_opts or {}))
+        registry.warm_up()
+
+        timer = StageTimer()
+        main.resolve_youtube_media = lambda url: (url, {})  # source_url already points at the clip server
+        if not use_ffmpeg:
+            main.stream_clip_to_tensor = _http_clip_to_tensor
+            main.stream_clip_to_temp_wav = _http_clip_to_temp_wav
+        main.fetch_jobs = timer.wrap("claim", main.fetch_jobs, lambda args, jobs: len(jobs))
+        main._fetch_job = timer.wrap("fetch", main._fetch_job)
+        main._prep_job = timer.wrap("prep", main._prep_job)
+        main.embed_waveforms = timer.wrap("embed", main.embed_waveforms, lambda args, vecs: len(args[0]))
+        commit_batch = IndexWriter.commit_batch
+        IndexWriter.commit_batch = timer.wrap("index", commit_batch, lambda args, n: len(args[1]))
+
+        try:
+            main.get_index_store()
+            for _ in range(warmup_batches):
+                main.embed_from_db_once()
+            warm = timer.items["fetch"]
+            timer.reset()
+
+            before = _usage()
+            processed = 0
+            while True:
+                processed += main.embed_from_db_once()
+                if not timer.last_claimed:
+                    break
+            after = _usage()
+        finally:
+            IndexWriter.commit_batch = commit_batch
+
+    wall = after["wall"] - before["wall"]
+    cpu = after["cpu"] - before["cpu"]
+    # os.times() has no child CPU on Windows (always 0): report it as unknown instead of as idle ffmpeg
+    children_cpu = after["children_cpu"] - before["children_cpu"] if os.name != "nt" else None
+    used = cpu + (children_cpu or 0.0)
+    cores = os.cpu_count() or 1
+    audio_s = processed * clip_seconds
+    peak_rss = _peak_rss_mb()
+    notes = []
+    if children_cpu is None:
+        notes.append("children_cpu_s is not measurable on Windows; cpu_util covers this process only, not ffmpeg")
+    if peak_rss is None:
+        notes.append("peak_rss_mb needs the resource module or psutil")
+    return {
+        "commit": commit,
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpu_count": cores},
+        "setup": {
+            "tracks": tracks, "warmup_tracks": warm, "clip_seconds": clip_seconds, "sample_rate": sample_rate,
+            "channels": channels, "distinct_clips": distinct_clips, "fetch": "ffmpeg" if use_ffmpeg else "http-wav",
+            "model": registry.embedding_id, "model_load_s": registry.load_seconds,
+            "seeded": seeded,
+        },
+        "config": {k: getattr(config, k) for k in (
+            "BATCH_LIMIT", "CLAIM_SCHEDULER", "YT_CLIP_SECONDS", "YT_STREAM_PCM", "EMBED_BATCH_SIZE",
+            "PIPELINE_IO_WORKERS", "PIPELINE_PREP_WORKERS", "PIPELINE_QUEUE_SIZE", "PIPELINE_INFER_TRACKS",
+            "FAISS_INDEX_TYPE", "FAISS_SHARDED", "EMBED_CACHE_ENABLED",
+        )},
+        "results": {
+            "processed": processed,
+            "status": db_sqlite.table_counts()["status"],
+            "wall_s": round(wall, 3),
+            "tracks_per_s": round(processed / wall, 3) if wall > 0 else None,
+            "audio_x_realtime": round(audio_s / wall, 2) if wall > 0 else None,
+            "cpu_s": round(cpu, 2),
+            "children_cpu_s": round(children_cpu, 2) if children_cpu is not None else None,
+            "cpu_util": round(used / wall, 2) if wall > 0 else None,  # 1.0 = one core busy
+            "cpu_util_of_host": round(used / wall / cores, 3) if wall > 0 else None,
+            "cpu_util_includes_children": children_cpu is not None,
+            "peak_rss_mb": peak_rss,  # whole process, model load included
+            "stages": timer.summary(),
+        },
+        "notes": notes,
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> Dict[str, Any]:
+    # current / baseline for throughput and each stage's latency percentiles
+    def ratio(a, b):
+        return round(a / b, 3) if a is not None and b else None
+
+    cur, base = current["results"], baseline["results"]
+    out = {"baseline_commit": baseline.get("commit"), "tracks_per_s": ratio(cur["tracks_per_s"], base["tracks_per_s"]),
+           "peak_rss_mb": ratio(cur["peak_rss_mb"], base["peak_rss_mb"]), "stages": {}}
+    for stage, stats in cur["stages"].items():
+        old = base["stages"].get(stage)
+        if old:
+            out["stages"][stage] = {p: ratio(stats[p], old[p]) for p in ("p50_ms", "p95_ms")}
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end embed throughput on synthetic audio and a local SQLite DB")
+    parser.add_argument("--tracks", type=int, default=64, help="timed tracks (warm-up batches are claimed on top)")
+    parser.add_argument("--clip-seconds", type=float, default=30.0)
+    parser.add_argument("--sample-rate", type=int, default=44100, help="rate of the served clips (resampled on prep)")
+    parser.add_argument("--channels", type=int, default=2)
+    parser.add_argument("--distinct-clips", type=int, default=8, help="synthetic clips the file server rotates through")
+    parser.add_argument("--fetch", choices=("auto", "ffmpeg", "http"), default="auto",
+                        help="ffmpeg reads the clip server like a media URL; http decodes the WAV in-process")
+    parser.add_argument("--warmup-batches", type=int, default=1, help="claim cycles run before timing starts")
+    parser.add_argument("--workdir", default=None, help="keep the DB, index and clips here (default: a temp dir)")
+    parser.add_argument("--out", default=None, help="write the results JSON here")
+    parser.add_argument("--baseline", default=None, help="earlier results JSON to compare against")
+    parser.add_argument("--device", default=None, help="e.g., cpu, cuda, cuda:1 (default: MODEL_DEVICE)")
+    parser.add_argument("--dtype", default=None, help="float32, bfloat16 or float16 (default: MODEL_DTYPE)")
+    parser.add_argument("--precision", default=None, help="float32, bfloat16 or int8 (default: MODEL_PRECISION)")
+    parser.add_argument("--num-layers", type=int, default=None, help="stop after N transformer layers")
+    parser.add_argument("--layers", default=None, help='pooled layers, e.g. "last", "6" or "4:0.5,6:0.5"')
+    args = parser.parse_args()
+
+    out = os.path.abspath(args.out) if args.out else None
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    model_opts = dict(device=args.device, dtype=args.dtype, precision=args.precision,
+                      num_layers=args.num_layers, layers=args.layers)
+    use_ffmpeg = None if args.fetch == "auto" else args.fetch == "ffmpeg"
+
+    tmp = None if args.workdir else tempfile.mkdtemp(prefix="embed-bench-")
+    try:
+        report = run_benchmark(
+            args.workdir or tmp, tracks=args.tracks, clip_seconds=args.clip_seconds, sample_rate=args.sample_rate,
+            channels=args.channels, distinct_clips=args.distinct_clips, use_ffmpeg=use_ffmpeg,
+            warmup_batches=args.warmup_batches, model_opts=model_opts,
+        )
+    finally:
+        if tmp:
+            os.chdir(os.path.dirname(os.path.abspath(__file__)))
+            shutil.rmtree(tmp, ignore_errors=True)
+    if baseline:
+        report["vs_baseline"] = compare(report, baseline)
+    if out:
+        with open(out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
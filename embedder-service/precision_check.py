@@ -0,0 +1,95 @@
+﻿import os
+import sys
+import json
+import time
+import argparse
+from typing import List, Tuple
+
+import numpy as np
+
+from config import AUDIO_PATH
+from logger import logger
+from audio_preparation import embed_waveforms
+from model_registry import ModelRegistry
+from faiss_index import load_index
+from preprocess import load_and_prep_files
+
+AUDIO_EXTS = (".wav", ".mp3", ".flac", ".ogg", ".m4a")
+
+
+def _reference_files(folder: str, limit: int) -> List[str]:
+    files = sorted(
+        os.path.join(folder, f) for f in os.listdir(folder)
+        if f.lower().endswith(AUDIO_EXTS)
+    )
+    return files[:limit] if limit > 0 else files
+
+
+def _embed(registry: ModelRegistry, waveforms) -> Tuple[np.ndarray, float]:
+    registry.get()
+    start = time.time()
+    vecs = embed_waveforms(waveforms, registry=registry)
+    return vecs, time.time() - start
+
+
+def _normalize(x: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (x / norms).astype("float32")
+
+
+def run_check(folder: str, precision: str, limit: int = 50, k: int = 10) -> dict:
+    files = _reference_files(folder, limit)
+    if not files:
+        raise SystemExit(f"No reference audio in {folder}")
+    waveforms = load_and_prep_files(files)
+
+    base_vecs, base_s = _embed(ModelRegistry(precision="float32"), waveforms)
+    cand_vecs, cand_s = _embed(ModelRegistry(precision=precision), waveforms)
+
+    a, b = _normalize(base_vecs), _normalize(cand_vecs)
+    drift = 1.0 - np.sum(a * b, axis=1)
+    report = {
+        "precision": precision,
+        "tracks": len(files),
+        "baseline_seconds": round(base_s, 3),
+        "candidate_seconds": round(cand_s, 3),
+        "speedup": round(base_s / cand_s, 3) if cand_s > 0 else None,
+        "cosine_drift_mean": float(drift.mean()),
+        "cosine_drift_p95": float(np.percentile(drift, 95)),
+        "cosine_drift_max": float(drift.max()),
+        "topk": k,
+        "topk_overlap_mean": None,
+    }
+
+    index = load_index()
+    if index.ntotal > 0:
+        kk = min(k, index.ntotal)
+        _, ia = index.search(a, kk)
+        _, ib = index.search(b, kk)
+        overlap = [len(set(x.tolist()) & set(y.tolist())) / kk for x, y in zip(ia, ib)]
+        report["topk"] = kk
+        report["topk_overlap_mean"] = float(np.mean(overlap))
+        report["topk_overlap_min"] = float(np.min(overlap))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--precision", required=True, help="bfloat16 or int8")
+    parser.add_argument("--reference", default=AUDIO_PATH, help="folder with reference audio files")
+    parser.add_argument("--limit", type=int, default=50, help="max reference tracks (0 = all)")
+    parser.add_argument("--k", type=int, default=10, help="neighbours compared against the existing index")
+    parser.add_argument("--max-drift", type=float, default=0.01, help="fail if mean 1-cos exceeds this")
+    parser.add_argument("--min-overlap", type=float, default=0.9, help="fail if mean top-k overlap is below this")
+    args = parser.parse_args()
+
+    result = run_check(args.reference, args.precision, limit=args.limit, k=args.k)
+    ok = result["cosine_drift_mean"] <= args.max_drift and (
+        result["topk_overlap_mean"] is None or result["topk_overlap_mean"] >= args.min_overlap
+    )
+    result["passed"] = ok
+    print(json.dumps(result, indent=2))
+    if not ok:
+        logger.error(f"Precision {args.precision} failed the accuracy gate")
+        sys.exit(1)
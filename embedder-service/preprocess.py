@@ -0,0 +1,131 @@
+﻿import os
+import time
+import contextlib
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+import torchaudio
+
+from config import AUDIO_PATH, TARGET_SAMPLING_RATE, PREP_BATCH_SIZE
+from logger import logger
+from audio_preparation import get_resampler, denoise
+
+
+def _pad_stack(waveforms: Sequence[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+    lengths = torch.tensor([w.size(-1) for w in waveforms])
+    batch = torch.zeros(len(waveforms), int(lengths.max()), dtype=waveforms[0].dtype)
+    for i, w in enumerate(waveforms):
+        batch[i, :w.size(-1)] = w.reshape(-1)
+    return batch, lengths
+
+
+def trim_silence_batch(batch: torch.Tensor, lengths: torch.Tensor, top_db: float = 60.0) -> Tuple[torch.Tensor, torch.Tensor]:
+    # [start, end) per row with the same rules as trim_silence_torch
+    abs_b = batch.abs()
+    n = batch.size(1)
+    max_amp = abs_b.max(dim=1).values
+    threshold = max_amp * (10 ** (-top_db / 20.0))
+    above = abs_b > threshold[:, None]
+    any_above = above.any(dim=1)
+    first = above.to(torch.uint8).argmax(dim=1)
+    last = n - 1 - above.flip(1).to(torch.uint8).argmax(dim=1)
+
+    silent = max_amp == 0
+    starts = torch.where(any_above & ~silent, first, torch.zeros_like(first))
+    ends = torch.where(silent, lengths, torch.where(any_above, last + 1, torch.ones_like(last)))
+    return starts, ends
+
+
+def normalize_loudness_batch(batch: torch.Tensor, starts: torch.Tensor, ends: torch.Tensor,
+                             target_d_bfs: float = -23.0) -> torch.Tensor:
+    # per-row gain over [start, end) with the same rules as normalize_loudness
+    idx = torch.arange(batch.size(1))[None, :]
+    seg = (idx >= starts[:, None]) & (idx < ends[:, None])
+    power = (batch.pow(2) * seg).sum(dim=1) / (ends - starts).clamp(min=1).to(batch.dtype)
+    current_dBFS = 20 * torch.log10(power.sqrt() + 1e-9)
+    gain = target_d_bfs - current_dBFS
+    return 10 ** (gain / 20)
+
+
+class PreprocessEngine:
+    def __init__(self, do_denoise: bool = False, top_db: float = 60.0, target_d_bfs: float = -23.0):
+        self.do_denoise = do_denoise
+        self.top_db = top_db
+        self.target_d_bfs = target_d_bfs
+        self.step_seconds: Dict[str, float] = defaultdict(float)
+        self.clips = 0
+
+    @contextlib.contextmanager
+    def _timed(self, step: str):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.step_seconds[step] += time.time() - start
+
+    def prep_batch(self, items: Sequence[Tuple[torch.Tensor, int]]) -> List[torch.Tensor]:
+        if not items:
+            return []
+
+        with self._timed("resample"):
+            waves = []
+            for waveform, sr in items:
+                if sr != TARGET_SAMPLING_RATE:
+                    waveform = get_resampler(sr)(waveform)
+                waves.append(waveform)
+
+        with self._timed("mono"):
+            waves = [w.mean(dim=0, keepdim=True) if w.size(0) > 1 else w for w in waves]
+
+        with self._timed("trim"):
+            batch, lengths = _pad_stack(waves)
+            starts, ends = trim_silence_batch(batch, lengths, top_db=self.top_db)
+
+        with self._timed("loudness"):
+            gains = normalize_loudness_batch(batch, starts, ends, target_d_bfs=self.target_d_bfs)
+            out = [
+                (batch[i, int(starts[i]):int(ends[i])] * gains[i]).unsqueeze(0)
+                for i in range(batch.size(0))
+            ]
+
+        if self.do_denoise:
+            with self._timed("denoise"):
+                out = [denoise(w, TARGET_SAMPLING_RATE) for w in out]
+
+        self.clips += len(out)
+        return out
+
+    def load_and_prep_batch(self, paths: Sequence[str]) -> List[torch.Tensor]:
+        with self._timed("load"):
+            items = [torchaudio.load(p) for p in paths]
+        return self.prep_batch(items)
+
+    def report(self) -> Dict[str, float]:
+        total = sum(self.step_seconds.values())
+        per_clip = {f"{k}_ms_per_clip": 1000.0 * v / max(1, self.clips) for k, v in self.step_seconds.items()}
+        return {"clips": self.clips, "total_seconds": round(total, 3),
+                **{k: round(v, 3) for k, v in per_clip.items()}}
+
+
+def load_and_prep_files(paths: Sequence[str], engine: Optional[PreprocessEngine] = None,
+                        batch_size: int = PREP_BATCH_SIZE) -> List[torch.Tensor]:
+    # load_and_prep for a whole folder of local audio, batch_size clips per prep_batch
+    engine = engine if engine is not None else PreprocessEngine()
+    out: List[torch.Tensor] = []
+    for i in range(0, len(paths), batch_size):
+        out += engine.load_and_prep_batch(paths[i:i + batch_size])
+    return out
+
+
+if __name__ == "__main__":
+    import sys
+
+    folder = sys.argv[1] if len(sys.argv) > 1 else AUDIO_PATH
+    paths = sorted(
+        os.path.join(folder, f) for f in os.listdir(folder)
+        if f.lower().endswith((".wav", ".mp3", ".flac", ".ogg", ".m4a"))
+    )
+    engine = PreprocessEngine(do_denoise=False)
+    load_and_prep_files(paths, engine)
+    logger.info(f"Preprocess report ({folder}): {engine.report()}")
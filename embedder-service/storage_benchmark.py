@@ -0,0 +1,123 @@
+﻿import os
+import json
+import time
+import argparse
+import tempfile
+
+import faiss
+import numpy as np
+
+from config import FAISS_SHARD_DIR, FAISS_PQ_M, FAISS_PQ_BITS, FAISS_IVF_NLIST, FAISS_REFINE_K_FACTOR
+from faiss_index import INDEX_TYPES, create_index, needs_training, apply_search_params, describe_index
+from knn_graph import _export_index, _export_shards
+
+
+def _recall(found: np.ndarray, truth: np.ndarray) -> float:
+    k = truth.shape[1]
+    return float(np.mean([len(set(a) & set(b)) / k for a, b in zip(found.tolist(), truth.tolist())]))
+
+
+def _build(kind: str, vecs: np.ndarray, train_size: int, rng, **params):
+    index = create_index(kind, dim=vecs.shape[1], **params)
+    if needs_training(kind):
+        n = len(vecs)
+        index.train(vecs if n <= train_size else vecs[np.sort(rng.choice(n, train_size, replace=False))])
+    for i in range(0, len(vecs), 65536):
+        index.add(np.ascontiguousarray(vecs[i:i + 65536]))
+    return index
+
+
+def _resident_bytes(index, file_bytes: int) -> int:
+    # what a mapped searcher keeps hot: for pq_refine only the codes, the float32 rows are read per candidate
+    base = faiss.downcast_index(index)
+    if isinstance(base, faiss.IndexRefine):
+        return len(faiss.serialize_index(base.base_index))
+    return file_bytes
+
+
+def run_benchmark(kinds, source: str = "index", k: int = 10, queries: int = 1000, train_size: int = 100000,
+                  latency_queries: int = 200, mmap: bool = True, k_factor: int = FAISS_REFINE_K_FACTOR,
+                  **params) -> list:
+    ids, vecs = _export_shards(FAISS_SHARD_DIR) if source == "shards" else _export_index()
+    vecs = np.ascontiguousarray(vecs, dtype="float32")
+    n, d = vecs.shape if len(ids) else (0, 0)
+    if n <= k:
+        raise SystemExit(f"Need more than k={k} vectors, found {n}")
+    rng = np.random.default_rng(0)
+    q = np.ascontiguousarray(vecs[rng.choice(n, min(queries, n), replace=False)])
+
+    # ground truth: exact inner product over the catalog as stored
+    exact = faiss.IndexFlatIP(d)
+    exact.add(vecs)
+    _, truth = exact.search(q, k)
+    del exact
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for kind in kinds:
+            t = time.time()
+            index = _build(kind, vecs, train_size, rng, **params)
+            build_s = time.time() - t
+
+            path = os.path.join(tmp, f"{kind}.index")
+            faiss.write_index(index, path)
+            file_bytes = os.path.getsize(path)
+            resident = _resident_bytes(index, file_bytes)
+            if mmap:
+                # searched the way search-engine opens it: mapped read-only
+                flag = faiss.IO_FLAG_MMAP if kind.startswith("ivf") else faiss.IO_FLAG_MMAP_IFC
+                del index
+                index = faiss.read_index(path, flag | faiss.IO_FLAG_READ_ONLY)
+            apply_search_params(index, k_factor=k_factor)
+
+            t = time.perf_counter()
+            _, found = index.search(q, k)
+            batch_s = time.perf_counter() - t
+
+            lat = []
+            for row in q[:latency_queries]:
+                t = time.perf_counter()
+                index.search(row[None, :], k)
+                lat.append(time.perf_counter() - t)
+
+            results.append({
+                "type": describe_index(index),
+                "n": int(n),
+                "dim": int(d),
+                "bytes_per_vector": round(file_bytes / n, 1),
+                "resident_bytes_per_vector": round(resident / n, 1),
+                "compression_vs_flat": round(4 * d / (resident / n), 2),
+                f"recall@{k}": round(_recall(found, truth), 4),
+                "qps_batch": round(len(q) / batch_s, 1),
+                "latency_p50_ms": round(float(np.percentile(lat, 50)) * 1000, 3),
+                "latency_p95_ms": round(float(np.percentile(lat, 95)) * 1000, 3),
+                "build_seconds": round(build_s, 2),
+            })
+            del index
+            os.remove(path)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--types", default="flat,fp16,sq8,pq_refine", help=f"comma-separated, from {INDEX_TYPES}")
+    parser.add_argument("--source", default="index", choices=("index", "shards"))
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=1000, help="catalog vectors used as queries")
+    parser.add_argument("--latency-queries", type=int, default=200, help="queries also timed one at a time")
+    parser.add_argument("--train-size", type=int, default=100000)
+    parser.add_argument("--no-mmap", action="store_true", help="search the in-memory index instead of a mapped file")
+    parser.add_argument("--threads", type=int, default=0, help="faiss OpenMP threads (0 = default)")
+    parser.add_argument("--k-factor", type=int, default=FAISS_REFINE_K_FACTOR)
+    parser.add_argument("--nlist", type=int, default=FAISS_IVF_NLIST)
+    parser.add_argument("--pq-m", type=int, default=FAISS_PQ_M)
+    parser.add_argument("--pq-bits", type=int, default=FAISS_PQ_BITS)
+    args = parser.parse_args()
+
+    if args.threads:
+        faiss.omp_set_num_threads(args.threads)
+    kinds = [t.strip() for t in args.types.split(",") if t.strip()]
+    print(json.dumps(run_benchmark(kinds, source=args.source, k=args.k, queries=args.queries,
+                                   train_size=args.train_size, latency_queries=args.latency_queries,
+                                   mmap=not args.no_mmap, k_factor=args.k_factor,
+                                   nlist=args.nlist, pq_m=args.pq_m, pq_bits=args.pq_bits), indent=2))
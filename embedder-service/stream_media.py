@@ -1,8 +1,9 @@
 ﻿import subprocess, tempfile, os
-from typing import Dict, Tuple, Optional
+from typing import Dict, List, Tuple, Optional
+import torch
 import yt_dlp
 from logger import logger
-from config import TARGET_SAMPLING_RATE
+from config import TARGET_SAMPLING_RATE, FULL_TRACK_PREALLOC_SECONDS
 
 
 def resolve_youtube_media(page_url: str) -> Tuple[str, Dict[str, str]]:
@@ -57,12 +58,8 @@ def _headers_to_ffmpeg_arg(headers: Dict[str, str]) -> Optional[str]:
     return "".join([f"{k}: {v}\r\n" for k, v in headers.items()])
 
 
-def stream_clip_to_temp_wav(media_url: str, headers: Dict[str, str], start_s: int, dur_s: int) -> str:
+def _ffmpeg_clip_cmd(media_url: str, headers: Dict[str, str], start_s: int, dur_s: int) -> List[str]:
     hdr_arg = _headers_to_ffmpeg_arg(headers)
-    tmp = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
-    tmp_path = tmp.name
-    tmp.close()
-
     cmd = ["ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error"]
 
     if start_s and start_s > 0:
@@ -77,6 +74,15 @@ def stream_clip_to_temp_wav(media_url: str, headers: Dict[str, str], start_s: in
     if dur_s and dur_s > 0:
         cmd += ["-t", str(dur_s)]
 
+    return cmd
+
+
+def stream_clip_to_temp_wav(media_url: str, headers: Dict[str, str], start_s: int, dur_s: int) -> str:
+    tmp = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
+    tmp_path = tmp.name
+    tmp.close()
+
+    cmd = _ffmpeg_clip_cmd(media_url, headers, start_s, dur_s)
     cmd += ["-y", tmp_path]
     cmd = [c for c in cmd if c != ""]
 
@@ -92,3 +98,45 @@ def stream_clip_to_temp_wav(media_url: str, headers: Dict[str, str], start_s: in
         raise RuntimeError(f"ffmpeg failed: {e}") from e
 
     return tmp_path
+
+
+def stream_clip_to_tensor(media_url: str, headers: Dict[str, str], start_s: int, dur_s: int) -> torch.Tensor:
+    # raw mono float32 PCM at TARGET_SAMPLING_RATE straight from ffmpeg's stdout, no temp file
+    cmd = _ffmpeg_clip_cmd(media_url, headers, start_s, dur_s)
+    cmd += ["-f", "f32le", "-acodec", "pcm_f32le", "pipe:1"]
+    cmd = [c for c in cmd if c != ""]
+
+    seconds = dur_s if dur_s and dur_s > 0 else FULL_TRACK_PREALLOC_SECONDS
+    buf = bytearray(int(seconds * TARGET_SAMPLING_RATE) * 4)
+    view = memoryview(buf)
+    n = 0
+
+    logger.info(f"ffmpeg (YouTube) -> pipe [ss={start_s}, t={'FULL' if not (dur_s and dur_s > 0) else dur_s}]")
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        while True:
+            if n == len(buf):
+                # longer than expected (full track): grow, the old view must be released first
+                view.release()
+                buf.extend(bytes(len(buf)))
+                view = memoryview(buf)
+            got = proc.stdout.readinto(view[n:])
+            if not got:
+                break
+            n += got
+        rc = proc.wait()
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    finally:
+        proc.stdout.close()
+        view.release()
+
+    if rc != 0:
+        raise RuntimeError(f"ffmpeg failed: exit status {rc}")
+    if n < 4:
+        raise RuntimeError("ffmpeg produced no audio")
+
+    # zero-copy: the tensor aliases the bytearray
+    return torch.frombuffer(buf, dtype=torch.float32, count=n // 4).unsqueeze(0)
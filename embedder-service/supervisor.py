@@ -0,0 +1,101 @@
+﻿import os
+import time
+import queue
+import multiprocessing as mp
+from typing import Optional
+
+from config import PIPELINE_QUEUE_SIZE
+from logger import logger
+
+POLL_SECONDS = 3
+
+
+def _worker_main(worker_id: int, threads: int, results_q, stop, model_opts: dict) -> None:
+    import torch
+
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+    # imported here so the spawned process builds its own model registry and DB state
+    from main import fetch_jobs, run_jobs, flush_failures
+    from model_registry import get_registry
+
+    registry = get_registry()
+    registry.configure(**model_opts)
+    registry.warm_up()
+    logger.info(f"Worker {worker_id} ready (pid={os.getpid()}, torch threads={threads})")
+
+    def send(results) -> int:
+        results_q.put(results)
+        return len(results)
+
+    while not stop.is_set():
+        jobs = fetch_jobs()
+        if not jobs:
+            time.sleep(POLL_SECONDS)
+            continue
+        n = run_jobs(jobs, send)
+        flush_failures()
+        logger.info(f"Worker {worker_id}: sent {n} vectors to the index writer")
+
+
+def run_supervisor(n_workers: int, threads_per_worker: Optional[int] = None,
+                   model_opts: Optional[dict] = None) -> None:
+    from main import ensure_mapper, get_embed_cache, get_index_store, _fail_job, flush_failures
+    from model_registry import get_registry
+    from index_writer import IndexWriter
+
+    threads = threads_per_worker or max(1, (os.cpu_count() or 1) // n_workers)
+    ctx = mp.get_context("spawn")
+    results_q = ctx.Queue(maxsize=max(1, n_workers * PIPELINE_QUEUE_SIZE))
+    stop = ctx.Event()
+
+    def start_worker(i: int):
+        p = ctx.Process(target=_worker_main, args=(i, threads, results_q, stop, model_opts or {}),
+                        name=f"embed-worker-{i}", daemon=True)
+        p.start()
+        return p
+
+    # this process is the only one that opens, assigns ids in, and saves the FAISS index
+    # configured (not loaded) here too so the embedding cache is keyed like the workers' vectors
+    get_registry().configure(**(model_opts or {}))
+    store = get_index_store()
+    writer = IndexWriter(store.index, ensure_mapper(), on_error=_fail_job, cache=get_embed_cache(), journal=store)
+    workers = [start_worker(i) for i in range(n_workers)]
+    logger.info(f"Supervisor started {n_workers} workers x {threads} threads; index size = {store.index.ntotal}")
+
+    try:
+        while True:
+            try:
+                results = results_q.get(timeout=1.0)
+                writer.commit_batch(results)
+                flush_failures()
+            except queue.Empty:
+                pass
+
+            for i, p in enumerate(workers):
+                if not p.is_alive():
+                    logger.error(f"Worker {i} exited (code={p.exitcode}); restarting")
+                    workers[i] = start_worker(i)
+
+            store.maybe_checkpoint()
+    except KeyboardInterrupt:
+        logger.info("Supervisor stopping")
+    finally:
+        stop.set()
+        deadline = time.time() + 30
+        while any(p.is_alive() for p in workers) and time.time() < deadline:
+            try:
+                writer.commit_batch(results_q.get(timeout=0.5))
+            except queue.Empty:
+                pass
+        for p in workers:
+            if p.is_alive():
+                p.terminate()
+        while True:
+            try:
+                writer.commit_batch(results_q.get_nowait())
+            except queue.Empty:
+                break
+        flush_failures()
+        store.maybe_checkpoint(force=True)
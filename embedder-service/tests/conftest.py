@@ -0,0 +1,10 @@
+﻿import os
+import sys
+import tempfile
+
+# config reads these at import; claims run against a throwaway SQLite file, never the configured MSSQL
+os.environ["DB_BACKEND"] = "sqlite"
+os.environ.setdefault("SQLITE_PATH", os.path.join(tempfile.mkdtemp(prefix="ums-tests-"), "ums.sqlite3"))
+
+# per service (python -m pytest tests from embedder-service): search-engine has its own flat `config` module
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
@@ -0,0 +1,44 @@
+﻿import os
+
+from claim_scheduler import ClaimScheduler, load_scene_caps
+
+CONFIG = """
+country_scenes:
+  RS:
+    - name: trap
+      keywords: [trap]
+    - name: drill
+      keywords: [drill]
+      daily_admit_cap: 50
+  HR:
+    - keywords: [nameless]
+global:
+  daily_admit_cap: 120
+"""
+
+
+def test_scene_caps_fall_back_to_the_global_cap(tmp_path):
+    path = tmp_path / "config.yaml"
+    path.write_text(CONFIG, encoding="utf-8")
+    assert load_scene_caps(str(path)) == {("RS", "trap"): 120, ("RS", "drill"): 50}
+
+
+def test_scenes_are_uncapped_without_a_global_cap(tmp_path):
+    path = tmp_path / "config.yaml"
+    path.write_text(CONFIG.replace("  daily_admit_cap: 120\n", ""), encoding="utf-8")
+    assert load_scene_caps(str(path)) == {("RS", "drill"): 50}
+    assert load_scene_caps(str(tmp_path / "missing.yaml")) == {}
+
+
+def test_collector_config_sets_the_default_cap():
+    caps = load_scene_caps(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, "yt-collector", "config.yaml"))
+    assert caps and all(cap > 0 for cap in caps.values())
+
+
+def test_select_respects_remaining_quota():
+    s = ClaimScheduler(caps={})
+    candidates = [{"id": str(i), "bucket": ("RS", "trap") if i % 2 else ("HR", "rap")} for i in range(10)]
+    chosen = s.select(candidates, 6, {("RS", "trap"): 2, ("HR", "rap"): 0})
+    # the capped bucket is skipped, the other stops at its quota, and the limit is never exceeded
+    assert chosen == ["1", "3"]
+    assert s.select(candidates, 6, {("RS", "trap"): 2}) == ["0", "1", "2", "3", "4", "6"]
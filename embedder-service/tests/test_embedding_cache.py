@@ -0,0 +1,58 @@
+﻿import os
+
+import numpy as np
+
+from embedding_cache import EmbeddingCache, _KEY_DTYPE
+
+DIM = 4
+
+
+def _cache(root):
+    return EmbeddingCache(root=str(root), dim=DIM, model_id="test-model", shard_rows=8)
+
+
+def _vecs(n, seed=0):
+    return np.random.default_rng(seed).standard_normal((n, DIM)).astype("float32")
+
+
+def _tear(path, n_bytes):
+    with open(path, "ab") as f:
+        f.write(b"\x7f" * n_bytes)
+
+
+def test_torn_vector_row_does_not_shift_later_rows(tmp_path):
+    first, later = _vecs(2), _vecs(3, seed=1)
+    _cache(tmp_path).put_many([("A", 0, 30), ("B", 0, 30)], first)
+    # a crash halfway through the next vector write
+    _tear(os.path.join(tmp_path, "shard_00000.f32"), DIM * 4 - 3)
+
+    cache = _cache(tmp_path)
+    cache.put_many([("C", 0, 30), ("D", 0, 30), ("E", 0, 30)], later)
+    reopened = _cache(tmp_path)
+    for cache in (cache, reopened):
+        np.testing.assert_array_equal(cache.get("A", 0, 30), first[0])
+        np.testing.assert_array_equal(cache.get("D", 0, 30), later[1])
+        found, out = cache.lookup_many([("E", 0, 30), ("B", 0, 30), ("Z", 0, 30)])
+        assert found.tolist() == [True, True, False]
+        np.testing.assert_array_equal(out[:2], np.stack([later[2], first[1]]))
+
+
+def test_torn_key_record_does_not_shift_later_keys(tmp_path):
+    vecs = _vecs(3)
+    _cache(tmp_path).put_many([("A", 0, 30)], vecs[:1])
+    _tear(os.path.join(tmp_path, "keys.bin"), _KEY_DTYPE.itemsize // 2)
+
+    _cache(tmp_path).put_many([("B", 0, 30), ("C", 10, 30)], vecs[1:])
+    cache = _cache(tmp_path)
+    assert len(cache) == 3
+    np.testing.assert_array_equal(cache.get("C", 10, 30), vecs[2])
+    ids, starts, _, out = cache.export()
+    assert ids == ["A", "B", "C"] and starts.tolist() == [0, 0, 10]
+    np.testing.assert_array_equal(out, vecs)
+
+
+def test_namespaces_do_not_mix(tmp_path):
+    _cache(tmp_path).put_many([("A", 0, 30)], _vecs(1))
+    other = EmbeddingCache(root=str(tmp_path), dim=DIM, model_id="test-model|depth=6", shard_rows=8)
+    assert other.get("A", 0, 30) is None
+    assert other.export()[0] == []
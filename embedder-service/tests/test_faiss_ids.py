@@ -0,0 +1,24 @@
+﻿import json
+import os
+import subprocess
+import sys
+
+from faiss_index import track_faiss_id
+
+SEARCH_ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, "search-engine")
+GUID = "0b1e3f4a-5c6d-4e7f-8a9b-0c1d2e3f4a5b"
+TRACKS = [GUID, GUID.upper(), "{" + GUID + "}", "not-a-guid.wav"]
+
+
+def test_track_faiss_id_is_pinned():
+    # ids already stored in music.index and the mapping; changing the hash orphans every vector
+    assert track_faiss_id(GUID) == 6218879223612354466
+    assert {track_faiss_id(t) for t in TRACKS[:3]} == {6218879223612354466}
+
+
+def test_search_engine_hashes_the_same():
+    # search_music.track_faiss_id is a copy; run it in its own process, the services share the `config` module name
+    code = "import json, sys, search_music; print(json.dumps([search_music.track_faiss_id(t) for t in json.load(sys.stdin)]))"
+    out = subprocess.run([sys.executable, "-c", code], cwd=SEARCH_ENGINE, input=json.dumps(TRACKS),
+                         capture_output=True, text=True, check=True).stdout
+    assert json.loads(out) == [track_faiss_id(t) for t in TRACKS]
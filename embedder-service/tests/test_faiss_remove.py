@@ -0,0 +1,77 @@
+﻿import numpy as np
+import pytest
+
+from faiss_index import (
+    INDEX_TYPES, create_index, needs_training, with_stable_ids, has_stable_ids, contains_id, index_ids,
+    export_vectors, normalize_rows, remove_ids, upsert_batch_to_index
+)
+
+DIM = 16
+# small enough to train on a few hundred rows
+PARAMS = {"nlist": 4, "pq_m": 4, "pq_bits": 4, "hnsw_m": 8}
+
+
+def _vecs(n, seed=0):
+    return normalize_rows(np.random.default_rng(seed).standard_normal((n, DIM)))
+
+
+def _stable_index(kind, n=300):
+    idx = create_index(kind, dim=DIM, **PARAMS)
+    if needs_training(kind):
+        idx.train(_vecs(n, seed=99))
+    return with_stable_ids(idx)
+
+
+def _top1(index, vecs):
+    return index.search(np.ascontiguousarray(vecs), 1)[1][:, 0]
+
+
+def test_refine_remove_keeps_both_halves_aligned():
+    idx = _stable_index("pq_refine")
+    ids = np.arange(100, 140, dtype="int64")
+    vecs = _vecs(len(ids))
+    idx.add_with_ids(vecs, ids)
+
+    gone = ids[::3]
+    assert remove_ids(idx, np.concatenate([gone, [999]])) == len(gone)
+    kept = np.setdiff1d(ids, gone)
+    assert idx.ntotal == len(kept)
+    np.testing.assert_array_equal(np.sort(index_ids(idx)), kept)
+    assert not any(contains_id(idx, i) for i in gone)
+
+    # the refine pass re-scores against float32 copies: an exact query must find its own row
+    ex_ids, ex_vecs = export_vectors(idx)
+    np.testing.assert_allclose(ex_vecs, vecs[np.searchsorted(ids, ex_ids)], atol=1e-6)
+    np.testing.assert_array_equal(_top1(idx, vecs[np.searchsorted(ids, kept)]), kept)
+
+    assert remove_ids(idx, gone) == 0
+
+
+@pytest.mark.parametrize("kind", [k for k in INDEX_TYPES if k != "hnsw"])
+def test_upsert_and_remove_by_stable_id(kind):
+    idx = _stable_index(kind)
+    assert has_stable_ids(idx)
+    ids = np.array([7, 3_000_000_000_000, 42, 5], dtype="int64")
+    upsert_batch_to_index(idx, ids, _vecs(4))
+    assert idx.ntotal == 4
+
+    # re-embedding keeps the id and replaces the vector instead of adding a second row
+    newer = _vecs(2, seed=1)
+    upsert_batch_to_index(idx, ids[:2], newer)
+    assert idx.ntotal == 4
+    np.testing.assert_array_equal(np.sort(index_ids(idx)), np.sort(ids))
+    if kind in ("flat", "ivf_flat", "pq_refine"):
+        np.testing.assert_allclose(idx.reconstruct(int(ids[1])), newer[1], atol=1e-6)
+
+    assert remove_ids(idx, ids[[0, 2]]) == 2
+    np.testing.assert_array_equal(np.sort(index_ids(idx)), np.sort(ids[[1, 3]]))
+    assert not contains_id(idx, ids[0]) and contains_id(idx, ids[3])
+
+
+def test_hnsw_refuses_to_replace():
+    idx = _stable_index("hnsw")
+    upsert_batch_to_index(idx, np.array([1, 2]), _vecs(2))
+    upsert_batch_to_index(idx, np.array([3]), _vecs(1, seed=1))
+    assert idx.ntotal == 3
+    with pytest.raises(RuntimeError):
+        upsert_batch_to_index(idx, np.array([2]), _vecs(1, seed=2))
@@ -0,0 +1,61 @@
+﻿import uuid
+
+import numpy as np
+import pytest
+
+import index_migrate
+from faiss_index import create_index, save_index, load_index, has_stable_ids, index_ids, normalize_rows, track_faiss_id
+from mapping_store import CSVMappingStore, SQLiteMappingStore
+from config import MAPPING_PATH
+
+DIM = 8
+TRACKS = [str(uuid.UUID(int=n + 1)).upper() for n in range(20)]
+
+
+@pytest.fixture
+def positional(tmp_path, monkeypatch):
+    # a legacy positional music.index with its CSV and SQL mapping, under a scratch working directory
+    monkeypatch.chdir(tmp_path)
+    sql = SQLiteMappingStore(str(tmp_path / "ums.sqlite3"))
+    monkeypatch.setattr(index_migrate, "sql_mapping_store", lambda: sql)
+    index = create_index("flat", dim=DIM)
+    index.add(normalize_rows(np.random.default_rng(0).standard_normal((len(TRACKS), DIM))))
+    save_index(index)
+    for store in (CSVMappingStore(MAPPING_PATH), sql):
+        store.initialize()
+        store.add_many(list(enumerate(TRACKS)))
+    return sql
+
+
+def _stable_mapping():
+    return {track_faiss_id(t): t for t in TRACKS}
+
+
+def test_stable_ids_rekey_index_and_mapping(positional):
+    index_migrate.migrate("flat", stable_ids=True)
+    index = load_index()
+    assert has_stable_ids(index)
+    np.testing.assert_array_equal(np.sort(index_ids(index)), sorted(_stable_mapping()))
+    assert CSVMappingStore(MAPPING_PATH).load() == _stable_mapping()
+    assert positional.load() == _stable_mapping()
+
+
+def test_interrupted_rekey_is_finished_by_running_again(positional, monkeypatch):
+    rekey = index_migrate._rekey_mapping
+
+    def interrupted(mapper, id2track):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(index_migrate, "_rekey_mapping", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        index_migrate.migrate("flat", stable_ids=True)
+    # the new index is on disk, the mapping is untouched rather than half re-keyed
+    assert has_stable_ids(load_index())
+    assert CSVMappingStore(MAPPING_PATH).load() == dict(enumerate(TRACKS))
+    assert positional.load() == dict(enumerate(TRACKS))
+
+    monkeypatch.setattr(index_migrate, "_rekey_mapping", rekey)
+    index_migrate.migrate("flat", stable_ids=True)
+    np.testing.assert_array_equal(np.sort(index_ids(load_index())), sorted(_stable_mapping()))
+    assert CSVMappingStore(MAPPING_PATH).load() == _stable_mapping()
+    assert positional.load() == _stable_mapping()
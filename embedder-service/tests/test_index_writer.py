@@ -0,0 +1,110 @@
+﻿import sqlite3
+import uuid
+
+import numpy as np
+import pytest
+
+import index_writer
+from faiss_index import create_index, with_stable_ids, save_index, normalize_rows, index_ids, track_faiss_id
+from index_writer import IndexWriter
+from vector_journal import VectorJournal, JournaledIndex
+
+DIM = 8
+
+
+class FakeMapper:
+    # all-or-nothing add_many; tracks in `conflicts` fail like a UNIQUE(track_id) violation
+    def __init__(self, conflicts=()):
+        self.rows = {}
+        self.conflicts = set(conflicts)
+
+    def add_many(self, rows, timestamp=None):
+        if any(track in self.conflicts for _, track in rows):
+            raise sqlite3.IntegrityError("UNIQUE constraint failed: VectorMap.track_id")
+        self.rows.update(rows)
+
+    def remove(self, vector_id):
+        self.rows.pop(vector_id, None)
+
+
+def _vecs(n, seed=0):
+    return normalize_rows(np.random.default_rng(seed).standard_normal((n, DIM)))
+
+
+def _jobs(n):
+    return [{"id": str(uuid.UUID(int=i + 1)).upper()} for i in range(n)]
+
+
+@pytest.fixture
+def processed(monkeypatch):
+    marked = []
+    monkeypatch.setattr(index_writer, "mark_processed_many", lambda ids: marked.extend(ids))
+    return marked
+
+
+def _writer(tmp_path, kind_index, mapper, failed):
+    store = JournaledIndex(journal=VectorJournal(str(tmp_path / "music.journal"), dim=DIM),
+                           index_path=str(tmp_path / "music.index"))
+    store.index = kind_index
+    return IndexWriter(store.index, mapper, on_error=lambda job, e: failed.append(job["id"]), journal=store)
+
+
+def test_mapping_conflict_fails_only_its_job(tmp_path, processed):
+    jobs, failed = _jobs(4), []
+    mapper = FakeMapper(conflicts=[jobs[1]["id"]])
+    writer = _writer(tmp_path, with_stable_ids(create_index("flat", dim=DIM)), mapper, failed)
+
+    assert writer.commit_batch([(job, v, None) for job, v in zip(jobs, _vecs(4))]) == 3
+    assert failed == [jobs[1]["id"]]
+    assert processed == [jobs[n]["id"] for n in (0, 2, 3)]
+    expected = sorted(track_faiss_id(jobs[n]["id"]) for n in (0, 2, 3))
+    np.testing.assert_array_equal(np.sort(index_ids(writer.index)), expected)
+    assert sorted(mapper.rows) == expected
+
+
+def test_failed_status_write_restores_replaced_vectors(tmp_path, monkeypatch):
+    jobs, failed = _jobs(3), []
+    mapper = FakeMapper()
+    writer = _writer(tmp_path, with_stable_ids(create_index("flat", dim=DIM)), mapper, failed)
+    monkeypatch.setattr(index_writer, "mark_processed_many", lambda ids: None)
+    old = _vecs(2)
+    writer.commit_batch([(job, v, None) for job, v in zip(jobs[:2], old)])
+    rows = dict(mapper.rows)
+
+    def down(ids):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(index_writer, "mark_processed_many", down)
+    # job 0 is re-embedded, job 2 is new
+    assert writer.commit_batch([(jobs[0], _vecs(1, seed=1)[0], None), (jobs[2], _vecs(1, seed=2)[0], None)]) == 0
+    assert failed == [jobs[0]["id"], jobs[2]["id"]]
+    assert mapper.rows == rows
+    fid0 = track_faiss_id(jobs[0]["id"])
+    np.testing.assert_allclose(writer.index.reconstruct(fid0), old[0], atol=1e-6)
+    assert writer.index.ntotal == 2
+
+    # the journal tells the same story after a restart
+    save_index(with_stable_ids(create_index("flat", dim=DIM)), str(tmp_path / "empty.index"))
+    replayed = JournaledIndex(journal=VectorJournal(str(tmp_path / "music.journal"), dim=DIM),
+                              index_path=str(tmp_path / "empty.index"))
+    np.testing.assert_array_equal(np.sort(index_ids(replayed.index)), np.sort(index_ids(writer.index)))
+    np.testing.assert_allclose(replayed.index.reconstruct(fid0), old[0], atol=1e-6)
+
+
+def test_positional_rollback_reuses_the_same_ids(tmp_path, monkeypatch, processed):
+    jobs, failed = _jobs(5), []
+    mapper = FakeMapper()
+    writer = _writer(tmp_path, create_index("flat", dim=DIM), mapper, failed)
+    writer.commit_batch([(job, v, None) for job, v in zip(jobs[:2], _vecs(2))])
+
+    # the last two of the batch conflict: they are the tail, so they come back out
+    mapper.conflicts = {jobs[3]["id"], jobs[4]["id"]}
+    assert writer.commit_batch([(job, v, None) for job, v in zip(jobs[2:], _vecs(3, seed=1))]) == 1
+    assert writer.index.ntotal == 3
+    assert len(writer.journal.journal) == 3
+    assert mapper.rows == {0: jobs[0]["id"], 1: jobs[1]["id"], 2: jobs[2]["id"]}
+
+    mapper.conflicts = set()
+    assert writer.commit_batch([(job, v, None) for job, v in zip(jobs[3:], _vecs(2, seed=2))]) == 2
+    assert mapper.rows[3] == jobs[3]["id"] and mapper.rows[4] == jobs[4]["id"]
+    np.testing.assert_array_equal(writer.journal.journal.read()["id"], np.arange(5))
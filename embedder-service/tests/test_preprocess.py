@@ -0,0 +1,30 @@
+﻿import torch
+
+from audio_preparation import prep_waveform
+from config import TARGET_SAMPLING_RATE
+from preprocess import PreprocessEngine
+
+
+def _clip(seconds, sr, channels, lead, tail, seed):
+    g = torch.Generator().manual_seed(seed)
+    body = torch.randn(channels, int(seconds * sr), generator=g) * 0.1
+    return torch.cat([torch.zeros(channels, int(lead * sr)), body, torch.zeros(channels, int(tail * sr))], dim=1)
+
+
+def test_batch_matches_per_clip_prep():
+    items = [
+        (_clip(1.0, 44100, 2, 0.2, 0.5, 0), 44100),
+        (_clip(0.5, TARGET_SAMPLING_RATE, 1, 0.0, 0.1, 1), TARGET_SAMPLING_RATE),
+        (_clip(1.5, 16000, 1, 0.3, 0.0, 2), 16000),
+        (torch.zeros(1, 2000), TARGET_SAMPLING_RATE),
+    ]
+    engine = PreprocessEngine()
+    batched = engine.prep_batch(items)
+    for (waveform, sr), got in zip(items, batched):
+        want = prep_waveform(waveform, sr)
+        assert got.shape == want.shape
+        torch.testing.assert_close(got, want, rtol=1e-4, atol=1e-5)
+
+    report = engine.report()
+    assert report["clips"] == len(items)
+    assert {"resample_ms_per_clip", "trim_ms_per_clip", "loudness_ms_per_clip"} <= set(report)
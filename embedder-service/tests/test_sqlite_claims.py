@@ -0,0 +1,122 @@
+﻿import threading
+from datetime import datetime, timezone
+
+import pytest
+
+import db_sqlite
+from claim_scheduler import ClaimScheduler
+
+
+@pytest.fixture
+def sqlite_db(tmp_path, monkeypatch):
+    path = str(tmp_path / "ums.sqlite3")
+    monkeypatch.setattr(db_sqlite, "SQLITE_PATH", path)
+    db_sqlite.seed_fake_data(600, playlists_per_scene=2, processed_fraction=0.1, failed_fraction=0.05, path=path)
+    return path
+
+
+def _collected(path):
+    with db_sqlite.get_conn(path, write=False) as conn:
+        return [r[0] for r in conn.execute("SELECT id FROM Tracks WHERE status='collected'").fetchall()]
+
+
+def _status(path):
+    return db_sqlite.table_counts(path)["status"]
+
+
+def test_claim_ids_skips_rows_not_collected(sqlite_db):
+    ids = _collected(sqlite_db)[:5]
+    with db_sqlite.get_conn(sqlite_db, write=False) as conn:
+        processed = conn.execute("SELECT id FROM Tracks WHERE status='processed' LIMIT 1").fetchone()[0]
+
+    jobs = db_sqlite.claim_ids(ids + ids[:2] + [processed, "NOT-A-TRACK"])
+    assert sorted(j["id"] for j in jobs) == sorted(ids)
+    assert db_sqlite.claim_ids(ids) == []
+
+
+def test_concurrent_claims_never_overlap(sqlite_db):
+    ids = _collected(sqlite_db)
+    before = _status(sqlite_db)
+    won, lock, start = [], threading.Lock(), threading.Barrier(8)
+
+    def worker(n):
+        # every thread asks for heavily overlapping windows of the same rows
+        start.wait()
+        for k in range(0, len(ids), 40):
+            jobs = db_sqlite.claim_ids(ids[k:k + 40 + 40 * (n % 3)])
+            with lock:
+                won.extend(j["id"] for j in jobs)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(won) == len(set(won)) == len(ids)
+    after = _status(sqlite_db)
+    assert after.get("collected", 0) == 0
+    assert after["processing"] == before["collected"]
+
+
+def test_requeue_expired_only_takes_back_expired_leases(sqlite_db):
+    ids = _collected(sqlite_db)[:3]
+    with db_sqlite.get_conn(sqlite_db) as conn:
+        # two claims from before claimed_at was stamped, one claim from a worker that died long ago
+        conn.execute("UPDATE Tracks SET status='processing', claimed_at=NULL WHERE id IN (?, ?)", ids[:2])
+        conn.execute("UPDATE Tracks SET status='processing', claimed_at='2000-01-01 00:00:00.000' WHERE id=?",
+                     ids[2:])
+
+    assert db_sqlite.requeue_expired(1800) == 1
+    assert db_sqlite.requeue_expired(1800) == 0
+    with db_sqlite.get_conn(sqlite_db) as conn:
+        rows = conn.execute("SELECT status, claimed_at FROM Tracks WHERE id IN (?, ?)", ids[:2]).fetchall()
+        assert all(status == "processing" and claimed for status, claimed in rows)
+        conn.execute("UPDATE Tracks SET claimed_at='2000-01-01 00:00:00.000' WHERE id IN (?, ?)", ids[:2])
+    assert db_sqlite.requeue_expired(1800) == 2
+
+
+def _processing_by_bucket(path):
+    with db_sqlite.get_conn(path, write=False) as conn:
+        rows = conn.execute("SELECT country_bucket, scene, COUNT(*) FROM Tracks WHERE status='processing' "
+                            "GROUP BY country_bucket, scene").fetchall()
+    return {(r[0], r[1]): r[2] for r in rows}
+
+
+def test_scheduler_stops_at_daily_cap(sqlite_db):
+    # seeded rows processed earlier today already count against the cap
+    used = db_sqlite.admitted_since(datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0))
+    caps = {("RS", "trap"): used.get(("RS", "trap"), 0) + 21, ("HR", "rap"): 0}
+    s = ClaimScheduler(caps=caps, batch=8, min_batch=8, max_batch=8)
+    while s.next_batch():
+        pass
+
+    claimed = _processing_by_bucket(sqlite_db)
+    assert claimed[("RS", "trap")] == 21
+    assert ("HR", "rap") not in claimed
+    assert claimed[("DE", "rap")] > 0  # buckets without a cap are not limited
+    assert s.next_batch() == []
+
+
+def test_concurrent_schedulers_never_double_claim(sqlite_db):
+    workers = [ClaimScheduler(caps={("HR", "rap"): 0}, batch=16, min_batch=16, max_batch=16) for _ in range(4)]
+    won, lock = [], threading.Lock()
+
+    def run(s):
+        while True:
+            jobs = s.next_batch()
+            if not jobs:
+                return
+            with lock:
+                won.extend(j["id"] for j in jobs)
+
+    threads = [threading.Thread(target=run, args=(s,)) for s in workers]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(won) == len(set(won))
+    claimed = _processing_by_bucket(sqlite_db)
+    assert sum(claimed.values()) == len(won)
+    assert ("HR", "rap") not in claimed
@@ -0,0 +1,151 @@
+﻿import os
+
+import numpy as np
+import pytest
+
+from faiss_index import create_index, with_stable_ids, save_index, normalize_rows, index_ids
+from vector_journal import VectorJournal, JournaledIndex, OP_ADD, OP_REMOVE, _HEADER_BYTES
+
+DIM = 8
+
+
+def _vecs(n, seed=0):
+    return normalize_rows(np.random.default_rng(seed).standard_normal((n, DIM)))
+
+
+def _tear(journal, n_bytes):
+    # what a crash halfway through an append leaves behind
+    with open(journal.path, "ab") as f:
+        f.write(b"\x01" * n_bytes)
+
+
+def test_torn_tail_is_dropped_on_open(tmp_path):
+    path = str(tmp_path / "music.journal")
+    j = VectorJournal(path, dim=DIM)
+    j.append(np.arange(3), _vecs(3))
+    _tear(j, j.dtype.itemsize - 5)
+
+    j = VectorJournal(path, dim=DIM)
+    assert len(j) == 3
+    assert os.path.getsize(path) == _HEADER_BYTES + 3 * j.dtype.itemsize
+    np.testing.assert_array_equal(j.read()["id"], [0, 1, 2])
+    np.testing.assert_allclose(j.read()["vec"], _vecs(3))
+
+    # without the truncation this record would start inside the torn one
+    j.append(np.array([3]), _vecs(1, seed=1))
+    np.testing.assert_array_equal(VectorJournal(path, dim=DIM).read()["id"], [0, 1, 2, 3])
+
+
+def test_journal_for_other_dim_is_rejected(tmp_path):
+    path = str(tmp_path / "music.journal")
+    VectorJournal(path, dim=DIM)
+    with pytest.raises(RuntimeError):
+        VectorJournal(path, dim=DIM * 2)
+
+
+def test_replay_positional_index_after_torn_record(tmp_path):
+    index_path = str(tmp_path / "music.index")
+    base = create_index("flat", dim=DIM)
+    base.add(_vecs(4))
+    save_index(base, index_path)
+
+    journal_path = str(tmp_path / "music.journal")
+    j = VectorJournal(journal_path, dim=DIM)
+    j.append(np.arange(2, 6), _vecs(4, seed=1)[:4])  # 2, 3 are already in the checkpoint
+    _tear(j, 7)
+
+    ji = JournaledIndex(journal=VectorJournal(journal_path, dim=DIM), index_path=index_path)
+    assert ji.index.ntotal == 6
+    assert ji.pending == 4
+    np.testing.assert_allclose(ji.index.reconstruct_n(4, 2), _vecs(4, seed=1)[2:4], atol=1e-6)
+
+
+def test_replay_positional_index_with_gap_fails(tmp_path):
+    index_path = str(tmp_path / "music.index")
+    base = create_index("flat", dim=DIM)
+    base.add(_vecs(2))
+    save_index(base, index_path)
+
+    j = VectorJournal(str(tmp_path / "music.journal"), dim=DIM)
+    j.append(np.array([3]), _vecs(1))
+    with pytest.raises(RuntimeError):
+        JournaledIndex(journal=j, index_path=index_path)
+
+
+def test_replay_stable_ids_last_record_wins(tmp_path):
+    index_path = str(tmp_path / "music.index")
+    base = with_stable_ids(create_index("flat", dim=DIM))
+    base.add_with_ids(_vecs(3), np.array([10, 20, 30]))
+    save_index(base, index_path)
+
+    journal_path = str(tmp_path / "music.journal")
+    j = VectorJournal(journal_path, dim=DIM)
+    new = _vecs(3, seed=2)
+    j.append(np.array([20, 40]), new[:2])                           # re-embed 20, add 40
+    j.append(np.array([10]), np.zeros((1, DIM)), op=OP_REMOVE)      # drop 10
+    j.append(np.array([40]), new[2:], op=OP_ADD)                    # 40 again: the later vector wins
+    j.append(np.array([50]), new[:1])
+    _tear(j, j.dtype.itemsize // 2)                                 # 50 was never acknowledged
+
+    ji = JournaledIndex(journal=VectorJournal(journal_path, dim=DIM), index_path=index_path)
+    np.testing.assert_array_equal(np.sort(index_ids(ji.index)), [20, 30, 40, 50])
+    np.testing.assert_allclose(ji.index.reconstruct(20), new[0], atol=1e-6)
+    np.testing.assert_allclose(ji.index.reconstruct(40), new[2], atol=1e-6)
+
+    # replaying the same journal over a checkpoint that already holds it changes nothing
+    ji.checkpoint()
+    j2 = VectorJournal(journal_path, dim=DIM)
+    j2.append(np.array([20, 40]), new[:2])
+    ji2 = JournaledIndex(journal=j2, index_path=index_path)
+    assert ji2.index.ntotal == 4
+    np.testing.assert_allclose(ji2.index.reconstruct(40), new[1], atol=1e-6)
+
+
+def test_replay_hnsw_adds_only_new_ids(tmp_path):
+    index_path = str(tmp_path / "music.index")
+    base = with_stable_ids(create_index("hnsw", dim=DIM, hnsw_m=8))
+    old = _vecs(3)
+    base.add_with_ids(old, np.array([10, 20, 30]))
+    save_index(base, index_path)
+
+    # 30 is the checkpoint's own copy, journaled before a crash kept the journal from being reset
+    new = _vecs(2, seed=3)
+    j = VectorJournal(str(tmp_path / "music.journal"), dim=DIM)
+    j.append(np.array([30, 40]), np.stack([old[2], new[0]]))
+    _tear(j, 9)
+
+    ji = JournaledIndex(journal=VectorJournal(j.path, dim=DIM), index_path=index_path)
+    np.testing.assert_array_equal(np.sort(index_ids(ji.index)), [10, 20, 30, 40])
+    np.testing.assert_allclose(ji.index.reconstruct(40), new[0], atol=1e-6)
+
+    replaced = VectorJournal(str(tmp_path / "replaced.journal"), dim=DIM)
+    replaced.append(np.array([20]), new[1:])
+    with pytest.raises(RuntimeError):
+        JournaledIndex(journal=replaced, index_path=index_path)
+
+    removed = VectorJournal(str(tmp_path / "removed.journal"), dim=DIM)
+    removed.append(np.array([10]), np.zeros((1, DIM)), op=OP_REMOVE)
+    with pytest.raises(RuntimeError):
+        JournaledIndex(journal=removed, index_path=index_path)
+
+
+def test_failed_checkpoint_keeps_journal(tmp_path, monkeypatch):
+    import vector_journal
+
+    index_path = str(tmp_path / "music.index")
+    j = VectorJournal(str(tmp_path / "music.journal"), dim=DIM)
+    ji = JournaledIndex(journal=j, index_path=index_path)
+    ji.index = with_stable_ids(create_index("flat", dim=DIM))
+    ji.index.add_with_ids(_vecs(2), np.array([1, 2]))
+    ji.log_added(np.array([1, 2]), _vecs(2))
+
+    def locked(*args, **kwargs):
+        raise PermissionError("music.index is open in another process")
+
+    monkeypatch.setattr(vector_journal, "save_index", locked)
+    assert ji.maybe_checkpoint(force=True) is False
+    assert len(j) == 2 and ji.pending == 2
+
+    monkeypatch.undo()
+    assert ji.maybe_checkpoint(force=True) is True
+    assert len(j) == 0 and ji.pending == 0
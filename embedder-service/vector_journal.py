@@ -0,0 +1,186 @@
+﻿import os
+import time
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from config import FAISS_JOURNAL_PATH, EMBEDDING_DIM, INDEX_CHECKPOINT_SECONDS, INDEX_CHECKPOINT_RECORDS
+from faiss_index import (
+    load_index, save_index, has_stable_ids, supports_remove, contains_id, remove_from_index, remove_ids
+)
+from logger import logger
+
+OP_ADD = 1  # upsert when the index has stable ids
+OP_REMOVE = 2
+
+_MAGIC = b"UMSJ"
+_VERSION = 1
+_HEADER_BYTES = 16
+
+
+def _record_dtype(dim: int) -> np.dtype:
+    return np.dtype([("op", "u1"), ("id", "<i8"), ("vec", "<f4", (dim,))])
+
+
+class VectorJournal:
+    # append-only (op, faiss id, vector) records behind a 16-byte header; fsync'd once per append
+    def __init__(self, path: str = FAISS_JOURNAL_PATH, dim: int = EMBEDDING_DIM):
+        p = Path(path).resolve()
+        p.parent.mkdir(parents=True, exist_ok=True)
+        self.path = str(p)
+        self.dim = int(dim)
+        self.dtype = _record_dtype(self.dim)
+        self._open()
+
+    def _header(self) -> bytes:
+        return _MAGIC + np.array([_VERSION, self.dim], dtype="<u4").tobytes() + bytes(4)
+
+    def _open(self) -> None:
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < _HEADER_BYTES:
+            self.reset()
+            return
+        with open(self.path, "rb") as f:
+            header = f.read(_HEADER_BYTES)
+        if header[:4] != _MAGIC or int(np.frombuffer(header[8:12], "<u4")[0]) != self.dim:
+            raise RuntimeError(f"Not a vector journal for dim={self.dim}: {self.path}")
+
+        body = os.path.getsize(self.path) - _HEADER_BYTES
+        torn = body % self.dtype.itemsize
+        if torn:
+            # a crash mid-append leaves a partial record; it was never acknowledged
+            logger.warning(f"Dropping {torn} trailing bytes of a torn journal record in {self.path}")
+            self.truncate(body // self.dtype.itemsize)
+
+    def __len__(self) -> int:
+        return (os.path.getsize(self.path) - _HEADER_BYTES) // self.dtype.itemsize
+
+    def truncate(self, n: int) -> None:
+        # keep the first n records
+        with open(self.path, "r+b") as f:
+            f.truncate(_HEADER_BYTES + n * self.dtype.itemsize)
+            os.fsync(f.fileno())
+
+    def append(self, ids: np.ndarray, vecs: np.ndarray, op: int = OP_ADD) -> None:
+        ids = np.asarray(ids, dtype="<i8").reshape(-1)
+        if not len(ids):
+            return
+        recs = np.zeros(len(ids), dtype=self.dtype)
+        recs["op"] = op
+        recs["id"] = ids
+        recs["vec"] = np.asarray(vecs, dtype="<f4").reshape(len(ids), self.dim)
+        with open(self.path, "ab") as f:
+            f.write(recs.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read(self) -> np.ndarray:
+        n = len(self)
+        if n == 0:
+            return np.zeros(0, dtype=self.dtype)
+        return np.memmap(self.path, dtype=self.dtype, mode="r", offset=_HEADER_BYTES, shape=(n,))
+
+    def reset(self) -> None:
+        with open(self.path, "wb") as f:
+            f.write(self._header())
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class JournaledIndex:
+    # the last music.index checkpoint plus a journal of everything added since
+    def __init__(self, checkpoint_seconds: float = INDEX_CHECKPOINT_SECONDS,
+                 checkpoint_records: int = INDEX_CHECKPOINT_RECORDS,
+                 journal: Optional[VectorJournal] = None, index_path: Optional[str] = None):
+        self.checkpoint_seconds = checkpoint_seconds
+        self.checkpoint_records = checkpoint_records
+        self.index_path = index_path
+        self.index = load_index(index_path)
+        self.journal = journal if journal is not None else VectorJournal()  # an empty journal is falsy
+        self.pending = self._replay()
+        self.last_checkpoint = time.time()
+
+    def _replay(self) -> int:
+        recs = self.journal.read()
+        if not len(recs):
+            return 0
+        if has_stable_ids(self.index):
+            return self._replay_stable(recs)
+        adds = recs[recs["op"] == OP_ADD]
+        # records at or below the checkpoint's ntotal are already inside music.index
+        adds = adds[adds["id"] >= self.index.ntotal]
+        expected = np.arange(self.index.ntotal, self.index.ntotal + len(adds))
+        if not np.array_equal(adds["id"], expected):
+            raise RuntimeError(f"Journal {self.journal.path} does not continue index at ntotal={self.index.ntotal}")
+        if len(adds):
+            self.index.add(np.ascontiguousarray(adds["vec"]))
+        logger.info(f"Replayed {len(adds)} journal records (ntotal={self.index.ntotal})")
+        return len(recs)
+
+    def _replay_stable(self, recs: np.ndarray) -> int:
+        # last record per id wins, which also makes replaying records already in the checkpoint harmless
+        ids = recs["id"]
+        _, last_rev = np.unique(ids[::-1], return_index=True)
+        last = np.sort(len(ids) - 1 - last_rev)
+        final = recs[last]
+        adds = final[final["op"] == OP_ADD]
+        if supports_remove(self.index):
+            remove_ids(self.index, final["id"])
+        else:
+            adds = self._unseen(final, adds)
+        if len(adds):
+            self.index.add_with_ids(np.ascontiguousarray(adds["vec"]), np.ascontiguousarray(adds["id"]))
+        logger.info(f"Replayed {len(recs)} journal records: {len(adds)} upserts, "
+                    f"{int((final['op'] == OP_REMOVE).sum())} removals (ntotal={self.index.ntotal})")
+        return len(recs)
+
+    def _unseen(self, final: np.ndarray, adds: np.ndarray) -> np.ndarray:
+        # HNSW: like upsert_batch_to_index, only ids not in the checkpoint are added and nothing is replaced
+        if (final["op"] == OP_REMOVE).any():
+            raise RuntimeError(f"Journal {self.journal.path} removes ids from an HNSW index, which cannot remove")
+        present = np.array([contains_id(self.index, i) for i in adds["id"].tolist()], dtype=bool)
+        for rec in adds[present]:
+            if not np.allclose(self.index.reconstruct(int(rec["id"])), rec["vec"], atol=1e-6):
+                raise RuntimeError(f"Journal {self.journal.path} replaces id {rec['id']} in an HNSW index; "
+                                   f"rebuild with index_migrate")
+        return adds[~present]
+
+    def log_removed(self, ids: np.ndarray) -> None:
+        ids = np.asarray(ids, dtype="int64")
+        self.journal.append(ids, np.zeros((len(ids), self.journal.dim), dtype="float32"), op=OP_REMOVE)
+        self.pending += len(ids)
+
+    def log_added(self, ids: np.ndarray, vecs: np.ndarray) -> None:
+        self.journal.append(ids, vecs, op=OP_ADD)
+        self.pending += len(ids)
+
+    def unlog_added(self, n: int) -> None:
+        # drops the last n records again: a positional batch rolled back by the writer under its lock
+        self.journal.truncate(len(self.journal) - n)
+        self.pending -= n
+
+    def remove(self, ids: np.ndarray) -> int:
+        n = remove_from_index(self.index, ids)
+        self.log_removed(ids)
+        return n
+
+    def checkpoint(self) -> None:
+        save_index(self.index, self.index_path)
+        self.journal.reset()
+        self.pending = 0
+        self.last_checkpoint = time.time()
+
+    def maybe_checkpoint(self, force: bool = False) -> bool:
+        due = (self.pending >= self.checkpoint_records
+               or (self.pending and time.time() - self.last_checkpoint >= self.checkpoint_seconds))
+        if (force and self.pending) or due:
+            try:
+                self.checkpoint()
+            except Exception as e:
+                # e.g. PermissionError on Windows while a searcher holds music.index open: the journal
+                # still has every pending record, so the next cycle simply tries again
+                logger.exception(f"Checkpoint of {self.index_path or 'music.index'} failed, retrying later: {e}")
+                self.last_checkpoint = time.time()
+                return False
+            return True
+        return False
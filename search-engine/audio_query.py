@@ -0,0 +1,82 @@
+﻿# audio_query.py
+import os
+import sys
+import json
+import time
+import threading
+import subprocess
+from typing import Optional
+
+import numpy as np
+
+from config import EMBEDDER_DIR, EMBEDDER_ARGS
+
+
+class AudioEmbedder:
+    # one long-lived embedder-service process (embed_worker.py): the model loads once, each query pays prep + forward
+    def __init__(self, embedder_dir: str = EMBEDDER_DIR, args: tuple = EMBEDDER_ARGS, python: Optional[str] = None):
+        self.embedder_dir = embedder_dir
+        self.args = list(args)
+        self.python = python or sys.executable
+        self.proc: Optional[subprocess.Popen] = None
+        self.info: dict = {}
+        self._lock = threading.Lock()
+
+    def start(self) -> dict:
+        # the embedder has its own config/logger modules, so it runs in its own directory and interpreter
+        self.proc = subprocess.Popen(
+            [self.python, "embed_worker.py", *self.args],
+            cwd=self.embedder_dir, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        )
+        while True:
+            line = self.proc.stdout.readline()
+            if not line:
+                raise RuntimeError(f"embed worker exited during startup (code={self.proc.wait()})")
+            try:
+                self.info = json.loads(line)
+            except ValueError:
+                continue  # stray output printed before the worker took over stdout
+            if self.info.get("ready"):
+                return self.info
+
+    def _call(self, header: dict, payload: bytes = b"") -> tuple[np.ndarray, dict]:
+        with self._lock:
+            if self.proc is None or self.proc.poll() is not None:
+                self.start()
+            t = time.perf_counter()
+            header = {**header, "nbytes": len(payload)}
+            self.proc.stdin.write((json.dumps(header) + "\n").encode("utf-8") + payload)
+            self.proc.stdin.flush()
+            line = self.proc.stdout.readline()
+            if not line:
+                self.proc = None
+                raise RuntimeError("embed worker exited")
+            reply = json.loads(line)
+            if not reply.get("ok"):
+                raise ValueError(reply.get("error", "embedding failed"))
+            vec = np.frombuffer(self.proc.stdout.read(4 * reply["dim"]), dtype="<f4").astype("float32")
+            timings = reply["timings"]
+            timings["ipc_s"] = time.perf_counter() - t - timings.get("worker_s", 0.0)
+            return vec, timings
+
+    def embed_file(self, path: str, denoise: bool = False) -> tuple[np.ndarray, dict]:
+        return self._call({"op": "file", "path": os.path.abspath(path), "denoise": denoise})
+
+    def embed_pcm(self, pcm: bytes, sr: int, fmt: str = "f32le", channels: int = 1,
+                  denoise: bool = False) -> tuple[np.ndarray, dict]:
+        return self._call({"op": "pcm", "sr": int(sr), "format": fmt, "channels": int(channels), "denoise": denoise},
+                          pcm)
+
+    def close(self) -> None:
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.stdin.close()
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        self.proc = None
+
+
+def unit(vec: np.ndarray) -> np.ndarray:
+    # the embedder stores unit vectors, so inner product is cosine
+    return (vec / (float(np.linalg.norm(vec)) or 1.0)).astype("float32")
@@ -1,4 +1,27 @@
+import os
+
 MUSIC_IDX = r"C:\Users\antep\Desktop\UMS\embedder-service\faiss\music.index"
 TEST_IDX = r"C:\Users\antep\Desktop\UMS\embedder-service\faiss\query.index"
 MAP_CSV = r"C:\Users\antep\Desktop\UMS\embedder-service\faiss\mapping.csv"
 TOP_K = 12
+NPROBE = 32  # IVF lists visited per query
+EF_SEARCH = 128  # HNSW candidate list size per query
+REFINE_K_FACTOR = 8  # pq_refine: PQ candidates re-scored at full precision = k * this
+# map index files read-only instead of copying them into each process; off on Windows, where the embedder's
+# os.replace of a checkpoint fails while any process has the old file mapped
+INDEX_MMAP = os.name != "nt"
+RELOAD_POLL_SECONDS = 2.0  # how often the index/mapping files are checked for a new generation (0 = never)
+SHARD_SEARCH_THREADS = 0  # parallel shard searches for a manifest.json index (0 = one per shard)
+# search_service.py
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8088
+BATCH_MAX_QUERIES = 64  # queries merged into one index.search call
+BATCH_WINDOW_MS = 2.0  # how long the first query of a batch waits for company
+KNN_GRAPH_DIR = ""  # embedder-service/faiss/knn to serve /similar from the precomputed graph
+# query-by-audio: embed_worker.py is started from the embedder checkout and kept warm
+EMBEDDER_DIR = r"C:\Users\antep\Desktop\UMS\embedder-service"
+EMBEDDER_ARGS = ()  # e.g. ("--precision", "int8") to match how the index was built
+AUDIO_MAX_BODY_BYTES = 64 << 20  # raw PCM upload limit for /search/audio
+AUDIO_FILE_ROOT = ""  # {"path": ...} audio queries may only read files under this directory ("" = PCM uploads only)
+RESULT_CACHE_MB = 64  # search results kept per generation (0 = off)
+RESULT_CACHE_TTL_SECONDS = 300
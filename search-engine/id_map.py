@@ -0,0 +1,116 @@
+﻿# id_map.py
+import os
+import json
+import uuid
+import bisect
+from collections.abc import Mapping
+from typing import Optional
+
+import numpy as np
+
+# written by embedder-service/mapping_compact.py: rows sorted by fid, by_uuid orders them by GUID bytes
+ENTRY_DTYPE = np.dtype([("fid", "<i8"), ("uuid", "S16"), ("by_uuid", "<i8")])
+
+
+def is_compact(path: str) -> bool:
+    return path.endswith(".npy")
+
+
+def read_compact(path: str) -> tuple[np.ndarray, dict]:
+    # the meta names the current mapping.<version>.npy; a table from before versioning is `path` itself
+    with open(path + ".meta.json", encoding="utf-8") as f:
+        meta = json.load(f)
+    table = os.path.join(os.path.dirname(path), meta["file"]) if meta.get("file") else path
+    rows = np.load(table, mmap_mode="r")
+    if rows.dtype != ENTRY_DTYPE or len(rows) != meta.get("n"):
+        # only a pre-versioning table can change under its meta: a conversion caught halfway
+        raise ValueError(f"{path} does not match its meta file (n={len(rows)} vs {meta.get('n')})")
+    return rows, meta
+
+
+def _padded(raw: bytes) -> bytes:
+    return raw.ljust(16, b"\0")  # numpy drops trailing NULs from S16 values
+
+
+class CompactMapping(Mapping):
+    # read-only faiss id -> track GUID over a mapped mapping.npy; `overlay` holds mapping.csv rows appended after
+    # the conversion ("" = removed), so only the tail costs Python objects
+    def __init__(self, rows: np.ndarray, meta: dict, overlay: Optional[dict[int, str]] = None):
+        self.rows = rows
+        self.fids = rows["fid"]
+        self.uuids = rows["uuid"]
+        self.by_uuid = rows["by_uuid"]
+        self.uppercase = bool(meta.get("uppercase", False))
+        self.extras = {int(k): v for k, v in meta.get("extras", {}).items()}
+        self.overlay = overlay if overlay is not None else {}
+
+        touched = np.fromiter(self.overlay, dtype="int64", count=len(self.overlay))
+        shadowed = int((self._rows_of(touched) >= 0).sum()) + sum(1 for fid in self.overlay if fid in self.extras)
+        self._len = len(rows) + len(self.extras) - shadowed + sum(1 for v in self.overlay.values() if v)
+
+        # GUIDs outside the sorted table, resolved by dict instead of a scan per find(); overlay rows win
+        self._by_track = {v.lower(): fid for fid, v in self.extras.items() if fid not in self.overlay}
+        self._by_track.update((v.lower(), fid) for fid, v in self.overlay.items() if v)
+
+    def _rows_of(self, fids: np.ndarray) -> np.ndarray:
+        # row of each id in the mapped table, -1 where absent
+        if not len(self.fids) or not len(fids):
+            return np.full(len(fids), -1, dtype="int64")
+        r = np.minimum(np.searchsorted(self.fids, fids), len(self.fids) - 1)
+        return np.where(self.fids[r] == fids, r, -1)
+
+    def _format(self, raw: bytes) -> str:
+        s = str(uuid.UUID(bytes=_padded(raw)))
+        return s.upper() if self.uppercase else s
+
+    def lookup_many(self, fids) -> list[Optional[str]]:
+        # one vectorised binary search for a whole result list
+        fids = np.asarray(fids, dtype="int64").ravel()
+        rows = self._rows_of(fids)
+        out = []
+        for fid, r in zip(fids.tolist(), rows.tolist()):
+            if fid in self.overlay:
+                out.append(self.overlay[fid] or None)
+            elif r >= 0:
+                out.append(self._format(self.uuids[r]))
+            else:
+                out.append(self.extras.get(fid))
+        return out
+
+    def __getitem__(self, fid: int) -> str:
+        val = self.lookup_many([fid])[0]
+        if val is None:
+            raise KeyError(fid)
+        return val
+
+    def __contains__(self, fid) -> bool:
+        try:
+            return self.lookup_many([fid])[0] is not None
+        except (TypeError, ValueError):
+            return False
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self):
+        for start in range(0, len(self.fids), 65536):
+            for fid in self.fids[start:start + 65536].tolist():
+                if fid not in self.overlay:
+                    yield fid
+        yield from (fid for fid in self.extras if fid not in self.overlay)
+        yield from (fid for fid, v in self.overlay.items() if v)
+
+    def find(self, track_id: str) -> Optional[int]:
+        # track GUID -> faiss id through the by_uuid order: O(log n) without materialising the sorted column
+        t = track_id.strip().lower()
+        if t in self._by_track:
+            return self._by_track[t]
+        try:
+            key = uuid.UUID(t).bytes
+        except ValueError:
+            return None
+        i = bisect.bisect_left(range(len(self.by_uuid)), key, key=lambda j: _padded(self.uuids[self.by_uuid[j]]))
+        if i == len(self.by_uuid) or _padded(self.uuids[self.by_uuid[i]]) != key:
+            return None
+        fid = int(self.fids[self.by_uuid[i]])
+        return None if fid in self.overlay else fid
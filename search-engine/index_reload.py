@@ -0,0 +1,212 @@
+﻿# index_reload.py
+import os
+import csv
+import json
+import threading
+import time
+from typing import Optional
+
+from config import RELOAD_POLL_SECONDS
+from id_map import CompactMapping, is_compact, read_compact
+from search_music import load_index
+
+
+class MappingTail:
+    # mapping.csv is append-only (removals are tombstone rows), so a refresh parses only the new bytes;
+    # tombstones=True keeps removals as "" entries, for overlaying a compact table built up to `offset`
+    def __init__(self, path: str, offset: int = 0, tombstones: bool = False):
+        self.path = path
+        self.offset = offset
+        self.tombstones = tombstones
+        self.fid_col: Optional[int] = None
+        self.key_col: Optional[int] = None
+        self.id2db: dict[int, str] = {}
+        self.by_track: dict[str, int] = {}  # lower-case GUID -> faiss id, kept in step with id2db
+
+    def _header(self) -> list:
+        with open(self.path, "rb") as f:
+            return next(csv.reader([f.readline().decode("utf-8-sig")]), [])
+
+    def refresh(self) -> dict[int, str]:
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if size < self.offset:
+            # rewritten rather than appended to: start over
+            self.offset, self.fid_col, self.key_col, self.id2db, self.by_track = 0, None, None, {}, {}
+        if size == self.offset:
+            return self.id2db
+
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read(size - self.offset)
+        end = data.rfind(b"\n") + 1  # a half-written last row waits for the next refresh
+        if not end:
+            return self.id2db
+        rows = csv.reader(data[:end].decode("utf-8-sig").splitlines())
+
+        if self.key_col is None:
+            header = next(rows, []) if self.offset == 0 else self._header()
+            if "faiss_id" not in header:
+                return self.id2db
+            self.fid_col = header.index("faiss_id")
+            self.key_col = header.index("db_id") if "db_id" in header else header.index("filename")
+
+        # copy: the previous generation may still be answering queries with its dicts
+        m = dict(self.id2db)
+        rev = dict(self.by_track)
+        for row in rows:
+            try:
+                fid = int(row[self.fid_col])
+            except (ValueError, IndexError):
+                continue
+            db_id = row[self.key_col] if len(row) > self.key_col else ""
+            old = m.get(fid)
+            if old and rev.get(old.lower()) == fid:
+                del rev[old.lower()]
+            if db_id:
+                m[fid] = db_id
+                rev[db_id.lower()] = fid
+            elif self.tombstones:
+                m[fid] = ""
+            else:
+                m.pop(fid, None)
+        self.offset += end
+        self.id2db = m
+        self.by_track = rev
+        return m
+
+
+class CompactMappingTail:
+    # same refresh() contract for a mapping.npy from embedder-service/mapping_compact.py: the table is mapped,
+    # mapping.csv is tailed from the offset the conversion stopped at
+    def __init__(self, path: str):
+        self.path = path
+        self.sig = None
+        self.rows = None
+        self.meta: dict = {}
+        self.tail: Optional[MappingTail] = None
+        self.id2db: Optional[CompactMapping] = None
+
+    def csv_path(self) -> Optional[str]:
+        if self.meta.get("csv_offset") is None:
+            return None
+        return os.path.join(os.path.dirname(os.path.abspath(self.path)), self.meta.get("csv_path", "mapping.csv"))
+
+    def refresh(self) -> CompactMapping:
+        sig = (_stat(self.path), _stat(self.path + ".meta.json"))
+        if sig != self.sig:
+            try:
+                self.rows, self.meta = read_compact(self.path)
+            except (OSError, ValueError) as e:
+                if self.id2db is None:
+                    raise
+                print(f"WARN: keeping the previous compact mapping: {e}")
+            else:
+                self.sig = sig
+                csv_path = self.csv_path()
+                self.tail = MappingTail(csv_path, self.meta["csv_offset"], tombstones=True) if csv_path else None
+                self.id2db = None
+
+        overlay = self.tail.refresh() if self.tail is not None else {}
+        if self.id2db is None or overlay is not self.id2db.overlay:
+            self.id2db = CompactMapping(self.rows, self.meta, overlay)
+        return self.id2db
+
+
+class Generation:
+    def __init__(self, number: int, index, id2db: dict[int, str], index_sig, map_sig,
+                 by_track: Optional[dict[str, int]] = None):
+        self.number = number
+        self.index = index
+        self.id2db = id2db
+        self.by_track = by_track
+        self.index_sig = index_sig
+        self.map_sig = map_sig
+        self.loaded_at = time.time()
+
+    def find_track(self, track_id: str) -> Optional[int]:
+        # track GUID -> faiss id without walking the mapping: a CompactMapping searches its table,
+        # a CSV mapping has the reverse dict MappingTail built alongside it
+        if hasattr(self.id2db, "find"):
+            return self.id2db.find(track_id)
+        return (self.by_track or {}).get(track_id.strip().lower())
+
+
+def _stat(path: str):
+    # os.replace by the embedder gives a new inode even when size and mtime look unchanged
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class HotIndex:
+    # readers take `current` once per query and keep using that generation; reloads build the next one beside it
+    def __init__(self, idx_path: str, map_path: str, poll_seconds: float = RELOAD_POLL_SECONDS):
+        self.idx_path = idx_path
+        self.map_path = map_path
+        self.mapping = CompactMappingTail(map_path) if is_compact(map_path) else MappingTail(map_path)
+        self._lock = threading.Lock()
+        self._retired: Optional[Generation] = None
+        self._stop = threading.Event()
+
+        index_sig = self._index_signature()
+        id2db = self.mapping.refresh()
+        self.current = Generation(1, load_index(idx_path), id2db, index_sig, self._map_signature(), self._by_track())
+
+        self._thread = None
+        if poll_seconds > 0:
+            self._thread = threading.Thread(target=self._watch, args=(poll_seconds,), name="index-reload", daemon=True)
+            self._thread.start()
+
+    def _by_track(self) -> Optional[dict[str, int]]:
+        return getattr(self.mapping, "by_track", None)
+
+    def _index_signature(self):
+        if not self.idx_path.endswith(".json"):
+            return (_stat(self.idx_path),)
+        # shard manifest: the manifest itself plus every shard's index and tombstone file
+        files = [self.idx_path]
+        try:
+            root = os.path.dirname(os.path.abspath(self.idx_path))
+            with open(self.idx_path, encoding="utf-8") as f:
+                for s in json.load(f)["shards"]:
+                    files += [os.path.join(root, s["index"]), os.path.join(root, s["deleted"])]
+        except (OSError, ValueError, KeyError):
+            pass
+        return tuple(_stat(p) for p in files)
+
+    def _map_signature(self):
+        if isinstance(self.mapping, CompactMappingTail):
+            return _stat(self.map_path), _stat(self.map_path + ".meta.json"), _stat(self.mapping.csv_path() or "")
+        return _stat(self.map_path)
+
+    def reload_if_changed(self) -> bool:
+        with self._lock:
+            cur = self.current
+            # signatures are taken before loading, so a write that lands mid-load triggers one more reload
+            index_sig = self._index_signature()
+            map_sig = self._map_signature()
+            if index_sig == cur.index_sig and map_sig == cur.map_sig:
+                return False
+            try:
+                index = load_index(self.idx_path) if index_sig != cur.index_sig else cur.index
+                id2db = self.mapping.refresh()
+            except Exception as e:
+                print(f"WARN: reload failed, keeping generation {cur.number}: {e}")
+                return False
+
+            # the generation before `cur` has had a full poll interval to finish its queries
+            if self._retired is not None and self._retired.index is not cur.index and hasattr(self._retired.index, "close"):
+                self._retired.index.close()
+            self._retired = cur
+            self.current = Generation(cur.number + 1, index, id2db, index_sig, map_sig, self._by_track())
+        print(f"Reloaded generation {self.current.number} (ntotal={index.ntotal}, mapping={len(id2db)})")
+        return True
+
+    def _watch(self, poll_seconds: float) -> None:
+        while not self._stop.wait(poll_seconds):
+            self.reload_if_changed()
+
+    def stop(self) -> None:
+        self._stop.set()
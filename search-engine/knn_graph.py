@@ -0,0 +1,38 @@
+﻿# knn_graph.py
+import os
+import json
+from typing import Optional
+
+import numpy as np
+
+# written by embedder-service/knn_graph.py; row r of neighbors/scores belongs to ids[r] (ids sorted ascending)
+IDS_FILE = "ids.npy"
+NEIGHBORS_FILE = "neighbors.npy"
+SCORES_FILE = "scores.npy"
+META_FILE = "meta.json"
+
+
+class KnnGraph:
+    # precomputed "similar tracks": a binary search over the mmap'd ids, then one row read, no index search
+    def __init__(self, root: str):
+        with open(os.path.join(root, META_FILE), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.ids = np.load(os.path.join(root, IDS_FILE), mmap_mode="r")
+        self.neighbors = np.load(os.path.join(root, NEIGHBORS_FILE), mmap_mode="r")
+        self.scores = np.load(os.path.join(root, SCORES_FILE), mmap_mode="r")
+
+    @property
+    def k(self) -> int:
+        return int(self.neighbors.shape[1])
+
+    def row(self, faiss_id: int) -> Optional[int]:
+        r = int(np.searchsorted(self.ids, faiss_id))
+        return r if r < len(self.ids) and int(self.ids[r]) == faiss_id else None
+
+    def lookup(self, faiss_id: int, k: Optional[int] = None) -> Optional[tuple[np.ndarray, np.ndarray]]:
+        r = self.row(faiss_id)
+        if r is None:
+            return None
+        nb, sc = self.neighbors[r, :k], self.scores[r, :k]
+        keep = nb >= 0
+        return np.asarray(sc[keep], dtype="float32"), np.asarray(nb[keep])
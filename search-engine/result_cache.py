@@ -0,0 +1,87 @@
+﻿# result_cache.py
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+from config import RESULT_CACHE_MB, RESULT_CACHE_TTL_SECONDS
+
+ENTRY_OVERHEAD_BYTES = 200  # key tuple, entry tuple and OrderedDict node, roughly
+
+
+def vector_key(vec: np.ndarray) -> str:
+    return hashlib.blake2b(np.ascontiguousarray(vec, dtype="float32").tobytes(), digest_size=16).hexdigest()
+
+
+def cache_key(kind: str, query, k: int, include_self: bool = False, filters: tuple = ()) -> tuple:
+    # query is a FAISS id for kind="id", a vector_key() digest for kind="vector"
+    return kind, query, int(k), bool(include_self), tuple(filters)
+
+
+class ResultCache:
+    # LRU over raw (scores, ids) search results, bounded by bytes and TTL, emptied whenever the index generation moves
+    def __init__(self, max_mb: float = RESULT_CACHE_MB, ttl_seconds: float = RESULT_CACHE_TTL_SECONDS):
+        self.max_bytes = int(max_mb * (1 << 20))
+        self.ttl = ttl_seconds
+        self.entries: OrderedDict = OrderedDict()
+        self.bytes = 0
+        self.generation: Optional[int] = None
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def _sync_generation(self, generation: int) -> bool:
+        # False for a request still running against an older generation: it neither reads nor replaces the cache
+        if self.generation is not None and generation < self.generation:
+            return False
+        if generation != self.generation:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.bytes = 0
+            self.generation = generation
+        return True
+
+    def get(self, key: tuple, generation: int) -> Optional[tuple[np.ndarray, np.ndarray]]:
+        with self._lock:
+            entry = self.entries.get(key) if self._sync_generation(generation) else None
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, sims, ids, nbytes = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                self.bytes -= nbytes
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return sims, ids
+
+    def put(self, key: tuple, generation: int, sims: np.ndarray, ids: np.ndarray) -> None:
+        nbytes = sims.nbytes + ids.nbytes + ENTRY_OVERHEAD_BYTES
+        if self.max_bytes <= 0 or nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if not self._sync_generation(generation):
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[3]
+            # copies: the arguments are usually views into a whole batch's result matrix
+            self.entries[key] = (time.monotonic() + self.ttl, sims.copy(), ids.copy(), nbytes)
+            self.bytes += nbytes
+            while self.bytes > self.max_bytes:
+                _, (_, _, _, evicted) = self.entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"entries": len(self.entries), "bytes": self.bytes, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions, "expirations": self.expirations, "invalidations": self.invalidations,
+                "generation": self.generation}
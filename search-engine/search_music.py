@@ -2,12 +2,16 @@
 import os
 import csv
 import sys
-from typing import Optional
+import json
+import time
+import uuid
+import hashlib
+from typing import Callable, Optional
 
 import faiss
 import numpy as np
 
-from config import MUSIC_IDX, MAP_CSV, TOP_K  # TEST_IDX not used anymore
+from config import MUSIC_IDX, MAP_CSV, TOP_K, NPROBE, EF_SEARCH, REFINE_K_FACTOR, INDEX_MMAP  # TEST_IDX not used anymore
 
 
 # ---------- helpers ----------
@@ -48,6 +52,11 @@ def prompt_yesno(prompt: str, default_no: bool = True) -> bool:
 def load_mapping(path: str) -> dict[int, str]:
     if not os.path.exists(path):
         sys.exit(f"ERR: mapping not found: {path}")
+    if path.endswith(".npy"):
+        # compact table from embedder-service/mapping_compact.py, plus the CSV rows written after it
+        from index_reload import CompactMappingTail
+
+        return CompactMappingTail(path).refresh()
     m: dict[int, str] = {}
     with open(path, newline="", encoding="utf-8") as f:
         reader = csv.DictReader(f)
@@ -56,21 +65,123 @@ def load_mapping(path: str) -> dict[int, str]:
             return m
         for row in reader:
             try:
-                m[int(row["faiss_id"])] = row[key_name]
+                fid = int(row["faiss_id"])
             except Exception:
                 continue
+            if row[key_name]:
+                m[fid] = row[key_name]
+            else:
+                m.pop(fid, None)  # tombstone written when a track is removed from the index
     return m
 
 
-def load_index(idx_path: str):
+def track_faiss_id(track_id: str) -> int:
+    # must match embedder-service/faiss_index.track_faiss_id
+    try:
+        key = str(uuid.UUID(str(track_id)))
+    except ValueError:
+        key = str(track_id)
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big") & 0x7FFFFFFFFFFFFFFF
+
+
+def parse_query_id(s: str, find_track: Callable[[str], Optional[int]]) -> Optional[int]:
+    # a FAISS id, or a track GUID from the DB; find_track is Generation.find_track, never a scan of the mapping
+    s = s.strip()
+    try:
+        return int(s)
+    except ValueError:
+        pass
+    fid = find_track(s)
+    if fid is not None:
+        return fid
+    try:
+        return track_faiss_id(s)
+    except Exception:
+        return None
+
+
+def lookup_tracks(id2db, fids) -> list[Optional[str]]:
+    # a CompactMapping resolves a whole result list in one vectorised pass
+    if hasattr(id2db, "lookup_many"):
+        return id2db.lookup_many(fids)
+    return [id2db.get(int(fid)) for fid in fids]
+
+
+def index_kind(index) -> str:
+    if not isinstance(index, faiss.Index):
+        return "+".join(index.kinds)  # ShardSet
+    base = faiss.downcast_index(index)
+    if isinstance(base, faiss.IndexIDMap):
+        base = faiss.downcast_index(base.index)
+    if isinstance(base, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(base, faiss.IndexIVF):
+        return "ivf_flat"
+    if isinstance(base, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(base, faiss.IndexRefine):
+        return "pq_refine"
+    if isinstance(base, faiss.IndexScalarQuantizer):
+        return "fp16" if base.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "sq8"
+    return "flat"
+
+
+def apply_search_params(index, nprobe: int = NPROBE, ef_search: int = EF_SEARCH, k_factor: int = REFINE_K_FACTOR):
+    ps = faiss.ParameterSpace()
+    kind = index_kind(index)
+    if kind in ("ivf_flat", "ivf_pq"):
+        ps.set_index_parameter(index, "nprobe", int(nprobe))
+        ivf = faiss.extract_index_ivf(index)
+        if ivf.direct_map.type == faiss.DirectMap.NoMap:
+            ivf.make_direct_map()  # needed by reconstruct(); stable-id indexes already carry a hashtable
+    elif kind == "hnsw":
+        ps.set_index_parameter(index, "efSearch", int(ef_search))
+    elif kind == "pq_refine":
+        # the float32 rows stay in the mapped file; only k * k_factor of them are touched per query
+        base = faiss.downcast_index(index)
+        base = faiss.downcast_index(base.index) if isinstance(base, faiss.IndexIDMap) else base
+        base.k_factor = float(k_factor)
+
+
+def _mmap_flags(idx_path: str) -> int:
+    # IVF inverted lists and flat code arrays are mapped by different flags; the embedder's meta file says which
+    kind = ""
+    try:
+        with open(idx_path + ".meta.json", encoding="utf-8") as f:
+            kind = json.load(f).get("type", "")
+    except (OSError, ValueError):
+        pass
+    flag = faiss.IO_FLAG_MMAP if kind.startswith("ivf") else faiss.IO_FLAG_MMAP_IFC
+    return flag | faiss.IO_FLAG_READ_ONLY
+
+
+def read_index(idx_path: str, mmap: bool = INDEX_MMAP):
+    # mapped read-only: opening is O(1) and replicas on one host share the page cache
+    if mmap:
+        try:
+            return faiss.read_index(idx_path, _mmap_flags(idx_path))
+        except RuntimeError as e:
+            print(f"WARN: could not mmap {idx_path} ({e}); reading it into memory")
     return faiss.read_index(idx_path)
 
 
-def reconstruct_vec(index, fid: int) -> np.ndarray:
-    ntotal = index.ntotal
-    if fid < 0 or fid >= ntotal:
-        sys.exit(f"ERR: query id {fid} out of range [0, {ntotal - 1}]")
-    v = index.reconstruct(fid)  # works for IndexFlat*
+def load_index(idx_path: str):
+    if idx_path.endswith(".json"):
+        # embedder shard manifest: searched in parallel, merged to an exact top-k
+        from shard_search import ShardSet
+
+        return ShardSet(idx_path, prepare=apply_search_params, kind_of=index_kind, reader=read_index)
+    index = read_index(idx_path)
+    apply_search_params(index)
+    return index
+
+
+def reconstruct_vec(index, fid: int) -> Optional[np.ndarray]:
+    # ids are positional (0..ntotal-1) on legacy indexes and per-track hashes on stable-id ones
+    try:
+        v = index.reconstruct(int(fid))  # IVF needs the direct map set up in apply_search_params
+    except RuntimeError:
+        return None
     return np.asarray(v, dtype="float32")
 
 
@@ -91,49 +202,80 @@ def cos_to_pct(cos_arr: np.ndarray) -> np.ndarray:
 # ---------- main interactive loop ----------
 
 def main():
-    print("\n=== FAISS music search (query by FAISS id from music.index) ===\n")
+    print("\n=== FAISS music search (query by FAISS id, track id or audio file) ===\n")
 
     # choose paths (with defaults from config)
-    idx_path = prompt_path("Path to music.index", MUSIC_IDX)
-    map_path = prompt_path("Path to mapping.csv", MAP_CSV)
+    idx_path = prompt_path("Path to music.index or shards/manifest.json", MUSIC_IDX)
+    map_path = prompt_path("Path to mapping.csv or compact mapping.npy", MAP_CSV)
+
+    # files are watched: a checkpoint by the embedder shows up as a new generation without a restart
+    from index_reload import HotIndex
 
-    # load once; you can restart program to switch paths
-    index = load_index(idx_path)
-    id2db = load_mapping(map_path)
+    hot = HotIndex(idx_path, map_path)
+    index, id2db = hot.current.index, hot.current.id2db
 
-    print(f"\nLoaded index: {os.path.abspath(idx_path)} (ntotal={index.ntotal})")
+    print(f"\nLoaded index: {os.path.abspath(idx_path)} (type={index_kind(index)}, ntotal={index.ntotal})")
     print(f"Loaded mapping: {os.path.abspath(map_path)} (entries={len(id2db)})\n")
 
-    default_qid = 0
+    default_qid = next(iter(id2db), 0)
     default_k = TOP_K
+    embedder = None  # started on the first audio query, then kept warm
 
     while True:
+        gen = hot.current
+        index, id2db = gen.index, gen.id2db
         if index.ntotal == 0:
             print("Index is empty. Exiting.")
             return
 
-        qid = prompt_int("Query FAISS id", default_qid, lo=0, hi=index.ntotal - 1)
+        raw = input(f"Query FAISS id, track id or audio file [{default_qid}]: ").strip().strip('"') or str(default_qid)
+        timings = None
+        if os.path.isfile(raw):
+            from audio_query import AudioEmbedder, unit
+
+            try:
+                if embedder is None:
+                    print("Starting the audio embedder (one-time model load)...")
+                    embedder = AudioEmbedder()
+                    embedder.start()
+                vec, timings = embedder.embed_file(raw)
+            except (ValueError, RuntimeError) as e:
+                # RuntimeError: the embed worker died or failed to start; the next audio query starts it again
+                print(f"Could not embed {raw}: {e}")
+                continue
+            qid, q_vec = None, unit(vec)
+        else:
+            qid = parse_query_id(raw, gen.find_track)
+            q_vec = reconstruct_vec(index, qid) if qid is not None else None
+            if q_vec is None:
+                print("Not in the index.")
+                continue
         k = prompt_int("Top-K", default_k, lo=1, hi=index.ntotal)
-        include_self = prompt_yesno("Include the query item itself in results?", default_no=True)
+        include_self = qid is None or prompt_yesno("Include the query item itself in results?", default_no=True)
 
-        q_vec = reconstruct_vec(index, qid)
-        D, I = search(index, q_vec, k, exclude_id=None if include_self else qid)
+        t = time.perf_counter()
+        D, I = search(index, q_vec, k, exclude_id=None if include_self or qid is None else qid)
         pct = cos_to_pct(np.asarray(D))
 
-        q_db = id2db.get(qid, "<unknown>")
-
-        print(f"\nQuery: FAISS id={qid}  DB={q_db}")
-        print(f"Index: {idx_path}  (ntotal={index.ntotal})\n")
-        print(f"{'Rk':<3} {'Score':>6}  {'FAISS_ID':>8}  DB_ID")
-        print("-" * 60)
-        for r, (sim, fid) in enumerate(zip(pct, I), start=1):
-            print(f"{r:<3} {sim:6.1f}  {int(fid):8d}  {id2db.get(int(fid), '<unknown>')}")
+        if qid is None:
+            timings["search_s"] = time.perf_counter() - t
+            print(f"\nQuery: audio {raw}")
+            print("Timings: " + "  ".join(f"{name}={v * 1000:.1f}ms" for name, v in timings.items() if name != "audio_s"))
+        else:
+            print(f"\nQuery: FAISS id={qid}  DB={id2db.get(qid, '<unknown>')}")
+        print(f"Index: {idx_path}  (ntotal={index.ntotal}, generation={gen.number})\n")
+        print(f"{'Rk':<3} {'Score':>6}  {'FAISS_ID':>19}  DB_ID")
+        print("-" * 72)
+        for r, (sim, fid, db_id) in enumerate(zip(pct, I, lookup_tracks(id2db, I)), start=1):
+            print(f"{r:<3} {sim:6.1f}  {int(fid):19d}  {db_id or '<unknown>'}")
         print()
 
-        default_qid = qid
+        default_qid = qid if qid is not None else raw
         default_k = k
         if not prompt_yesno("Search again?", default_no=False):
             break
+    if embedder is not None:
+        embedder.close()
 
 
 if __name__ == "__main__":
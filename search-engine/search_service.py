@@ -0,0 +1,369 @@
+﻿# search_service.py
+import os
+import json
+import time
+import asyncio
+import argparse
+from typing import Optional
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+
+from config import (
+    MUSIC_IDX, MAP_CSV, TOP_K, SERVICE_HOST, SERVICE_PORT, BATCH_MAX_QUERIES, BATCH_WINDOW_MS, KNN_GRAPH_DIR,
+    AUDIO_MAX_BODY_BYTES, AUDIO_FILE_ROOT, RESULT_CACHE_MB
+)
+from audio_query import AudioEmbedder, unit
+from index_reload import HotIndex
+from knn_graph import KnnGraph, META_FILE
+from result_cache import ResultCache, cache_key, vector_key
+from search_music import parse_query_id, lookup_tracks, reconstruct_vec, cos_to_pct
+
+MAX_K = 1000
+MAX_BODY_BYTES = 1 << 20
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class MicroBatcher:
+    # concurrent queries wait at most BATCH_WINDOW_MS and are answered by one index.search over an (n, d) matrix
+    def __init__(self, hot: HotIndex, max_queries: int = BATCH_MAX_QUERIES, window_ms: float = BATCH_WINDOW_MS):
+        self.hot = hot
+        self.max_queries = max_queries
+        self.window = window_ms / 1000.0
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.batches = 0
+        self.queries = 0
+
+    async def search(self, vec: np.ndarray, k: int, exclude_id: Optional[int] = None):
+        fut = asyncio.get_running_loop().create_future()
+        await self.queue.put((vec, k, exclude_id, fut))
+        return await fut
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_queries:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            gen = self.hot.current
+            Q = np.stack([vec for vec, _, _, _ in batch]).astype("float32")
+            want = max(k + (exclude is not None) for _, k, exclude, _ in batch)
+            try:
+                # faiss releases the GIL, so the event loop keeps accepting requests during the search
+                D, I = await loop.run_in_executor(None, gen.index.search, Q, want)
+            except Exception as e:
+                for *_, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            self.batches += 1
+            self.queries += len(batch)
+
+            for row, (_, k, exclude, fut) in enumerate(batch):
+                sims, ids = D[row], I[row]
+                keep = ids >= 0
+                if exclude is not None:
+                    keep &= ids != exclude
+                if not fut.done():
+                    fut.set_result((gen, sims[keep][:k], ids[keep][:k]))
+
+
+def _results(gen, sims: np.ndarray, ids: np.ndarray) -> list:
+    pct = cos_to_pct(np.asarray(sims))
+    return [
+        {"rank": r, "faiss_id": int(fid), "track_id": tid, "score": float(sim), "pct": round(float(p), 1)}
+        for r, (sim, fid, p, tid) in enumerate(zip(sims, ids, pct, lookup_tracks(gen.id2db, ids)), start=1)
+    ]
+
+
+def _local_audio_path(root: str, path: str) -> str:
+    # the path is resolved (symlinks and ..) before the check, so a client cannot step outside `root`
+    if not root:
+        raise HTTPError(403, "local audio paths are disabled; upload PCM instead (or start with --audio-root)")
+    root = os.path.realpath(root)
+    full = os.path.realpath(os.path.join(root, path))
+    try:
+        inside = os.path.normcase(os.path.commonpath([root, full])) == os.path.normcase(root)
+    except ValueError:
+        inside = False  # different drives on Windows
+    if not inside:
+        raise HTTPError(403, "path is outside the audio root")
+    if not os.path.isfile(full):
+        raise HTTPError(404, "no such audio file")
+    return full
+
+
+def _int_param(params: dict, name: str, default: int, lo: int, hi: int) -> int:
+    raw = params.get(name, default)
+    try:
+        val = int(raw[0] if isinstance(raw, list) else raw)
+    except (TypeError, ValueError):
+        raise HTTPError(400, f"'{name}' must be an integer")
+    if not lo <= val <= hi:
+        raise HTTPError(400, f"'{name}' must be in [{lo}, {hi}]")
+    return val
+
+
+class SearchService:
+    def __init__(self, hot: HotIndex, batcher: MicroBatcher, knn_dir: str = KNN_GRAPH_DIR,
+                 audio: Optional[AudioEmbedder] = None, cache: Optional[ResultCache] = None,
+                 audio_root: str = AUDIO_FILE_ROOT):
+        self.hot = hot
+        self.batcher = batcher
+        self.audio = audio
+        self.audio_root = audio_root
+        self.cache = cache
+        self.started = time.time()
+        self.knn_dir = knn_dir
+        self._knn: Optional[KnnGraph] = None
+        self._knn_stamp = None
+
+    def knn(self) -> Optional[KnnGraph]:
+        # reopened when the builder swaps in a new graph (meta.json is written last)
+        if not self.knn_dir:
+            return None
+        try:
+            stamp = os.stat(os.path.join(self.knn_dir, META_FILE)).st_mtime_ns
+        except OSError:
+            return None
+        if stamp != self._knn_stamp:
+            self._knn, self._knn_stamp = KnnGraph(self.knn_dir), stamp
+        return self._knn
+
+    def similar(self, fid: int, params: dict) -> dict:
+        graph = self.knn()
+        if graph is None:
+            raise HTTPError(404, "no k-NN graph configured (--knn)")
+        k = _int_param(params, "k", min(TOP_K, graph.k), 1, graph.k)
+        hit = graph.lookup(fid, k)
+        if hit is None:
+            raise HTTPError(404, f"FAISS id {fid} is not in the k-NN graph")
+        gen = self.hot.current
+        return {"query": {"faiss_id": fid, "track_id": gen.id2db.get(fid)}, "graph_built_at": graph.meta.get("built_at"),
+                "results": _results(gen, *hit)}
+
+    async def _search(self, key: tuple, make_vec, k: int, exclude_id: Optional[int] = None):
+        # popular queries are answered from the cache; a new index generation empties it
+        gen = self.hot.current
+        hit = self.cache.get(key, gen.number) if self.cache is not None else None
+        if hit is not None:
+            return gen, hit[0], hit[1]
+        searched, sims, ids = await self.batcher.search(make_vec(gen), k, exclude_id)
+        # the query vector came from `gen`; if the batcher already searched a newer one, the result is mixed
+        if self.cache is not None and searched.number == gen.number:
+            self.cache.put(key, gen.number, sims, ids)
+        return searched, sims, ids
+
+    async def by_id(self, fid: int, params: dict) -> dict:
+        def make_vec(gen):
+            vec = reconstruct_vec(gen.index, fid)
+            if vec is None:
+                raise HTTPError(404, f"FAISS id {fid} is not in the index")
+            return vec
+
+        k = _int_param(params, "k", TOP_K, 1, MAX_K)
+        include_self = str(params.get("include_self", ["0"])[0]).lower() in ("1", "true", "yes")
+        gen, sims, ids = await self._search(cache_key("id", fid, k, include_self), make_vec, k,
+                                            exclude_id=None if include_self else fid)
+        return {"query": {"faiss_id": fid, "track_id": gen.id2db.get(fid)}, "generation": gen.number,
+                "results": _results(gen, sims, ids)}
+
+    async def by_track(self, track_id: str, params: dict) -> dict:
+        fid = parse_query_id(track_id, self.hot.current.find_track)
+        if fid is None:
+            raise HTTPError(404, f"track {track_id} is not in the mapping")
+        return await self.by_id(fid, params)
+
+    async def by_vector(self, body: dict, params: dict) -> dict:
+        gen = self.hot.current
+        try:
+            vec = np.asarray(body["vector"], dtype="float32").reshape(-1)
+        except (KeyError, TypeError, ValueError):
+            raise HTTPError(400, "body must be {\"vector\": [float, ...]}")
+        if vec.shape[0] != gen.index.d:
+            raise HTTPError(400, f"vector has {vec.shape[0]} dims, index has {gen.index.d}")
+        vec = unit(vec)  # the embedder stores unit vectors: IP is cosine
+        k = _int_param({**params, **body}, "k", TOP_K, 1, MAX_K)
+        gen, sims, ids = await self._search(cache_key("vector", vector_key(vec), k), lambda _: vec, k)
+        return {"query": {"vector_dim": int(vec.shape[0])}, "generation": gen.number, "results": _results(gen, sims, ids)}
+
+    async def by_audio(self, body: bytes, headers: dict, params: dict) -> dict:
+        # raw PCM in the body (?sr=&format=f32le|s16le&channels=), or {"path": ...} as JSON for a file under audio_root
+        if self.audio is None:
+            raise HTTPError(404, "audio queries are disabled (start with --audio)")
+        t0 = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        try:
+            if headers.get("content-type", "").startswith("application/json"):
+                req = json.loads(body or b"{}")
+                if not isinstance(req, dict) or not req.get("path"):
+                    raise HTTPError(400, "body must be {\"path\": \"file.wav\"}")
+                path = _local_audio_path(self.audio_root, str(req["path"]))
+                vec, timings = await loop.run_in_executor(None, self.audio.embed_file, path)
+            else:
+                sr = _int_param(params, "sr", 0, 1, 384000)
+                channels = _int_param(params, "channels", 1, 1, 16)
+                fmt = params.get("format", ["f32le"])[0]
+                vec, timings = await loop.run_in_executor(None, self.audio.embed_pcm, body, sr, fmt, channels)
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+
+        k = _int_param(params, "k", TOP_K, 1, MAX_K)
+        t = time.perf_counter()
+        vec = unit(vec)
+        gen, sims, ids = await self._search(cache_key("vector", vector_key(vec), k), lambda _: vec, k)
+        timings["search_s"] = time.perf_counter() - t
+        timings["total_s"] = time.perf_counter() - t0
+        return {"query": {"audio_s": round(timings.get("audio_s", 0.0), 3)}, "generation": gen.number,
+                "timings": {name: round(v, 4) for name, v in timings.items()}, "results": _results(gen, sims, ids)}
+
+    def health(self) -> dict:
+        gen = self.hot.current
+        b = self.batcher
+        return {"status": "ok", "generation": gen.number, "ntotal": int(gen.index.ntotal), "mapping": len(gen.id2db),
+                "uptime_s": round(time.time() - self.started, 1), "batches": b.batches, "queries": b.queries,
+                "avg_batch": round(b.queries / b.batches, 2) if b.batches else 0.0,
+                "cache": self.cache.stats() if self.cache is not None else None}
+
+    async def route(self, method: str, target: str, body: bytes, headers: dict) -> dict:
+        url = urlsplit(target)
+        params = parse_qs(url.query)
+        parts = [p for p in url.path.split("/") if p]
+
+        if method == "GET" and parts == ["health"]:
+            return self.health()
+        if method == "GET" and len(parts) == 3 and parts[:2] == ["search", "id"]:
+            try:
+                fid = int(parts[2])
+            except ValueError:
+                raise HTTPError(400, "FAISS id must be an integer")
+            return await self.by_id(fid, params)
+        if method == "GET" and len(parts) == 3 and parts[:2] == ["search", "track"]:
+            return await self.by_track(parts[2], params)
+        if method == "GET" and len(parts) == 3 and parts[:2] == ["similar", "id"]:
+            try:
+                return self.similar(int(parts[2]), params)
+            except ValueError:
+                raise HTTPError(400, "FAISS id must be an integer")
+        if method == "GET" and len(parts) == 3 and parts[:2] == ["similar", "track"]:
+            fid = parse_query_id(parts[2], self.hot.current.find_track)
+            if fid is None:
+                raise HTTPError(404, f"track {parts[2]} is not in the mapping")
+            return self.similar(fid, params)
+        if method == "POST" and parts == ["search", "audio"]:
+            return await self.by_audio(body, headers, params)
+        if method == "POST" and parts == ["search", "vector"]:
+            try:
+                payload = json.loads(body or b"{}")
+            except ValueError:
+                raise HTTPError(400, "body is not valid JSON")
+            if not isinstance(payload, dict):
+                raise HTTPError(400, "body must be a JSON object")
+            return await self.by_vector(payload, params)
+        raise HTTPError(404, f"no route for {method} {url.path}")
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # minimal HTTP/1.1 with keep-alive: enough for JSON clients and load balancers' health checks
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    return
+                lines = head.decode("latin-1").split("\r\n")
+                try:
+                    method, target, version = lines[0].split(" ", 2)
+                except ValueError:
+                    return
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+
+                status, payload = 200, None
+                try:
+                    length = int(headers.get("content-length", "0") or 0)
+                    limit = AUDIO_MAX_BODY_BYTES if target.startswith("/search/audio") else MAX_BODY_BYTES
+                    if length > limit:
+                        raise HTTPError(413, "request body too large")
+                    body = await reader.readexactly(length) if length else b""
+                    payload = await self.route(method.upper(), target, body, headers)
+                except HTTPError as e:
+                    status, payload = e.status, {"error": str(e)}
+                except asyncio.IncompleteReadError:
+                    return
+                except Exception as e:
+                    status, payload = 500, {"error": f"{type(e).__name__}: {e}"}
+
+                keep_alive = (version.upper() == "HTTP/1.1" and headers.get("connection", "").lower() != "close")
+                data = json.dumps(payload).encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    return
+        finally:
+            writer.close()
+
+
+async def serve(idx_path: str, map_path: str, host: str = SERVICE_HOST, port: int = SERVICE_PORT,
+                knn_dir: str = KNN_GRAPH_DIR, audio: bool = False, cache_mb: float = RESULT_CACHE_MB,
+                audio_root: str = AUDIO_FILE_ROOT) -> None:
+    hot = HotIndex(idx_path, map_path)
+    batcher = MicroBatcher(hot)
+    embedder = None
+    if audio:
+        # started before serving so the first audio query does not pay the model load
+        embedder = AudioEmbedder()
+        info = embedder.start()
+        print(f"Audio embedder ready ({info.get('embedding_id')}, load {info.get('load_s') or 0:.1f}s)")
+    service = SearchService(hot, batcher, knn_dir, embedder, ResultCache(cache_mb) if cache_mb > 0 else None,
+                            audio_root)
+    batch_task = asyncio.create_task(batcher.run())
+    server = await asyncio.start_server(service.handle, host, port)
+    gen = hot.current
+    print(f"Serving {idx_path} (ntotal={gen.index.ntotal}, mapping={len(gen.id2db)}) on http://{host}:{port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batch_task.cancel()
+        hot.stop()
+        if embedder is not None:
+            embedder.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index", default=MUSIC_IDX, help="music.index or shards/manifest.json")
+    parser.add_argument("--mapping", default=MAP_CSV)
+    parser.add_argument("--host", default=SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    parser.add_argument("--knn", default=KNN_GRAPH_DIR, help="k-NN graph directory for /similar")
+    parser.add_argument("--audio", action="store_true", help="enable POST /search/audio (keeps a warm embedder)")
+    parser.add_argument("--audio-root", default=AUDIO_FILE_ROOT,
+                        help='directory {"path": ...} audio queries may read from (default: PCM uploads only)')
+    parser.add_argument("--cache-mb", type=float, default=RESULT_CACHE_MB, help="result cache size (0 = off)")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.index, args.mapping, args.host, args.port, args.knn, args.audio, args.cache_mb,
+                          args.audio_root))
+    except KeyboardInterrupt:
+        pass
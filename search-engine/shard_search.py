@@ -0,0 +1,107 @@
+﻿# shard_search.py
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import faiss
+import numpy as np
+
+from config import SHARD_SEARCH_THREADS
+
+
+def _load_ids(path: str) -> np.ndarray:
+    return np.load(path) if os.path.exists(path) else np.zeros(0, dtype="int64")
+
+
+class Shard:
+    def __init__(self, name: str, index, deleted: np.ndarray, kind: str):
+        self.name = name
+        self.index = index
+        self.deleted = deleted
+        self.params = None
+        self.post_filter = False
+        if len(deleted) and kind == "pq_refine":
+            # IndexRefine ignores selectors under an IDMap, so deleted ids are dropped from an over-fetch instead
+            self.post_filter = True
+        elif len(deleted):
+            # ids superseded by a newer shard; the selectors must outlive the params that point at them
+            self._batch = faiss.IDSelectorBatch(deleted)
+            self._sel = faiss.IDSelectorNot(self._batch)
+            if kind in ("ivf_flat", "ivf_pq"):
+                self.params = faiss.SearchParametersIVF()
+                self.params.nprobe = faiss.extract_index_ivf(index).nprobe
+            elif kind == "hnsw":
+                base = faiss.downcast_index(index)
+                base = faiss.downcast_index(base.index) if isinstance(base, faiss.IndexIDMap) else base
+                self.params = faiss.SearchParametersHNSW()
+                self.params.efSearch = base.hnsw.efSearch
+            else:
+                self.params = faiss.SearchParameters()
+            self.params.sel = self._sel
+
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal - len(self.deleted)
+
+    def search(self, q: np.ndarray, k: int):
+        if not self.post_filter:
+            return self.index.search(q, k, params=self.params)
+        D, I = self.index.search(q, min(self.index.ntotal, k + len(self.deleted)))
+        dead = np.isin(I, self.deleted)
+        D = np.where(dead, -np.inf, D).astype("float32")
+        I = np.where(dead, -1, I)
+        order = np.argsort(-D, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(D, order, axis=1), np.take_along_axis(I, order, axis=1)
+
+
+class ShardSet:
+    # read-only view of an embedder shard manifest that searches like a single index
+    def __init__(self, manifest_path: str, threads: int = SHARD_SEARCH_THREADS, prepare=None, kind_of=None,
+                 reader=faiss.read_index):
+        root = os.path.dirname(os.path.abspath(manifest_path))
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+
+        self.shards: list[Shard] = []
+        for s in manifest["shards"]:
+            path = os.path.join(root, s["index"])
+            if not os.path.exists(path):
+                continue  # open shard that has not been checkpointed yet
+            index = reader(path)
+            if prepare is not None:
+                prepare(index)
+            kind = kind_of(index) if kind_of is not None else "flat"
+            self.shards.append(Shard(s["name"], index, _load_ids(os.path.join(root, s["deleted"])), kind))
+        if not self.shards:
+            raise ValueError(f"No shard indexes found for {manifest_path}")
+
+        self.d = self.shards[0].index.d
+        self.kinds = sorted({kind_of(sh.index) if kind_of is not None else "flat" for sh in self.shards})
+        # faiss releases the GIL inside search, so shard searches run concurrently
+        self.pool = ThreadPoolExecutor(max_workers=threads or len(self.shards), thread_name_prefix="shard")
+
+    @property
+    def ntotal(self) -> int:
+        return sum(sh.ntotal for sh in self.shards)
+
+    def search(self, q: np.ndarray, k: int):
+        q = np.ascontiguousarray(np.atleast_2d(q), dtype="float32")
+        parts = list(self.pool.map(lambda sh: sh.search(q, k), self.shards))
+        D = np.hstack([p[0] for p in parts])
+        I = np.hstack([p[1] for p in parts])
+        # every id lives in exactly one shard, so the top-k of the union is the exact top-k
+        order = np.argsort(-D, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(D, order, axis=1), np.take_along_axis(I, order, axis=1)
+
+    def reconstruct(self, fid: int) -> np.ndarray:
+        for sh in self.shards:
+            if fid in sh.deleted:
+                continue
+            try:
+                return sh.index.reconstruct(int(fid))
+            except RuntimeError:
+                continue
+        raise RuntimeError(f"id {fid} not found in any shard")
+
+    def close(self) -> None:
+        self.pool.shutdown(wait=False)
@@ -0,0 +1,6 @@
+﻿# conftest.py
+import os
+import sys
+
+# per service (python -m pytest tests from search-engine): embedder-service has its own flat `config` module
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
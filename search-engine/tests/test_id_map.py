@@ -0,0 +1,80 @@
+﻿# test_id_map.py
+import json
+import uuid
+
+import numpy as np
+import pytest
+
+from id_map import ENTRY_DTYPE, CompactMapping, read_compact
+
+# GUIDs with trailing zero bytes, which numpy strips from S16 values
+UUIDS = [str(uuid.UUID(int=((n * 0x9E3779B97F4A7C15) % 2 ** 64) << 64)) for n in range(1, 6)]
+FIDS = [10, 11, 12, 13, 14]
+
+
+def _rows(fids=FIDS, uuids=UUIDS):
+    rows = np.zeros(len(fids), dtype=ENTRY_DTYPE)
+    rows["fid"] = fids
+    rows["uuid"] = [uuid.UUID(u).bytes for u in uuids]
+    rows["by_uuid"] = sorted(range(len(fids)), key=lambda i: uuid.UUID(uuids[i]).bytes)
+    return rows
+
+
+@pytest.fixture
+def mapping():
+    # 11 removed, 12 re-pointed at a new track, 20 takes over 11's track, 99 is a filename-keyed extra
+    overlay = {11: "", 12: "new-track", 20: UUIDS[1]}
+    return CompactMapping(_rows(), {"uppercase": True, "extras": {"99": "file.wav"}}, overlay)
+
+
+def test_lookup_applies_overlay(mapping):
+    assert mapping[10] == UUIDS[0].upper()
+    assert mapping.lookup_many([11, 12, 20, 99, 5]) == [None, "new-track", UUIDS[1], "file.wav", None]
+    assert 11 not in mapping and 20 in mapping and "x" not in mapping
+    with pytest.raises(KeyError):
+        mapping[11]
+
+
+def test_len_and_iteration_skip_tombstones(mapping):
+    assert len(mapping) == 6
+    assert sorted(mapping) == [10, 12, 13, 14, 20, 99]
+    assert len(list(mapping)) == len(mapping)
+
+
+def test_overlay_over_extras_and_missing_ids():
+    m = CompactMapping(_rows(), {"extras": {"99": "file.wav", "98": "gone.wav"}}, {98: "", 77: ""})
+    assert len(m) == 6
+    assert sorted(m) == [10, 11, 12, 13, 14, 99]
+    assert m.find("gone.wav") is None
+
+
+def test_find_follows_overlay(mapping):
+    assert mapping.find(UUIDS[0].upper()) == 10
+    assert mapping.find(f" {UUIDS[3]} ") == 13
+    assert mapping.find(UUIDS[1]) == 20      # moved by the overlay
+    assert mapping.find(UUIDS[2]) is None    # its row was re-pointed
+    assert mapping.find("NEW-TRACK") == 12
+    assert mapping.find("FILE.wav") == 99
+    assert mapping.find(str(uuid.uuid4())) is None
+    assert mapping.find("not-a-guid") is None
+
+
+def test_find_on_empty_table():
+    m = CompactMapping(np.zeros(0, dtype=ENTRY_DTYPE), {}, {1: UUIDS[0]})
+    assert len(m) == 1 and list(m) == [1]
+    assert m.find(UUIDS[0]) == 1 and m.find(UUIDS[1]) is None
+
+
+def test_read_compact_follows_meta(tmp_path):
+    path = str(tmp_path / "mapping.npy")
+    np.save(tmp_path / "mapping.3.npy", _rows())
+    with open(path + ".meta.json", "w", encoding="utf-8") as f:
+        json.dump({"file": "mapping.3.npy", "version": 3, "n": len(FIDS)}, f)
+    rows, meta = read_compact(path)
+    assert meta["version"] == 3
+    assert CompactMapping(rows, meta).find(UUIDS[4]) == 14
+
+    with open(path + ".meta.json", "w", encoding="utf-8") as f:
+        json.dump({"file": "mapping.3.npy", "n": len(FIDS) + 1}, f)
+    with pytest.raises(ValueError):
+        read_compact(path)
@@ -1,18 +1,28 @@
 ﻿from typing import List, Dict, Set
 from copy import deepcopy
-from config import Settings
-from dao_mssql import MSSQLDAO
+from config import Settings, DB_BACKEND
 from filters import iso8601_duration_to_seconds, should_keep_noncat10, should_keep_cat10, safe_lang
 from yt_client import YouTubeClient
 
 YOUTUBE_URL = "https://www.youtube.com/watch?v={}"
 
 
+def make_dao(settings: Settings):
+    # imported lazily so the sqlite backend runs without SQLAlchemy / pyodbc installed
+    if DB_BACKEND == "sqlite":
+        from dao_sqlite import SQLiteDAO
+        return SQLiteDAO(settings)
+    if DB_BACKEND == "mssql":
+        from dao_mssql import MSSQLDAO
+        return MSSQLDAO(settings)
+    raise ValueError(f"Unknown DB_BACKEND '{DB_BACKEND}', expected 'mssql' or 'sqlite'")
+
+
 class Collector:
     def __init__(self, settings: Settings):
         self.settings = settings
         self.yt = YouTubeClient()
-        self.dao = MSSQLDAO(settings)
+        self.dao = make_dao(settings)
 
     def discover_playlists(self, country: str, scene_cfg) -> List[Dict[str, str]]:
         seen_source: Set[str] = set()
@@ -9,7 +9,7 @@ class SceneConfig(BaseModel):
     name: str
     keywords: List[str]
     negative_keywords: List[str] = []
-    daily_admit_cap: int = 200
+    daily_admit_cap: Optional[int] = None  # None = global.daily_admit_cap; read by embedder-service/claim_scheduler.py
 
 
 class GlobalConfig(BaseModel):
@@ -19,6 +19,7 @@ class GlobalConfig(BaseModel):
     search_max_playlists_per_scene: int = 40
     search_results_per_query: int = 25
     per_playlist_seed_count: int = 3
+    daily_admit_cap: Optional[int] = None  # per scene per day; None = uncapped
     filtering: Dict[str, Any] = {}
     playlist_quality: Dict[str, Any] = {}
     crawl_limits: Dict[str, Any] = {}
@@ -44,6 +45,10 @@ YT_API_KEY = os.getenv("YT_API_KEY", "")
 if not YT_API_KEY:
     print("⚠️  Set YT_API_KEY environment variable.")
 
+# "mssql" (default) or "sqlite": a single-file database for local runs, the same one embedder-service reads
+DB_BACKEND = os.getenv("DB_BACKEND", "mssql").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "../data/ums.sqlite3")
+
 DB_CONN_STR = os.getenv("DB_CONN_STR", "")
 
 MSSQL_DRIVER = os.getenv("MSSQL_DRIVER", "ODBC Driver 17 for SQL Server")
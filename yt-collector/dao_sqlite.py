@@ -0,0 +1,181 @@
+﻿import os
+import uuid
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Optional
+from config import SQLITE_PATH, Settings
+
+NOW_SQL = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+# the DDL lives in data/schema.sql, shared with embedder-service/db_sqlite.py
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "data", "schema.sql")
+
+CHUNK = 900  # below SQLITE_MAX_VARIABLE_NUMBER on every build
+
+
+def _new_id() -> str:
+    return str(uuid.uuid4()).upper()  # same text form as CONVERT(varchar(36), UNIQUEIDENTIFIER)
+
+
+def _text(v):
+    # timestamps are stored as UTC text, the format db_sqlite.py writes
+    if isinstance(v, datetime):
+        if v.tzinfo is not None:
+            v = v.astimezone(timezone.utc)
+        return v.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+    return v
+
+
+class SQLiteDAO:
+    # same methods as MSSQLDAO over a local SQLite file; MERGE becomes INSERT ... ON CONFLICT DO UPDATE
+    def __init__(self, settings: Optional[Settings] = None, path: str = SQLITE_PATH):
+        self.path = path
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, exist_ok=True)
+        with self._conn() as cx, open(SCHEMA_PATH, encoding="utf-8") as f:
+            cx.executescript(f.read())
+
+    @contextmanager
+    def _conn(self):
+        cx = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        cx.row_factory = sqlite3.Row
+        try:
+            cx.execute("PRAGMA journal_mode=WAL")
+            cx.execute("PRAGMA busy_timeout=30000")
+            yield cx
+        finally:
+            cx.close()
+
+    @contextmanager
+    def _begin(self):
+        with self._conn() as cx:
+            cx.execute("BEGIN IMMEDIATE")
+            try:
+                yield cx
+                cx.execute("COMMIT")
+            except BaseException:
+                cx.execute("ROLLBACK")
+                raise
+
+    def upsert_playlists(self, playlists: List[Dict[str, Any]]):
+        if not playlists: return
+        sql = f"""
+            INSERT INTO Playlists (id, platform, source_playlist_id, title, description, country, scene, etag, created_at)
+            VALUES (:id, :platform, :source_playlist_id, :title, :description, :country, :scene, :etag, {NOW_SQL})
+            ON CONFLICT (platform, source_playlist_id) DO UPDATE SET
+              title = excluded.title,
+              description = excluded.description,
+              country = COALESCE(Playlists.country, excluded.country),
+              scene = COALESCE(Playlists.scene, excluded.scene),
+              etag = excluded.etag
+        """
+        with self._begin() as cx:
+            cx.executemany(sql, [{**p, "id": _new_id()} for p in playlists])
+
+    def map_playlist_sources_to_guids(self, platform: str, source_ids: List[str]) -> Dict[str, str]:
+        if not source_ids: return {}
+        ids = list(dict.fromkeys(source_ids))
+        mapping = {}
+        with self._conn() as cx:
+            for i in range(0, len(ids), CHUNK):
+                chunk = ids[i:i + CHUNK]
+                rows = cx.execute(
+                    f"SELECT source_playlist_id, id FROM Playlists "
+                    f"WHERE platform = ? AND source_playlist_id IN ({', '.join(['?'] * len(chunk))})",
+                    [platform, *chunk]
+                ).fetchall()
+                mapping.update({r["source_playlist_id"]: str(r["id"]) for r in rows})
+        return mapping
+
+    def get_playlist_by_guid(self, playlist_guid: str) -> Optional[Dict[str, Any]]:
+        with self._conn() as cx:
+            r = cx.execute(
+                "SELECT id, last_scanned_at, cooccurrence_counted FROM Playlists WHERE id = :pid",
+                {"pid": playlist_guid}
+            ).fetchone()
+        if not r: return None
+        last = datetime.fromisoformat(r["last_scanned_at"]) if r["last_scanned_at"] else None
+        return {"id": str(r["id"]), "last_scanned_at": last, "cooccurrence_counted": bool(r["cooccurrence_counted"])}
+
+    def mark_cooccurrence_done(self, playlist_guid: str):
+        with self._begin() as cx:
+            cx.execute("UPDATE Playlists SET cooccurrence_counted = 1 WHERE id = :pid", {"pid": playlist_guid})
+
+    def touch_playlist_scanned(self, playlist_guid: str):
+        with self._begin() as cx:
+            cx.execute(f"UPDATE Playlists SET last_scanned_at = {NOW_SQL} WHERE id = :pid", {"pid": playlist_guid})
+
+    def upsert_tracks(self, rows: List[Dict[str, Any]]):
+        if not rows: return
+        sql = f"""
+            INSERT INTO Tracks
+              (id, platform, source_id, source_url, status, title, channel_id, category_id, upload_date,
+               duration_sec, view_count, is_live, etag, country_bucket, scene, seed, collected_at)
+            VALUES
+              (:id, :platform, :source_id, :source_url, 'collected', :title, :channel_id, :category_id, :upload_date,
+               :duration_sec, :view_count, :is_live, :etag, :country_bucket, :scene, :seed, {NOW_SQL})
+            ON CONFLICT (platform, source_id) DO UPDATE SET
+              title = excluded.title,
+              channel_id = excluded.channel_id,
+              category_id = excluded.category_id,
+              upload_date = excluded.upload_date,
+              duration_sec = excluded.duration_sec,
+              view_count = excluded.view_count,
+              is_live = excluded.is_live,
+              etag = excluded.etag,
+              country_bucket = COALESCE(Tracks.country_bucket, excluded.country_bucket),
+              scene = COALESCE(Tracks.scene, excluded.scene),
+              seed = CASE WHEN Tracks.seed = 1 THEN 1 ELSE excluded.seed END,
+              last_checked_at = {NOW_SQL}
+        """
+        params = [{**{k: _text(v) for k, v in r.items()}, "id": _new_id()} for r in rows]
+        with self._begin() as cx:
+            cx.executemany(sql, params)
+
+    def map_source_ids_to_track_ids(self, source_ids: List[str]) -> Dict[str, str]:
+        if not source_ids: return {}
+        mapping = {}
+        with self._conn() as cx:
+            for i in range(0, len(source_ids), CHUNK):
+                chunk = list(dict.fromkeys(source_ids[i:i + CHUNK]))
+                rows = cx.execute(
+                    f"SELECT source_id, id FROM Tracks "
+                    f"WHERE platform = 'youtube' AND source_id IN ({', '.join(['?'] * len(chunk))})",
+                    chunk
+                ).fetchall()
+                for r in rows:
+                    mapping[r["source_id"]] = str(r["id"])
+        return mapping
+
+    def upsert_track_playlists(self, links: List[Dict[str, Any]]):
+        if not links: return
+        sql = f"""
+            INSERT INTO TrackPlaylists (playlist_id, track_id, position, first_seen_at, last_seen_at)
+            VALUES (:playlist_id, :track_id, :position, {NOW_SQL}, {NOW_SQL})
+            ON CONFLICT (playlist_id, track_id) DO UPDATE SET
+              last_seen_at = {NOW_SQL},
+              position = COALESCE(excluded.position, TrackPlaylists.position)
+        """
+        with self._begin() as cx:
+            cx.executemany(sql, links)
+
+    def increment_cooccurrence(self, pairs: List[Dict[str, Any]]):
+        if not pairs: return
+        sql = """
+            INSERT INTO CoOccurrence (track_id_a, track_id_b, count) VALUES (:a, :b, :cnt)
+            ON CONFLICT (track_id_a, track_id_b) DO UPDATE SET count = CoOccurrence.count + excluded.count
+        """
+        with self._begin() as cx:
+            cx.executemany(sql, pairs)
+
+    def update_playlist_quality(self, playlist_guid: str, music_ratio: float, trust_score: float):
+        sql = f"""
+                   UPDATE Playlists
+                   SET coherence       = :music_ratio,
+                       hub_score       = :trust_score,
+                       last_scanned_at = {NOW_SQL}
+                   WHERE id = :pid
+                   """
+        with self._begin() as cx:
+            cx.execute(sql, {"music_ratio": float(music_ratio), "trust_score": float(trust_score), "pid": playlist_guid})
@@ -1,5 +1,5 @@
 ﻿import argparse
-from config import Settings
+from config import Settings, DB_BACKEND
 from collector_mssql import Collector
 
 
@@ -17,7 +17,7 @@ def main():
 
     collector = Collector(settings)
     collector.crawl_scene(args.country, scene_cfg)
-    print(f"✅ Collected playlists + tracks for {args.country}/{args.scene} into MSSQL.")
+    print(f"✅ Collected playlists + tracks for {args.country}/{args.scene} into {'SQLite' if DB_BACKEND == 'sqlite' else 'MSSQL'}.")
 
 
 if __name__ == "__main__":